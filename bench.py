@@ -0,0 +1,500 @@
+#!/usr/bin/python3
+import configparser
+import io
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import greylist
+
+# fractions of the synthesized traffic, see generate_requests()
+DEFAULT_MIX = {
+    "whitelisted": 0.5,
+    "new": 0.2,
+    "retry_early": 0.1,
+    "retry_late": 0.1,
+    "burst": 0.1,
+}
+
+def parse_mix(value):
+    """
+    Parse a traffic mix of the form ``kind=weight,kind=weight,...``.
+    """
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError("Invalid request kind: {}".format(kind))
+        mix[kind] = float(weight)
+    return mix
+
+# the other attributes of a Postfix policy request, which greylist.py ignores
+POSTFIX_ATTRIBUTES = {
+    "client_port": "52842",
+    "reverse_client_name": "mx.example.com",
+    "server_address": "198.51.100.25",
+    "server_port": "25",
+    "helo_name": "mx.example.com",
+    "queue_id": "",
+    "recipient_count": "0",
+    "instance": "4b8e.6533e5a1.b7c0b.0",
+    "size": "0",
+    "etrn_domain": "",
+    "stress": "",
+    "sasl_method": "",
+    "sasl_username": "",
+    "sasl_sender": "",
+    "ccert_subject": "",
+    "ccert_issuer": "",
+    "ccert_fingerprint": "",
+    "ccert_pubkey_fingerprint": "",
+    "encryption_protocol": "TLSv1.3",
+    "encryption_cipher": "TLS_AES_256_GCM_SHA384",
+    "encryption_keysize": "256",
+    "policy_context": "",
+    "compatibility_level": "3.6",
+    "mail_version": "3.7.11",
+    "protocol_name": "ESMTP",
+}
+
+def make_request(client_name, sender, recipient):
+    return {
+        "request": "smtpd_access_policy",
+        "protocol_state": "RCPT",
+        "client_name": client_name,
+        "client_address": "192.0.2.1",
+        "sender": sender,
+        "recipient": recipient,
+    }
+
+def generate_requests(count, mix, rng, clients=1000):
+    """
+    Synthesize *count* requests according to *mix* and return them together
+    with the state they expect in the database, as a tuple ``(requests,
+    whitelisted, greylisted)``:
+
+    * ``whitelisted`` requests come from one of *clients* already whitelisted
+      client names, listed in ``whitelisted``.
+    * ``new`` requests carry a greylisting key which has not been seen before.
+    * ``retry_early`` and ``retry_late`` requests retry a greylisting key from
+      ``greylisted`` (a list of ``(key, age)`` tuples) within respectively
+      after the greylisting window.
+    * ``burst`` requests all come from a single client name, sending to
+      ever new recipients like a spam wave.
+    """
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    whitelisted = ["wl{}.example.net".format(i) for i in range(clients)]
+    greylisted = []
+    requests = []
+    for i, kind in enumerate(rng.choices(kinds, weights, k=count)):
+        if kind == "whitelisted":
+            client_name = rng.choice(whitelisted)
+            key = (client_name, "user{}@example.net".format(i),
+                   "rcpt{}@example.org".format(rng.randrange(100)))
+        elif kind == "new":
+            key = ("mx{}.example.com".format(rng.randrange(clients)),
+                   "sender{}@example.com".format(i),
+                   "rcpt{}@example.org".format(rng.randrange(100)))
+        elif kind == "burst":
+            key = ("spam.example.info",
+                   "sender{}@example.info".format(rng.randrange(10)),
+                   "rcpt{}@example.org".format(i))
+        else:
+            key = ("retry{}.example.com".format(rng.randrange(clients)),
+                   "sender{}@example.com".format(i),
+                   "rcpt{}@example.org".format(rng.randrange(100)))
+            age = 0 if kind == "retry_early" else greylist.greylist_timeout
+            greylisted.append((key, age))
+        requests.append(make_request(*key))
+    return requests, whitelisted, greylisted
+
+def seed_db(whitelisted, greylisted, now):
+    """
+    Create the whitelist and greylist entries expected by the requests from
+    :func:`generate_requests`.
+    """
+    backend = greylist.get_backend()
+    threshold = greylist.auto_whitelist_threshold or 0
+    for client_name in whitelisted:
+        for i in range(threshold + 1):
+            backend.atomic(backend.add_whitelist_hit, client_name, now)
+    for key, age in greylisted:
+        backend.atomic(backend.upsert_greylist, key, now - age)
+    greylist.flush_db()
+
+def read_requests(f):
+    """
+    Read recorded policy requests (attribute lines separated by empty lines)
+    from *f*.
+    """
+    requests = []
+    while True:
+        request = greylist.read_request(f)
+        if request is None:
+            return requests
+        if request:
+            requests.append(request)
+
+def format_request(request):
+    return "".join("{}={}\n".format(*item) for item in request.items()) + "\n"
+
+def run_inprocess(requests, interval=None):
+    """
+    Answer *requests* by calling into :mod:`greylist` like its stdin mode does
+    and return the latency of every request and the responses.
+
+    If *interval* is given, :data:`greylist.clock` has to be a
+    :class:`greylist.VirtualClock`, which is advanced by *interval* seconds
+    after every request.
+    """
+    latencies = []
+    responses = []
+    for request in requests:
+        started = time.perf_counter()
+        response = greylist.respond(dict(request))
+        greylist.commit_batch()
+        latencies.append(time.perf_counter() - started)
+        responses.append(response)
+        greylist.maybe_flush_db()
+        greylist.maybe_gc_db()
+        if interval is not None:
+            greylist.clock.advance(interval)
+    greylist.close_db()
+    return latencies, responses
+
+def run_parse(requests, repeat=10):
+    """
+    Parse *requests*, completed by the attributes in
+    :data:`POSTFIX_ATTRIBUTES`, *repeat* times with
+    :func:`greylist.read_request` and with :class:`greylist.RequestParser`,
+    and return the seconds taken by each of them.
+    """
+    texts = [format_request(dict(POSTFIX_ATTRIBUTES, **request))
+             for request in requests]
+    stream = "".join(texts)
+    chunks = [text.encode() for text in texts]
+
+    started = time.perf_counter()
+    for i in range(repeat):
+        f = io.StringIO(stream)
+        while greylist.read_request(f) is not None:
+            pass
+    read_request_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(repeat):
+        parser = greylist.RequestParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    parser_seconds = time.perf_counter() - started
+    return read_request_seconds, parser_seconds
+
+def run_stdin(requests, config_file):
+    """
+    Answer *requests* through a ``greylist.py`` process reading them from its
+    stdin, one after the other.
+    """
+    process = subprocess.Popen(
+        [sys.executable, greylist.__file__, "-c", config_file],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        universal_newlines=True, bufsize=1)
+    latencies = []
+    responses = []
+    try:
+        for request in requests:
+            started = time.perf_counter()
+            process.stdin.write(format_request(request))
+            process.stdin.flush()
+            line = process.stdout.readline()
+            # skip the empty lines terminating the previous response
+            while line == "\n":
+                line = process.stdout.readline()
+            latencies.append(time.perf_counter() - started)
+            responses.append(line + "\n")
+    finally:
+        process.stdin.close()
+        process.wait()
+    return latencies, responses
+
+def _socket_client(address, requests, latencies, responses):
+    kind, addr = address
+    if kind == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(addr)
+    else:
+        # IPv4 or IPv6, whatever the host resolves to
+        sock = socket.create_connection(addr)
+    with sock:
+        f = sock.makefile("rwb")
+        for request in requests:
+            started = time.perf_counter()
+            f.write(format_request(request).encode())
+            f.flush()
+            response = []
+            while True:
+                line = f.readline()
+                if not line:
+                    raise ConnectionError("connection closed by server")
+                response.append(line)
+                if line == b"\n":
+                    break
+            latencies.append(time.perf_counter() - started)
+            responses.append(b"".join(response).decode())
+
+def run_socket(requests, address, connections=1):
+    """
+    Answer *requests* through the policy daemon listening on *address* (as
+    returned by :func:`greylist.parse_listen_address`), distributing them
+    across *connections* concurrent connections.
+    """
+    latencies = []
+    responses = []
+    threads = [
+        threading.Thread(target=_socket_client,
+                         args=(address, requests[i::connections],
+                               latencies, responses))
+        for i in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(responses) != len(requests):
+        raise RuntimeError("{} of {} requests failed".format(
+            len(requests) - len(responses), len(requests)))
+    return latencies, responses
+
+def start_daemon(config_file, address):
+    """
+    Start a ``greylist.py`` daemon listening on the unix socket *address* and
+    wait until it accepts connections.
+    """
+    process = subprocess.Popen(
+        [sys.executable, greylist.__file__, "-c", config_file,
+         "--listen", "unix:" + address])
+    deadline = time.monotonic() + 10
+    while True:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(address)
+                return process
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError("daemon did not start")
+        time.sleep(0.05)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))]
+
+def db_state():
+    """
+    Return the entry counts and the size of the database files.
+    """
+    backend = greylist.get_backend()
+    counts = backend.count("greylist"), backend.count("whitelist")
+    greylist.close_db()
+    size = 0
+    if greylist.storage == "sqlite":
+        for path in greylist.db_files():
+            for suffix in ("", "-wal"):
+                try:
+                    size += os.stat(path + suffix).st_size
+                except FileNotFoundError:
+                    pass
+    return counts + (size,)
+
+def report(mode, latencies, responses, duration, before, after):
+    outcomes = {}
+    for response in responses:
+        action = response.split()[0] if response.strip() else "(none)"
+        outcomes[action] = outcomes.get(action, 0) + 1
+    print("mode {}".format(mode))
+    print("requests {}".format(len(latencies)))
+    print("requests_per_second {:.1f}".format(len(latencies) / duration))
+    print("latency_p50_ms {:.3f}".format(percentile(latencies, 0.5) * 1000))
+    print("latency_p99_ms {:.3f}".format(percentile(latencies, 0.99) * 1000))
+    print("latency_max_ms {:.3f}".format(max(latencies) * 1000))
+    for action, count in sorted(outcomes.items()):
+        print("responses{{{}}} {}".format(action, count))
+    print("greylist_growth {}".format(after[0] - before[0]))
+    print("whitelist_growth {}".format(after[1] - before[1]))
+    print("db_size_growth {}".format(after[2] - before[2]))
+
+def write_config(config_file, path, db_file):
+    """
+    Write the config file at *config_file* (if any) to *path*, with
+    ``db_file`` replaced by *db_file*.
+    """
+    config = configparser.ConfigParser()
+    if config_file is not None:
+        with config_file as f:
+            config.read_file(f)
+    config["DEFAULT"]["db_file"] = db_file
+    with open(path, "w") as f:
+        config.write(f)
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(
+        description="""Measure the throughput and latency of greylist.py on
+        synthesized or recorded policy requests. Unless --db-file is given, a
+        fresh temporary database is used."""
+    )
+    parser.add_argument(
+        "-c", "--config",
+        default=None,
+        type=argparse.FileType("r"),
+        metavar="FILE",
+        help="Specify a config file to override defaults")
+    parser.add_argument(
+        "-v",
+        dest="verbosity",
+        action="count",
+        default=0,
+        help="Increase verbosity by one step")
+    parser.add_argument(
+        "-m", "--mode",
+        choices=("inprocess", "stdin", "socket", "parse"),
+        default="inprocess",
+        help="Call into greylist.py directly (default), feed the requests to"
+        " a greylist.py process on stdin, send them to a greylist.py daemon"
+        " or only compare the speed of the request parsers")
+    parser.add_argument(
+        "-n", "--requests",
+        type=int,
+        default=10000,
+        metavar="COUNT",
+        help="Number of requests to synthesize (default: 10000)")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        metavar="KIND=WEIGHT,...",
+        help="Relative weights of the request kinds whitelisted, new,"
+        " retry_early, retry_late and burst")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the random traffic generator")
+    parser.add_argument(
+        "--replay",
+        type=argparse.FileType("r"),
+        default=None,
+        metavar="FILE",
+        help="Replay the policy requests recorded in FILE instead of"
+        " synthesizing traffic")
+    parser.add_argument(
+        "--virtual-interval",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="With --mode=inprocess, let SECONDS of simulated time pass"
+        " between requests instead of running in real time, e.g. to observe"
+        " expiry over days of traffic")
+    parser.add_argument(
+        "--db-file",
+        default=None,
+        metavar="PATH",
+        help="Use (and keep) the database at PATH")
+    parser.add_argument(
+        "--connect",
+        type=greylist.parse_listen_address,
+        default=None,
+        metavar="ADDRESS",
+        help="With --mode=socket, use the daemon already listening on ADDRESS"
+        " instead of starting one. With the sqlite storage, --db-file has to"
+        " name the database of that daemon")
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        metavar="COUNT",
+        help="With --mode=socket, number of concurrent connections")
+
+    args = parser.parse_args()
+
+    verbosity = {
+        0: logging.ERROR,
+        1: logging.WARN,
+        2: logging.INFO,
+        3: logging.DEBUG
+    }
+
+    logging.basicConfig(
+        level=verbosity.get(args.verbosity, logging.DEBUG),
+        stream=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = os.path.join(tmpdir, "config.ini")
+        write_config(args.config, config_file,
+                     args.db_file or os.path.join(tmpdir, "greylist.db"))
+        with open(config_file) as f:
+            greylist.load_config(f)
+        # the requests are seeded and the growth is measured in the storage of
+        # the daemon, which has to be reachable from here
+        if args.connect is not None:
+            if greylist.storage == "memory":
+                parser.error("--connect does not work with the memory storage")
+            if greylist.storage == "sqlite" and args.db_file is None:
+                parser.error("--connect needs the database of the daemon"
+                             " as --db-file")
+        if args.virtual_interval is not None:
+            if args.mode != "inprocess":
+                parser.error("--virtual-interval needs --mode=inprocess")
+            greylist.clock = greylist.VirtualClock()
+
+        if args.replay is not None:
+            requests = read_requests(args.replay)
+        else:
+            requests, whitelisted, greylisted = generate_requests(
+                args.requests, args.mix, random.Random(args.seed))
+            seed_db(whitelisted, greylisted, greylist.clock.time())
+        if args.mode == "parse":
+            repeat = 10
+            read_request_seconds, parser_seconds = run_parse(requests, repeat)
+            count = len(requests) * repeat
+            print("mode parse")
+            print("requests {}".format(count))
+            print("read_request_per_second {:.1f}".format(
+                count / read_request_seconds))
+            print("parser_per_second {:.1f}".format(count / parser_seconds))
+            print("speedup {:.2f}".format(read_request_seconds / parser_seconds))
+            sys.exit(0)
+        before = db_state()
+
+        started = time.perf_counter()
+        if args.mode == "inprocess":
+            latencies, responses = run_inprocess(requests,
+                                                 args.virtual_interval)
+        elif args.mode == "stdin":
+            latencies, responses = run_stdin(requests, config_file)
+        elif args.connect is not None:
+            latencies, responses = run_socket(requests, args.connect,
+                                              args.connections)
+        else:
+            address = os.path.join(tmpdir, "greylist.sock")
+            daemon = start_daemon(config_file, address)
+            started = time.perf_counter()
+            try:
+                latencies, responses = run_socket(
+                    requests, ("unix", address), args.connections)
+            finally:
+                # lets the daemon close the database cleanly
+                daemon.send_signal(signal.SIGINT)
+                daemon.wait()
+        duration = time.perf_counter() - started
+
+        report(args.mode, latencies, responses, duration, before, db_state())
@@ -1,16 +1,42 @@
 #!/usr/bin/python3
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import hashlib
+import heapq
+import ipaddress
+import itertools
+import json
 import logging
+import os
+import re
+import selectors
+import signal
+import socket
 import sqlite3
-
-from datetime import datetime, timedelta
+import stat
+import threading
+import time
 
 # CONFIGURATION
 
 # See README.md for more details. Use a config file whenever possible instead of
 # changing the source code here, to make your own life easier on updates.
 
+storage = "sqlite"
 db_file = "greylist.db"
+memory_snapshot_file = None
+memory_log_file = None
+memory_snapshot_interval = 300
+redis_host = "127.0.0.1"
+redis_port = 6379
+redis_db = 0
+redis_prefix = "greylist:"
+redis_pool_size = 4
+redis_timeout = 1.0
 auto_whitelist_threshold = 10
 greylist_timeout = 60
 max_greylist_entries = 100000
@@ -24,6 +50,36 @@ stats_active_threshold = 3600
 stats_dead_threshold = 86400
 move_to_whitelist = True
 whitelist_prefixes = []
+whitelist_prefixes_file = None
+use_client_address = False
+client_ipv4_prefix = None
+client_ipv6_prefix = None
+normalize_senders = False
+gc_interval_requests = 1
+gc_interval = None
+gc_background = False
+gc_chunk_size = None
+gc_time_budget = None
+gc_low_water = None
+sqlite_journal_mode = None
+sqlite_synchronous = None
+sqlite_busy_timeout = 5000
+sqlite_cache_size = None
+sqlite_mmap_size = None
+sqlite_compact_keys = False
+sqlite_store_keys = True
+sqlite_shards = None
+write_retries = 3
+write_retry_backoff = 0.05
+whitelist_cache_size = None
+whitelist_cache_ttl = 300
+write_behind_interval = 5
+greylist_cache_size = None
+commit_batch_size = 1
+commit_batch_interval = 10
+commit_before_response = True
+metrics_listen = None
+workers = 1
 
 # END OF CONFIGURATION
 
@@ -47,7 +103,7 @@ SCHEMA[("table", "whitelist")] = """CREATE TABLE whitelist
    (
       id INTEGER PRIMARY KEY,
       client_name TEXT,
-      last_seen TIMESTAMP,
+      last_seen INTEGER,
       hit_count INTEGER,
       CONSTRAINT client_name UNIQUE (client_name)
    )"""
@@ -57,63 +113,885 @@ SCHEMA[("table", "greylist")] = """CREATE TABLE greylist
       client_name TEXT,
       sender TEXT,
       recipient TEXT,
-      first_seen TIMESTAMP,
-      last_seen TIMESTAMP,
+      first_seen INTEGER,
+      last_seen INTEGER,
       CONSTRAINT match UNIQUE (client_name, sender, recipient)
   )"""
-SCHEMA[("index", "whitelist_last_seen")] = """CREATE INDEX whitelist_last_seen ON greylist (last_seen)"""
+SCHEMA[("index", "whitelist_last_seen")] = """CREATE INDEX whitelist_last_seen ON whitelist
+(last_seen)"""
 SCHEMA[("index", "greylist_last_seen")] = """CREATE INDEX greylist_last_seen ON greylist
 (last_seen)"""
+# used for the per-client_name purge in gc_db
+SCHEMA[("index", "greylist_client_name_last_seen")] = """CREATE INDEX greylist_client_name_last_seen ON greylist
+(client_name, last_seen)"""
+# the counters are maintained by the triggers below, so that the size limits
+# can be checked without counting the rows of the lists
+SCHEMA[("table", "counters")] = """CREATE TABLE counters
+   (
+      name TEXT PRIMARY KEY,
+      value INTEGER
+   )"""
+SCHEMA[("table", "greylist_client_counts")] = """CREATE TABLE greylist_client_counts
+   (
+      client_name TEXT PRIMARY KEY,
+      count INTEGER
+   )"""
+SCHEMA[("index", "greylist_client_counts_count")] = """CREATE INDEX greylist_client_counts_count ON greylist_client_counts
+(count)"""
+SCHEMA[("trigger", "greylist_insert")] = """CREATE TRIGGER greylist_insert AFTER INSERT ON greylist
+BEGIN
+   UPDATE counters SET value = value + 1 WHERE name = 'greylist';
+   INSERT OR IGNORE INTO greylist_client_counts (client_name, count)
+      VALUES (new.client_name, 0);
+   UPDATE greylist_client_counts SET count = count + 1
+      WHERE client_name = new.client_name;
+END"""
+SCHEMA[("trigger", "greylist_delete")] = """CREATE TRIGGER greylist_delete AFTER DELETE ON greylist
+BEGIN
+   UPDATE counters SET value = value - 1 WHERE name = 'greylist';
+   UPDATE greylist_client_counts SET count = count - 1
+      WHERE client_name = old.client_name;
+   DELETE FROM greylist_client_counts
+      WHERE client_name = old.client_name AND count <= 0;
+END"""
+SCHEMA[("trigger", "whitelist_insert")] = """CREATE TRIGGER whitelist_insert AFTER INSERT ON whitelist
+BEGIN
+   UPDATE counters SET value = value + 1 WHERE name = 'whitelist';
+END"""
+SCHEMA[("trigger", "whitelist_delete")] = """CREATE TRIGGER whitelist_delete AFTER DELETE ON whitelist
+BEGIN
+   UPDATE counters SET value = value - 1 WHERE name = 'whitelist';
+END"""
+
+# with sqlite_compact_keys, greylist entries are identified by a 64-bit hash of
+# their greylisting key (see key_hash()) and of their client_name, which keeps
+# rows and indices small; the keys themselves are optionally kept aside in
+# greylist_keys
+COMPACT_SCHEMA = dict(SCHEMA)
+COMPACT_SCHEMA[("table", "greylist")] = """CREATE TABLE greylist
+   (
+      id INTEGER PRIMARY KEY,
+      client_id INTEGER,
+      first_seen INTEGER,
+      last_seen INTEGER
+   )"""
+COMPACT_SCHEMA[("table", "greylist_keys")] = """CREATE TABLE greylist_keys
+   (
+      id INTEGER PRIMARY KEY,
+      client_name TEXT,
+      sender TEXT,
+      recipient TEXT
+   )"""
+del COMPACT_SCHEMA[("index", "greylist_client_name_last_seen")]
+COMPACT_SCHEMA[("index", "greylist_client_id_last_seen")] = """CREATE INDEX greylist_client_id_last_seen ON greylist
+(client_id, last_seen)"""
+COMPACT_SCHEMA[("table", "greylist_client_counts")] = """CREATE TABLE greylist_client_counts
+   (
+      client_id INTEGER PRIMARY KEY,
+      count INTEGER
+   )"""
+COMPACT_SCHEMA[("trigger", "greylist_insert")] = """CREATE TRIGGER greylist_insert AFTER INSERT ON greylist
+BEGIN
+   UPDATE counters SET value = value + 1 WHERE name = 'greylist';
+   INSERT OR IGNORE INTO greylist_client_counts (client_id, count)
+      VALUES (new.client_id, 0);
+   UPDATE greylist_client_counts SET count = count + 1
+      WHERE client_id = new.client_id;
+END"""
+COMPACT_SCHEMA[("trigger", "greylist_delete")] = """CREATE TRIGGER greylist_delete AFTER DELETE ON greylist
+BEGIN
+   UPDATE counters SET value = value - 1 WHERE name = 'greylist';
+   UPDATE greylist_client_counts SET count = count - 1
+      WHERE client_id = old.client_id;
+   DELETE FROM greylist_client_counts
+      WHERE client_id = old.client_id AND count <= 0;
+   DELETE FROM greylist_keys WHERE id = old.id;
+END"""
+
+# previous versions stored the timestamps as TEXT; tables with that schema are
+# migrated in place to epoch seconds, see migrate_timestamps()
+LEGACY_SCHEMA = {}
+LEGACY_SCHEMA[("table", "whitelist")] = """CREATE TABLE whitelist
+   (
+      id INTEGER PRIMARY KEY,
+      client_name TEXT,
+      last_seen TIMESTAMP,
+      hit_count INTEGER,
+      CONSTRAINT client_name UNIQUE (client_name)
+   )"""
+LEGACY_SCHEMA[("table", "greylist")] = """CREATE TABLE greylist
+   (
+      id INTEGER PRIMARY KEY,
+      client_name TEXT,
+      sender TEXT,
+      recipient TEXT,
+      first_seen TIMESTAMP,
+      last_seen TIMESTAMP,
+      CONSTRAINT match UNIQUE (client_name, sender, recipient)
+  )"""
+
+TIMESTAMP_COLUMNS = {
+    "whitelist": ("last_seen",),
+    "greylist": ("first_seen", "last_seen"),
+}
+
+# order in which schema objects are created
+SCHEMA_TYPES = ("table", "index", "trigger")
+
+# the version of the schema recorded in PRAGMA user_version, see setup_db();
+# COMPACT_KEYS_FLAG is added for the COMPACT_SCHEMA. Increase SCHEMA_VERSION
+# with every change to the schemas and add a migration to MIGRATIONS.
+SCHEMA_VERSION = 1
+COMPACT_KEYS_FLAG = 1 << 16
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"}
+
+# UPDATE/INSERT ... RETURNING saves a SELECT per request where available
+HAVE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    A latency histogram in the style of Prometheus.
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # the last one counts the observations above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """
+        Observe the time it takes to run the ``with`` block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def format(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                self.name, bound, cumulative))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+class Clock:
+    """
+    Source of the current time for all time-dependent decisions. Durations
+    which are only measured, e.g. for logging, use :mod:`time` directly.
+    """
+
+    def time(self):
+        """
+        Return the current time in integer epoch seconds.
+        """
+        return int(time.time())
+
+    def monotonic(self):
+        """
+        Return the value of a monotonic clock in seconds.
+        """
+        return time.monotonic()
+
+class CachedClock(Clock):
+    """
+    Reads the time only once per iteration of the event loop *loop*, as all
+    requests handled in one iteration may as well share their timestamp.
+
+    It may also be read from other threads, like the database thread of the
+    daemon (see :func:`run_db`).
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._thread = threading.get_ident()
+        self._now = None
+
+    def _read(self):
+        now = self._now
+        if now is None:
+            now = self._now = int(time.time()), time.monotonic()
+            if threading.get_ident() == self._thread:
+                self.loop.call_soon(self._expire)
+            else:
+                try:
+                    self.loop.call_soon_threadsafe(self._expire)
+                except RuntimeError:
+                    # the event loop has been closed, e.g. while the daemon
+                    # shuts down, so do not cache at all
+                    self._now = None
+        return now
+
+    def _expire(self):
+        self._now = None
+
+    def time(self):
+        return self._read()[0]
+
+    def monotonic(self):
+        return self._read()[1]
+
+class VirtualClock(Clock):
+    """
+    A clock which only moves when told to, starting at epoch second *start*
+    (the current time by default). Installed as :data:`clock`, it allows to
+    simulate long periods of traffic without waiting.
+    """
+
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return int(self.now)
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+clock = Clock()
 
 _dbconn = None
+# shard index -> connection, see get_shard_db()
+_shard_dbconns = {}
+_backend = None
+# see get_static_whitelist()
+_static_whitelist = None
+_gc_requests = 0
+_gc_last_run = None
+# cumulative outcome of the garbage collection passes, see gc_steps()
+_gc_progress = collections.Counter()
+# client_name -> monotonic time at which the entry has to be re-checked
+_whitelist_cache = collections.OrderedDict()
+# client_name -> [hits, last_seen] not yet written to the database
+_pending_whitelist_hits = {}
+# (client_name, sender, recipient) -> first_seen of deferred greylist entries
+_greylist_cache = collections.OrderedDict()
+# client_name -> its keys in _greylist_cache
+_greylist_cache_clients = {}
+# (client_name, sender, recipient) -> last_seen not yet written to the database
+_pending_greylist_touches = {}
+_last_flush = clock.monotonic()
+# request outcome -> count, see respond()
+_request_outcomes = collections.Counter()
+_histograms = {
+    "whitelist_check": Histogram(
+        "greylist_whitelist_check_seconds",
+        "Time spent looking up and updating the whitelist entry"),
+    "greylist_check": Histogram(
+        "greylist_greylist_check_seconds",
+        "Time spent looking up and updating the greylist entry"),
+    "commit": Histogram(
+        "greylist_commit_seconds",
+        "Time spent committing database transactions"),
+    "lock_wait": Histogram(
+        "greylist_lock_wait_seconds",
+        "Time spent waiting for the database write lock"),
+    "gc": Histogram(
+        "greylist_gc_seconds",
+        "Time spent deleting entries per garbage collection run"),
+}
+# state of the group commit, see run_batched()
+_batch_size = 0
+_batch_started = None
+_batch_waiters = []
+_batch_timer = None
+_batch_commits = set()
+# thread running the database work of the daemon, see run_db()
+_db_executor = None
+
+# SRS0=hash=tt=domain=local@forwarder, SRS1=hash=forwarder==hash=tt=...
+SRS_RE = re.compile(r"^srs(?:0|1[=+-][^=]*=[^=]*=)[=+-][^=]*=[^=]*=([^=]*)=(.*)$",
+                    re.IGNORECASE)
+# prvs=tag=local, btv1==tag==local
+BATV_RE = re.compile(r"^(?:(?:ms)?prvs=[^=]*|btv1==[^=]*=)=(.*)$",
+                     re.IGNORECASE)
+DIGITS_RE = re.compile(r"[0-9]+")
+
+def group_address(address):
+    """
+    Return the network of ``client_ipv4_prefix`` or ``client_ipv6_prefix``
+    bits containing *address*, e.g. ``192.0.2.0/24``, or *address* itself if
+    it is not grouped.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    prefix = client_ipv4_prefix if ip.version == 4 else client_ipv6_prefix
+    if prefix is None:
+        return address
+    return str(ipaddress.ip_network((ip, prefix), strict=False))
+
+def normalize_sender(sender):
+    """
+    Strip the parts of *sender* which change from message to message: SRS and
+    BATV rewriting, ``+`` extensions and numbers (as used by VERP) in the
+    local part.
+    """
+    local, at, domain = sender.rpartition("@")
+    if not at:
+        return sender
+    match = SRS_RE.match(local)
+    if match is not None:
+        domain, local = match.groups()
+    match = BATV_RE.match(local)
+    if match is not None:
+        local, = match.groups()
+    local = DIGITS_RE.sub("#", local.partition("+")[0])
+    return "{}@{}".format(local, domain.lower())
 
 def clean_request(attrs):
     try:
         client_name = attrs["client_name"]
-        if client_name == "unknown":
+        if client_name == "unknown" or use_client_address:
             del attrs["client_name"]
     except KeyError:
         pass
-    attrs.setdefault("client_name", attrs["client_address"])
+    client_address = attrs["client_address"]
+    if "client_name" not in attrs:
+        attrs["client_name"] = group_address(client_address)
     # make sure that critical attributes are in place
     attrs["sender"]
     attrs["recipient"]
+    if normalize_senders:
+        attrs["sender"] = normalize_sender(attrs["sender"])
+
+def configure_db(dbconn):
+    """
+    Apply the ``sqlite_*`` tuning options to a freshly opened connection.
+    """
+    # pragma values cannot be bound as parameters, so they are validated here
+    if sqlite_journal_mode is not None:
+        if sqlite_journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("Invalid journal mode: {}".format(
+                sqlite_journal_mode))
+        mode, = dbconn.execute("PRAGMA journal_mode={}".format(
+            sqlite_journal_mode)).fetchone()
+        logger.debug("journal mode is %s", mode)
+    if sqlite_synchronous is not None:
+        if sqlite_synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid synchronous mode: {}".format(
+                sqlite_synchronous))
+        dbconn.execute("PRAGMA synchronous={}".format(sqlite_synchronous))
+    if sqlite_cache_size is not None:
+        dbconn.execute("PRAGMA cache_size={:d}".format(sqlite_cache_size))
+    if sqlite_mmap_size is not None:
+        dbconn.execute("PRAGMA mmap_size={:d}".format(sqlite_mmap_size))
+
+def get_schema():
+    """
+    Return the schema selected by ``sqlite_compact_keys``.
+    """
+    return COMPACT_SCHEMA if sqlite_compact_keys else SCHEMA
+
+def key_hash(*parts):
+    """
+    Return a signed 64-bit hash of the strings *parts*, suitable as an SQLite
+    integer key.
+    """
+    digest = hashlib.blake2b(
+        "\0".join(parts).encode("utf-8", errors="surrogateescape"),
+        digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def upgrade_db(dbconn):
+    """
+    Create the schema objects which are missing in the database and replace
+    outdated indices and triggers, leaving all existing data intact. Tables
+    which are not part of the schema are left alone. Return :data:`False` if
+    a table of the schema has a different definition, which cannot be
+    upgraded in place.
+    """
+    migrated = migrate_timestamps(dbconn)
+    migrated = migrate_keys(dbconn) or migrated
+    schema = get_schema()
+    existing = _read_schema(dbconn)
+    for key, sql in list(existing.items()):
+        type_, name = key
+        if same_sql(schema.get(key), sql):
+            continue
+        if type_ == "table":
+            if key not in schema:
+                logger.info("ignoring unknown table %s", name)
+                continue
+            logger.error("table %s differs from the schema: %r", name, sql)
+            return False
+        table, = dbconn.execute("""SELECT tbl_name FROM sqlite_master
+        WHERE type = ? AND name = ?""", (type_, name)).fetchone()
+        if key not in schema and ("table", table) not in schema:
+            # belongs to an unknown table
+            continue
+        logger.info("dropping outdated %s %s", type_, name)
+        dbconn.execute("DROP {} {}".format(type_.upper(), name))
+        del existing[key]
+
+    for type_ in SCHEMA_TYPES:
+        missing = ((name, sql)
+                   for (other_type, name), sql in schema.items()
+                   if other_type == type_ and (type_, name) not in existing)
+        for name, sql in missing:
+            logger.info("creating missing %s %s", type_, name)
+            dbconn.execute(sql)
 
-def create_db(dbconn):
-    logger.info("(re-)creating database")
-    tables = ((table, sql)
-              for (type_, table), sql in SCHEMA.items()
-              if type_ == "table")
-    for table, sql in tables:
-        logger.info("creating table %s", table)
-        dbconn.execute("DROP TABLE IF EXISTS {}".format(table))
-        dbconn.execute(sql)
-        logger.info("created table %s", table)
-
-    indicies = ((index, sql)
-                for (type_, index), sql in SCHEMA.items()
-                if type_ == "index")
-    for index, sql in indicies:
-        logger.info("creating index %s", index)
-        dbconn.execute(sql)
-        logger.info("created index %s", index)
+    if migrated or ("table", "counters") not in existing:
+        recount_db(dbconn)
+    return True
+
+def migrate_timestamps(dbconn):
+    """
+    Convert tables still using the TEXT timestamp schema from
+    :data:`LEGACY_SCHEMA` to integer epoch seconds, keeping their contents.
+    Return whether any table was migrated.
+    """
+    existing = _read_schema(dbconn)
+    tables = [table
+              for (type_, table), sql in LEGACY_SCHEMA.items()
+              if same_sql(existing.get((type_, table)), sql)]
+    if not tables:
+        return False
+
+    dbconn.execute("BEGIN")
+    try:
+        for table in tables:
+            logger.info("migrating timestamps of %s to epoch seconds", table)
+            columns = [name
+                       for _, name, *_ in dbconn.execute(
+                           "PRAGMA table_info({})".format(table))]
+            values = [
+                "CAST(strftime('%s', {0}) AS INTEGER)".format(column)
+                if column in TIMESTAMP_COLUMNS[table] else column
+                for column in columns
+            ]
+            # indices and triggers of the old table are dropped with it and
+            # re-created by upgrade_db()
+            dbconn.execute("ALTER TABLE {0} RENAME TO {0}_legacy".format(
+                table))
+            dbconn.execute(SCHEMA[("table", table)])
+            dbconn.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {0}_legacy".format(
+                table, ", ".join(columns), ", ".join(values)))
+            dbconn.execute("DROP TABLE {}_legacy".format(table))
+    except:
+        dbconn.rollback()
+        raise
+    dbconn.commit()
+    return True
+
+def migrate_keys(dbconn):
+    """
+    Convert the greylist between the full and the compact schema, whichever
+    is not selected by ``sqlite_compact_keys``, keeping its entries. Entries
+    whose keys were not stored are dropped when converting back to the full
+    schema. Return whether the greylist was migrated.
+    """
+    schema = get_schema()
+    other = SCHEMA if schema is COMPACT_SCHEMA else COMPACT_SCHEMA
+    existing = _read_schema(dbconn)
+    if not same_sql(existing.get(("table", "greylist")),
+                    other[("table", "greylist")]):
+        return False
+
+    dbconn.create_function("key_hash", -1, key_hash, deterministic=True)
+    dbconn.execute("BEGIN")
+    try:
+        logger.info("migrating greylist to the %s schema",
+                    "compact" if sqlite_compact_keys else "full")
+        # the other tables only differ in their keys and are re-created (and
+        # recounted) by upgrade_db()
+        for name in ("greylist_client_counts", "greylist_keys"):
+            if ("table", name) in existing:
+                dbconn.execute("ALTER TABLE {0} RENAME TO {0}_legacy".format(
+                    name))
+        dbconn.execute("ALTER TABLE greylist RENAME TO greylist_legacy")
+        dbconn.execute(schema[("table", "greylist")])
+        if sqlite_compact_keys:
+            dbconn.execute("""INSERT OR IGNORE INTO greylist
+            (id, client_id, first_seen, last_seen)
+            SELECT key_hash(client_name, sender, recipient),
+                   key_hash(client_name), first_seen, last_seen
+            FROM greylist_legacy""")
+            dbconn.execute(schema[("table", "greylist_keys")])
+            if sqlite_store_keys:
+                dbconn.execute("""INSERT OR IGNORE INTO greylist_keys
+                (id, client_name, sender, recipient)
+                SELECT key_hash(client_name, sender, recipient),
+                       client_name, sender, recipient
+                FROM greylist_legacy""")
+        else:
+            dbconn.execute("""INSERT INTO greylist
+            (client_name, sender, recipient, first_seen, last_seen)
+            SELECT client_name, sender, recipient, first_seen, last_seen
+            FROM greylist_legacy JOIN greylist_keys_legacy USING (id)""")
+        for name in ("greylist", "greylist_client_counts", "greylist_keys"):
+            dbconn.execute("DROP TABLE IF EXISTS {}_legacy".format(name))
+    except:
+        dbconn.rollback()
+        raise
+    dbconn.commit()
+    return True
+
+def recount_db(dbconn):
+    """
+    Recompute the entry counters from the actual contents of the lists.
+    """
+    logger.info("recounting list entries")
+    dbconn.execute("DELETE FROM counters")
+    dbconn.execute("""INSERT INTO counters (name, value)
+    SELECT 'greylist', COUNT(*) FROM greylist""")
+    dbconn.execute("""INSERT INTO counters (name, value)
+    SELECT 'whitelist', COUNT(*) FROM whitelist""")
+    dbconn.execute("DELETE FROM greylist_client_counts")
+    column = "client_id" if sqlite_compact_keys else "client_name"
+    dbconn.execute("""INSERT INTO greylist_client_counts ({0}, count)
+    SELECT {0}, COUNT(*) FROM greylist GROUP BY {0}""".format(column))
+    dbconn.commit()
+
+def get_count(cursor, listtype):
+    """
+    Return the number of entries in the list *listtype* (``"greylist"`` or
+    ``"whitelist"``) from the maintained counters.
+    """
+    cursor.execute("SELECT value FROM counters WHERE name=?", (listtype,))
+    count, = cursor.fetchone()
+    return count
 
 def close_db():
-    global _dbconn
-    if _dbconn is None:
+    global _dbconn, _backend, _batch_timer
+    if _backend is not None:
+        try:
+            flush_db()
+        except (OSError, RedisError) as err:
+            logger.error("Dropping coalesced updates: %s", err)
+        _backend.close()
+        _backend = None
+    if _batch_timer is not None:
+        _batch_timer.cancel()
+        _batch_timer = None
+    if _dbconn is None and not _shard_dbconns:
         return
-    _dbconn.close()
-    _dbconn = None
+    commit_batch()
+    if _dbconn is not None:
+        _dbconn.close()
+        _dbconn = None
+    for dbconn in _shard_dbconns.values():
+        dbconn.close()
+    _shard_dbconns.clear()
+
+def open_db(path):
+    logger.debug("opening database at %s", path)
+    timeout = (sqlite_busy_timeout or 0) / 1000
+    # the daemon uses the connection on its database thread, see run_db()
+    dbconn = sqlite3.connect(path,
+                             timeout=timeout,
+                             detect_types=sqlite3.PARSE_DECLTYPES,
+                             check_same_thread=False)
+    configure_db(dbconn)
+    setup_db(dbconn)
+    return dbconn
 
 def get_db():
     global _dbconn
     if _dbconn is None:
-        logger.debug("opening database at %s", db_file)
-        _dbconn = sqlite3.connect(db_file,
-                                  detect_types=sqlite3.PARSE_DECLTYPES)
-        setup_db(_dbconn)
+        _dbconn = open_db(db_file)
     return _dbconn
 
+def shard_file(index):
+    """
+    Return the path of the database file of shard *index*.
+    """
+    if db_file == ":memory:":
+        return db_file
+    return "{}.{}".format(db_file, index)
+
+def get_shard_db(index):
+    """
+    Return the connection to the database of shard *index*, see
+    ``sqlite_shards``.
+    """
+    try:
+        return _shard_dbconns[index]
+    except KeyError:
+        dbconn = _shard_dbconns[index] = open_db(shard_file(index))
+        return dbconn
+
+def db_files():
+    """
+    Return the paths of all database files: those of the shards if
+    ``sqlite_shards`` is set, ``db_file`` otherwise.
+    """
+    if sqlite_shards:
+        return [shard_file(index) for index in range(sqlite_shards)]
+    return [db_file]
+
+def get_dbs():
+    """
+    Return the connections to all databases, in the order of
+    :func:`db_files`.
+    """
+    if sqlite_shards:
+        return [get_shard_db(index) for index in range(sqlite_shards)]
+    return [get_db()]
+
+def run_transaction(dbconn, func, *args):
+    """
+    Call ``func(cursor, *args)`` in a ``BEGIN IMMEDIATE`` transaction on
+    *dbconn*, commit it and return the result of *func*.
+
+    If the database is locked by another connection for longer than
+    ``sqlite_busy_timeout``, the transaction is retried up to ``write_retries``
+    times with exponential backoff.
+    """
+    cursor = dbconn.cursor()
+    try:
+        attempt = 0
+        while True:
+            try:
+                with _histograms["lock_wait"].time():
+                    cursor.execute("BEGIN IMMEDIATE")
+                result = func(cursor, *args)
+                with _histograms["commit"].time():
+                    dbconn.commit()
+                return result
+            except sqlite3.OperationalError as err:
+                if dbconn.in_transaction:
+                    dbconn.rollback()
+                if not is_busy_error(err) or attempt >= write_retries:
+                    raise
+                delay = write_retry_backoff * 2**attempt
+                attempt += 1
+                logger.warning("%s, retrying in %.3fs", err, delay)
+                time.sleep(delay)
+            except:
+                if dbconn.in_transaction:
+                    dbconn.rollback()
+                raise
+    finally:
+        cursor.close()
+
+def batching():
+    """
+    Return whether request writes are collected in batches instead of being
+    committed by :func:`process_request` itself.
+    """
+    return commit_batch_size > 1 or not commit_before_response
+
+def run_batched(dbconn, func, *args):
+    """
+    Like :func:`run_transaction`, but leave the transaction open, so that the
+    writes of many requests are committed together by :func:`commit_batch`.
+
+    If *func* fails, only its own writes are rolled back.
+    """
+    global _batch_size, _batch_started
+    cursor = dbconn.cursor()
+    try:
+        attempt = 0
+        while not dbconn.in_transaction:
+            try:
+                with _histograms["lock_wait"].time():
+                    cursor.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as err:
+                if not is_busy_error(err) or attempt >= write_retries:
+                    raise
+                delay = write_retry_backoff * 2**attempt
+                attempt += 1
+                logger.warning("%s, retrying in %.3fs", err, delay)
+                time.sleep(delay)
+            else:
+                # with sqlite_shards, a batch may span several connections
+                if not _batch_size:
+                    _batch_started = time.monotonic()
+
+        cursor.execute("SAVEPOINT request")
+        try:
+            result = func(cursor, *args)
+        except:
+            cursor.execute("ROLLBACK TO request")
+            cursor.execute("RELEASE request")
+            raise
+        cursor.execute("RELEASE request")
+        _batch_size += 1
+        return result
+    finally:
+        cursor.close()
+
+def batch_due():
+    """
+    Return whether the open batch has reached ``commit_batch_size`` requests
+    or is older than ``commit_batch_interval`` milliseconds.
+    """
+    if not _batch_size:
+        return False
+    return (_batch_size >= commit_batch_size
+            or time.monotonic() - _batch_started >= commit_batch_interval / 1000)
+
+def commit_batch():
+    """
+    Commit the open batch of request writes, if any.
+    """
+    global _batch_size
+    dbconns = [dbconn
+               for dbconn in [_dbconn, *_shard_dbconns.values()]
+               if dbconn is not None and dbconn.in_transaction]
+    try:
+        if dbconns:
+            logger.debug("committing batch of %d requests", _batch_size)
+        for dbconn in dbconns:
+            attempt = 0
+            while True:
+                try:
+                    with _histograms["commit"].time():
+                        dbconn.commit()
+                    break
+                except sqlite3.OperationalError as err:
+                    # a failed COMMIT leaves the transaction open
+                    if not is_busy_error(err) or attempt >= write_retries:
+                        raise
+                    delay = write_retry_backoff * 2**attempt
+                    attempt += 1
+                    logger.warning("%s, retrying in %.3fs", err, delay)
+                    time.sleep(delay)
+    except:
+        for dbconn in dbconns:
+            if dbconn.in_transaction:
+                dbconn.rollback()
+        raise
+    finally:
+        _batch_size = 0
+
+async def finish_batch():
+    """
+    Run :func:`commit_batch` on the database thread and wake up everyone
+    waiting for it in :func:`group_commit`.
+    """
+    global _batch_timer
+    if _batch_timer is not None:
+        _batch_timer.cancel()
+        _batch_timer = None
+    waiters = list(_batch_waiters)
+    _batch_waiters.clear()
+    try:
+        await run_db(commit_batch)
+    except Exception as err:
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(err)
+        raise
+    else:
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+async def _commit_timed_batch():
+    try:
+        await finish_batch()
+    except sqlite3.Error as err:
+        logger.error("committing batch failed: %s", err)
+
+def _commit_batch_timer():
+    global _batch_timer
+    _batch_timer = None
+    task = asyncio.ensure_future(_commit_timed_batch())
+    # keep a reference until the commit is done
+    _batch_commits.add(task)
+    task.add_done_callback(_batch_commits.discard)
+
+async def group_commit(response):
+    """
+    Make sure the open batch gets committed in time. If
+    ``commit_before_response`` is set, wait for that commit and return
+    *response*, or the pass response if the commit failed.
+    """
+    global _batch_timer
+    if not batching() or not _batch_size:
+        return response
+    if batch_due():
+        try:
+            await finish_batch()
+        except sqlite3.Error as err:
+            logger.error("Committing request failed: %s", err)
+            logger.warning("Returning PASS action")
+            return response_pass
+        return response
+
+    loop = asyncio.get_running_loop()
+    if _batch_timer is None:
+        remaining = (_batch_started + commit_batch_interval / 1000
+                     - time.monotonic())
+        _batch_timer = loop.call_later(max(remaining, 0), _commit_batch_timer)
+    if not commit_before_response:
+        return response
+
+    waiter = loop.create_future()
+    _batch_waiters.append(waiter)
+    try:
+        await waiter
+    except sqlite3.Error as err:
+        logger.error("Committing request failed: %s", err)
+        logger.warning("Returning PASS action")
+        return response_pass
+    return response
+
+def get_db_executor():
+    """
+    Return the executor of the database thread, see :func:`run_db`.
+    """
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="greylist-db")
+    return _db_executor
+
+def stop_db_executor():
+    """
+    Wait for the database thread to finish its work and stop it.
+    """
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown()
+        _db_executor = None
+
+async def run_db(func, *args):
+    """
+    Call ``func(*args)`` on the database thread and return its result.
+
+    The daemon does all work on the storage backend there, one call at a time,
+    so that waiting for a locked database (``sqlite_busy_timeout``,
+    ``write_retries``) or a slow backend does not stall the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), func, *args)
+
+def is_busy_error(err):
+    """
+    Return whether *err* signals that the database is locked by another
+    connection, i.e. whether the failed operation may be retried.
+    """
+    return (isinstance(err, sqlite3.OperationalError)
+            and ("locked" in str(err) or "busy" in str(err)))
+
 def getint_or_none(config, section, option, fallback):
     try:
         v = config.get(section, option).lower()
@@ -123,6 +1001,24 @@ def getint_or_none(config, section, option, fallback):
         return None
     return int(v)
 
+def getfloat_or_none(config, section, option, fallback):
+    try:
+        v = config.get(section, option).lower()
+    except configparser.NoOptionError:
+        return fallback
+    if v in {"none", "off", "disabled"}:
+        return None
+    return float(v)
+
+def getstr_or_none(config, section, option, fallback):
+    try:
+        v = config.get(section, option)
+    except configparser.NoOptionError:
+        return fallback
+    if v.lower() in {"none", "off", "disabled"}:
+        return None
+    return v
+
 def getresponse(config, section, option, fallback):
     try:
         v = config.get(section, option).upper()
@@ -137,100 +1033,283 @@ def getresponse(config, section, option, fallback):
     except ValueError:
         raise ValueError("Invalid response type: {}".format(v))
 
+def flush_db():
+    """
+    Write the coalesced whitelist hits of cached clients and the ``last_seen``
+    updates of cached greylist entries to the storage backend.
+    """
+    global _last_flush
+    commit_batch()
+    _last_flush = clock.monotonic()
+    if _backend is not None:
+        _backend.sync()
+    if not _pending_whitelist_hits and not _pending_greylist_touches:
+        return
+    hits = [(hits, last_seen, client_name)
+            for client_name, (hits, last_seen)
+            in _pending_whitelist_hits.items()]
+    touches = [(last_seen,) + key
+               for key, last_seen in _pending_greylist_touches.items()]
+    _pending_whitelist_hits.clear()
+    _pending_greylist_touches.clear()
+    logger.debug("flushing %d whitelist and %d greylist updates",
+                 len(hits), len(touches))
+    backend = get_backend()
+    backend.atomic(backend.apply_updates, hits, touches)
+
+def maybe_flush_db():
+    """
+    Run :func:`flush_db` if ``write_behind_interval`` has passed since the
+    last flush.
+    """
+    if clock.monotonic() - _last_flush >= write_behind_interval:
+        try:
+            flush_db()
+        except (OSError, RedisError) as err:
+            # like respond(), carry on while the backend is unavailable
+            logger.error("Dropping coalesced updates: %s", err)
+
 def gc_db():
-    dbconn = get_db()
-    cursor = dbconn.cursor()
-    now = datetime.utcnow()
-    try:
-        if greylist_expire is not None:
-            cursor.execute("DELETE FROM greylist WHERE (julianday(?) - julianday(last_seen))*86400.0 >= ?",
-                           (now, greylist_expire))
-            if cursor.rowcount > 0:
-                logger.info("removed %s greylist entries due to expiry",
-                             cursor.rowcount)
-
-        if whitelist_expire is not None:
-            cursor.execute("""DELETE FROM whitelist
-            WHERE (julianday(?) - julianday(last_seen))*86400.0 >= ?""",
-                           (now, whitelist_expire))
-            if cursor.rowcount > 0:
-                logger.info("removed %s whitelist entries due to expiry",
-                             cursor.rowcount)
-
-        if dbconn.in_transaction:
-            dbconn.commit()
-
-        cursor.execute("SELECT COUNT(*) FROM greylist")
-        greylist_count, = cursor.fetchone()
-
-        # only trigger if the limit is set, and either the global limit is unset
-        # or it has been surpassed
-        if (max_greylist_entries_per_client_name is not None
+    """
+    Run a complete garbage collection pass, see :func:`gc_steps`.
+    """
+    for _ in gc_steps():
+        pass
+
+def gc_steps():
+    """
+    Run a garbage collection pass as a generator, which yields between the
+    chunks of work.
+
+    Expired entries and entries over the size limits are deleted in chunks of
+    at most ``gc_chunk_size`` entries, each in a transaction of its own, so that
+    requests only ever wait for a single chunk. Once the chunks took
+    ``gc_time_budget`` milliseconds, the rest is left to the next pass. The
+    outcome is logged and added to :data:`_gc_progress`.
+    """
+    flush_db()
+    backend = get_backend()
+    now = clock.time()
+    steps = []
+    if greylist_expire is not None:
+        steps.append((_expire_chunk, "greylist", now - greylist_expire))
+    if whitelist_expire is not None:
+        steps.append((_expire_chunk, "whitelist", now - whitelist_expire))
+    # checking the counters does not need the write lock
+    greylist_count = backend.count("greylist")
+    # only trigger the per-client limit if the global limit is unset or it
+    # has been surpassed
+    if (max_greylist_entries_per_client_name is not None
             and (max_greylist_entries is None
                  or greylist_count > max_greylist_entries)):
-            cursor.execute("""SELECT client_name, COUNT(*) as count
-            FROM greylist
-            GROUP BY client_name
-            HAVING count > ?""",
-                           (max_greylist_entries_per_client_name,))
-            results = list(cursor)
-            for client_name, count in results:
-                logger.warning("client_name=%r crossed entry limit, count=%s",
-                               client_name, count)
-                to_purge = count - max_greylist_entries_per_client_name
-                cursor.execute("""DELETE FROM greylist
-                WHERE id IN (SELECT id FROM greylist
-                             WHERE client_name=?
-                             ORDER BY last_seen DESC LIMIT ?)""",
-                               (client_name, to_purge))
-                logger.info("purged %s entries from client_name=%r",
-                            cursor.rowcount, client_name)
-
-        if max_greylist_entries is not None:
-            cursor.execute("SELECT COUNT(*) FROM greylist")
-            count, = cursor.fetchone()
-            if count > max_greylist_entries:
-                to_purge = count - max_greylist_entries
-                logger.info("purging %s entries from greylist (oversized)",
-                             to_purge)
-                cursor.execute("""DELETE FROM greylist WHERE id IN (
-                SELECT id FROM greylist ORDER BY last_seen ASC LIMIT ?)""",
-                               (to_purge,))
-
-        if max_whitelist_entries is not None:
-            cursor.execute("SELECT COUNT(*) FROM whitelist")
-            count, = cursor.fetchone()
-            if count > max_whitelist_entries:
-                to_purge = count - max_whitelist_entries
-                logger.info("purging %s entries from whitelist (oversized)",
-                             to_purge)
-                cursor.execute("""DELETE FROM whitelist WHERE id IN (
-                SELECT id FROM whitelist ORDER BY last_seen ASC LIMIT ?)""",
-                               (to_purge,))
-
-
-        if dbconn.in_transaction:
-            dbconn.commit()
+        clients = []
+        for client_name, count in backend.clients_over_limit(
+                max_greylist_entries_per_client_name):
+            logger.warning("client_name=%r crossed entry limit, count=%s",
+                           client_name, count)
+            clients.append([client_name, count - low_water(
+                max_greylist_entries_per_client_name)])
+        if clients:
+            steps.append((_evict_clients_chunk, clients))
+    if (max_greylist_entries is not None
+            and greylist_count > max_greylist_entries):
+        steps.append((_evict_chunk, "greylist",
+                      low_water(max_greylist_entries)))
+    if (max_whitelist_entries is not None
+            and backend.count("whitelist") > max_whitelist_entries):
+        steps.append((_evict_chunk, "whitelist",
+                      low_water(max_whitelist_entries)))
+    if not steps:
+        return
+
+    spent = 0
+    deleted = chunks = 0
+    complete = True
+    try:
+        for func, *args in steps:
+            while complete:
+                started = time.monotonic()
+                count = backend.atomic(func, backend, *args, gc_chunk_size)
+                spent += time.monotonic() - started
+                deleted += count
+                chunks += 1
+                if gc_chunk_size is None or count < gc_chunk_size:
+                    break
+                if (gc_time_budget is not None
+                        and spent * 1000 >= gc_time_budget):
+                    complete = False
+                    break
+                yield
     finally:
-        if dbconn.in_transaction:
-            dbconn.commit()
-        cursor.close()
+        _gc_progress.update(passes=1, chunks=chunks, deleted=deleted,
+                            incomplete=not complete)
+        _gc_progress["seconds"] += spent
+        _histograms["gc"].observe(spent)
+        logger.info("garbage collection deleted %d entries in %d chunks"
+                    " (%.1f ms)%s", deleted, chunks, spent * 1000,
+                    "" if complete else ", time budget exhausted")
+
+def _clear_cache(listtype):
+    if listtype == "greylist":
+        _clear_greylist_cache()
+    else:
+        _whitelist_cache.clear()
+
+def _expire_chunk(backend, listtype, cutoff, limit):
+    count = backend.expire(listtype, cutoff, limit)
+    if count > 0:
+        logger.info("removed %s %s entries due to expiry", count, listtype)
+        _clear_cache(listtype)
+    return count
 
-def load_config(f):
-    global db_file
+def low_water(limit):
+    """
+    Return the number of entries to purge down to once *limit* has been
+    exceeded, see ``gc_low_water``.
+    """
+    if gc_low_water is None:
+        return limit
+    return int(limit * gc_low_water)
+
+def _evict_clients_chunk(backend, clients, limit):
+    # clients is a list of [client_name, entries left to purge], which is
+    # worked off across chunks
+    purged = 0
+    while clients and (limit is None or purged < limit):
+        client_name, to_purge = clients[0]
+        if limit is not None:
+            to_purge = min(to_purge, limit - purged)
+        count = backend.evict_client(client_name, to_purge)
+        logger.info("purged %s entries from client_name=%r",
+                    count, client_name)
+        purged += count
+        clients[0][1] -= to_purge
+        if clients[0][1] <= 0 or count < to_purge:
+            del clients[0]
+    if purged:
+        _clear_greylist_cache()
+    return purged
+
+def _evict_chunk(backend, listtype, target, limit):
+    to_purge = backend.count(listtype) - target
+    if to_purge <= 0:
+        return 0
+    if limit is not None:
+        to_purge = min(to_purge, limit)
+    logger.info("purging %s entries from %s (oversized)", to_purge, listtype)
+    count = backend.evict(listtype, to_purge)
+    _clear_cache(listtype)
+    return count
+
+def gc_due():
+    """
+    Return whether one of the inline garbage collection triggers
+    (``gc_interval_requests`` or ``gc_interval``) has fired.
+    """
+    if (gc_interval_requests is not None
+            and _gc_requests >= gc_interval_requests):
+        return True
+    if gc_interval is not None:
+        return (_gc_last_run is None
+                or clock.monotonic() - _gc_last_run >= gc_interval)
+    return False
+
+def maybe_gc_db():
+    """
+    Account for one processed request and run :func:`gc_db` if it is due.
+    """
+    global _gc_requests, _gc_last_run
+    _gc_requests += 1
+    if not gc_due():
+        return
+    try:
+        gc_db()
+    except sqlite3.OperationalError as err:
+        if not is_busy_error(err):
+            raise
+        # try again on the next trigger
+        logger.warning("skipping garbage collection: %s", err)
+        return
+    except (OSError, RedisError) as err:
+        # like respond(), carry on while the backend is unavailable; the
+        # next attempt is made after another interval
+        logger.error("garbage collection failed: %s", err)
+    _gc_requests = 0
+    _gc_last_run = clock.monotonic()
+
+async def gc_task():
+    """
+    Run :func:`gc_db` every ``gc_interval`` seconds (or every minute, if unset)
+    in the background of the daemon.
+    """
+    done = object()
+    while True:
+        await asyncio.sleep(gc_interval or 60)
+        steps = gc_steps()
+        try:
+            # one chunk at a time, to let requests through in between
+            while await run_db(next, steps, done) is not done:
+                pass
+        except (sqlite3.Error, OSError, RedisError) as err:
+            logger.error("background garbage collection failed: %s", err)
+
+def load_config(f, daemon=None):
+    """
+    Read the configuration file *f* into the module globals. If *daemon* is
+    False, i.e. requests are read from stdin, reject settings which only work
+    in daemon mode.
+    """
+    global storage, db_file
+    global memory_snapshot_file, memory_log_file, memory_snapshot_interval
     global auto_whitelist_threshold, greylist_timeout, max_greylist_entries
     global max_whitelist_entries, greylist_expire, whitelist_expire
     global stats_active_threshold, response_pass, response_fail
     global max_greylist_entries_per_client_name, move_to_whitelist
+    global whitelist_prefixes, whitelist_prefixes_file, _static_whitelist
+    global use_client_address, client_ipv4_prefix, client_ipv6_prefix
+    global normalize_senders
     global stats_dead_threshold
+    global gc_interval_requests, gc_interval, gc_background
+    global gc_chunk_size, gc_time_budget, gc_low_water
+    global sqlite_journal_mode, sqlite_synchronous, sqlite_busy_timeout
+    global sqlite_cache_size, sqlite_mmap_size
+    global sqlite_compact_keys, sqlite_store_keys, sqlite_shards
+    global write_retries, write_retry_backoff
+    global whitelist_cache_size, whitelist_cache_ttl, write_behind_interval
+    global greylist_cache_size
+    global commit_batch_size, commit_batch_interval, commit_before_response
+    global metrics_listen, workers
+    global redis_host, redis_port, redis_db, redis_prefix, redis_pool_size
+    global redis_timeout
     config = configparser.ConfigParser()
     with f as f:
         config.read_file(f)
 
+    storage = config.get(
+        "DEFAULT", "storage",
+        fallback=storage)
+    if storage == "memory" and daemon is False:
+        raise ValueError("The memory storage only works in daemon mode"
+                         " (--listen)")
+
     db_file = config.get(
         "DEFAULT", "db_file",
         fallback=db_file)
 
+    memory_snapshot_file = getstr_or_none(
+        config,
+        "DEFAULT", "memory_snapshot_file",
+        fallback=memory_snapshot_file)
+
+    memory_log_file = getstr_or_none(
+        config,
+        "DEFAULT", "memory_log_file",
+        fallback=memory_log_file)
+
+    memory_snapshot_interval = config.getint(
+        "DEFAULT", "memory_snapshot_interval",
+        fallback=memory_snapshot_interval)
+
     auto_whitelist_threshold = getint_or_none(
         config,
         "DEFAULT", "auto_whitelist_threshold",
@@ -289,6 +1368,198 @@ def load_config(f):
         "DEFAULT", "move_to_whitelist",
         fallback=move_to_whitelist)
 
+    prefixes = config.get(
+        "DEFAULT", "whitelist_prefixes",
+        fallback=None)
+    if prefixes is not None:
+        whitelist_prefixes = prefixes.replace(",", " ").split()
+
+    whitelist_prefixes_file = getstr_or_none(
+        config,
+        "DEFAULT", "whitelist_prefixes_file",
+        fallback=whitelist_prefixes_file)
+    _static_whitelist = None
+    # compile it right away, to report invalid entries at startup
+    get_static_whitelist()
+
+    use_client_address = config.getboolean(
+        "DEFAULT", "use_client_address",
+        fallback=use_client_address)
+
+    client_ipv4_prefix = getint_or_none(
+        config,
+        "DEFAULT", "client_ipv4_prefix",
+        fallback=client_ipv4_prefix)
+
+    client_ipv6_prefix = getint_or_none(
+        config,
+        "DEFAULT", "client_ipv6_prefix",
+        fallback=client_ipv6_prefix)
+
+    normalize_senders = config.getboolean(
+        "DEFAULT", "normalize_senders",
+        fallback=normalize_senders)
+
+    gc_interval_requests = getint_or_none(
+        config,
+        "DEFAULT", "gc_interval_requests",
+        fallback=gc_interval_requests)
+
+    gc_interval = getint_or_none(
+        config,
+        "DEFAULT", "gc_interval",
+        fallback=gc_interval)
+
+    gc_background = config.getboolean(
+        "DEFAULT", "gc_background",
+        fallback=gc_background)
+
+    gc_chunk_size = getint_or_none(
+        config,
+        "DEFAULT", "gc_chunk_size",
+        fallback=gc_chunk_size)
+
+    gc_time_budget = getint_or_none(
+        config,
+        "DEFAULT", "gc_time_budget",
+        fallback=gc_time_budget)
+
+    gc_low_water = getfloat_or_none(
+        config,
+        "DEFAULT", "gc_low_water",
+        fallback=gc_low_water)
+    if gc_low_water is not None and not 0 <= gc_low_water < 1:
+        raise ValueError(
+            "gc_low_water must be at least 0 and below 1: {}".format(
+                gc_low_water))
+
+    sqlite_journal_mode = getstr_or_none(
+        config,
+        "DEFAULT", "sqlite_journal_mode",
+        fallback=sqlite_journal_mode)
+
+    sqlite_synchronous = getstr_or_none(
+        config,
+        "DEFAULT", "sqlite_synchronous",
+        fallback=sqlite_synchronous)
+
+    sqlite_busy_timeout = getint_or_none(
+        config,
+        "DEFAULT", "sqlite_busy_timeout",
+        fallback=sqlite_busy_timeout)
+
+    sqlite_cache_size = getint_or_none(
+        config,
+        "DEFAULT", "sqlite_cache_size",
+        fallback=sqlite_cache_size)
+
+    sqlite_mmap_size = getint_or_none(
+        config,
+        "DEFAULT", "sqlite_mmap_size",
+        fallback=sqlite_mmap_size)
+
+    sqlite_compact_keys = config.getboolean(
+        "DEFAULT", "sqlite_compact_keys",
+        fallback=sqlite_compact_keys)
+
+    sqlite_store_keys = config.getboolean(
+        "DEFAULT", "sqlite_store_keys",
+        fallback=sqlite_store_keys)
+
+    sqlite_shards = getint_or_none(
+        config,
+        "DEFAULT", "sqlite_shards",
+        fallback=sqlite_shards)
+
+    write_retries = config.getint(
+        "DEFAULT", "write_retries",
+        fallback=write_retries)
+
+    write_retry_backoff = config.getfloat(
+        "DEFAULT", "write_retry_backoff",
+        fallback=write_retry_backoff)
+
+    whitelist_cache_size = getint_or_none(
+        config,
+        "DEFAULT", "whitelist_cache_size",
+        fallback=whitelist_cache_size)
+
+    whitelist_cache_ttl = config.getint(
+        "DEFAULT", "whitelist_cache_ttl",
+        fallback=whitelist_cache_ttl)
+
+    write_behind_interval = config.getint(
+        "DEFAULT", "write_behind_interval",
+        fallback=write_behind_interval)
+
+    greylist_cache_size = getint_or_none(
+        config,
+        "DEFAULT", "greylist_cache_size",
+        fallback=greylist_cache_size)
+
+    commit_batch_size = config.getint(
+        "DEFAULT", "commit_batch_size",
+        fallback=commit_batch_size)
+
+    commit_batch_interval = config.getint(
+        "DEFAULT", "commit_batch_interval",
+        fallback=commit_batch_interval)
+
+    commit_before_response = config.getboolean(
+        "DEFAULT", "commit_before_response",
+        fallback=commit_before_response)
+
+    metrics_listen = getstr_or_none(
+        config,
+        "DEFAULT", "metrics_listen",
+        fallback=metrics_listen)
+
+    workers = config.getint(
+        "DEFAULT", "workers",
+        fallback=workers)
+
+    redis_host = config.get(
+        "DEFAULT", "redis_host",
+        fallback=redis_host)
+
+    redis_port = config.getint(
+        "DEFAULT", "redis_port",
+        fallback=redis_port)
+
+    redis_db = config.getint(
+        "DEFAULT", "redis_db",
+        fallback=redis_db)
+
+    redis_prefix = config.get(
+        "DEFAULT", "redis_prefix",
+        fallback=redis_prefix)
+
+    redis_pool_size = config.getint(
+        "DEFAULT", "redis_pool_size",
+        fallback=redis_pool_size)
+
+    redis_timeout = config.getfloat(
+        "DEFAULT", "redis_timeout",
+        fallback=redis_timeout)
+
+def parse_listen_address(address):
+    """
+    Parse a ``--listen`` address of the form ``unix:/path/to/socket`` or
+    ``tcp:host:port`` into a ``(kind, address)`` tuple.
+    """
+    kind, _, rest = address.partition(":")
+    if kind == "unix" and rest:
+        return "unix", rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host.startswith("[") and host.endswith("]"):
+            host = host[1:-1]
+        try:
+            return "tcp", (host or None, int(port))
+        except ValueError:
+            pass
+    raise ValueError("Invalid listen address: {}".format(address))
+
 def read_request(instream):
     attrs = {}
     for line in map(str.strip, instream):
@@ -302,113 +1573,1929 @@ def read_request(instream):
         return None
     return attrs
 
-def _check_whitelist(dbconn, cursor, client_name):
-    if auto_whitelist_threshold is not None:
-        cursor.execute("SELECT hit_count FROM whitelist WHERE client_name=?",
-                       (client_name,))
-        match = cursor.fetchone() or (0,)
-        hit_count, = match
-        if hit_count >= auto_whitelist_threshold:
+class Request:
+    """
+    A policy request holding only the attributes used by the greylisting
+    logic, see :class:`RequestParser`. It can be used like the dicts returned
+    by :func:`read_request`.
+    """
+
+    __slots__ = ("client_name", "client_address", "sender", "recipient")
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __delitem__(self, name):
+        try:
+            delattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __repr__(self):
+        return "Request({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for name in self.__slots__ if hasattr(self, name)))
+
+# seconds between the metrics reports of the workers, see Supervisor
+WORKER_REPORT_INTERVAL = 1
+# minimum seconds between the starts of a worker, see Supervisor
+WORKER_RESTART_DELAY = 1
+
+# bytes read from a connection or stdin at once
+READ_SIZE = 65536
+
+class RequestParser:
+    """
+    Incremental parser for the policy requests in a byte stream.
+
+    Data is passed to :meth:`feed` as it is received, which returns the
+    requests completed by it. Only the attributes in :class:`Request` are
+    decoded; the lines are not split in Python code, but the attributes are
+    picked from the raw request with a regular expression.
+    """
+
+    # the attributes of a Request
+    ATTRIBUTE_RE = re.compile(
+        rb"\n(" + b"|".join(name.encode() for name in Request.__slots__)
+        + rb")=([^\n]*)")
+    # all bytes but newlines and "=", see feed()
+    OTHER_BYTES = bytes(set(range(256)) - set(b"\n="))
+    # whitespace at the end of a line, including the CR of a CRLF; lines are
+    # stripped like read_request() does, so lines of whitespace end a request
+    TRAILING_SPACE_RE = re.compile(rb"[ \t\r\f\v]+\n")
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        """
+        Add *data* to the stream and return a list of the completed requests.
+        Malformed requests are returned as :class:`ValueError` instances
+        instead; empty requests are skipped.
+        """
+        buffer = self.buffer + data
+        if b"\r" in buffer:
+            # a CR at the end of the buffer is kept until its LF arrives
+            buffer = self.TRAILING_SPACE_RE.sub(b"\n", buffer)
+        requests = []
+        start = 0
+        stripped = False
+        while True:
+            # skip empty requests
+            while buffer.startswith(b"\n", start):
+                start += 1
+            end = buffer.find(b"\n\n", start)
+            # the complete lines of the (next) request
+            last = end if end >= 0 else buffer.rfind(b"\n")
+            if last < start:
+                break
+            block = (buffer[start - 1:last + 1] if start else
+                     b"\n" + buffer[:last + 1])
+            # a line without "=", see read_request()
+            if b"\n\n" in block.translate(None, self.OTHER_BYTES):
+                if not stripped:
+                    # which may be a line of whitespace ending the request
+                    buffer = buffer[:start] + self.TRAILING_SPACE_RE.sub(
+                        b"\n", buffer[start:])
+                    stripped = True
+                    continue
+                if end >= 0:
+                    requests.append(ValueError("Input format violation"))
+            elif end >= 0:
+                requests.append(self.parse(block))
+            if end < 0:
+                break
+            start = end + 2
+        self.buffer = buffer[start:]
+        return requests
+
+    def parse(self, block):
+        """
+        Parse a single well-formed request, passed with a newline before its
+        first and after its last line.
+        """
+        request = Request()
+        for name, value in self.ATTRIBUTE_RE.findall(block):
+            setattr(request, name.decode(),
+                    value.strip().decode("utf-8", "surrogateescape"))
+        return request
+
+class Backend:
+    """
+    Interface of the storage engines holding the greylist and the whitelist.
+
+    Greylist entries are addressed by their *greylisting key*, a
+    ``(client_name, sender, recipient)`` tuple, whitelist entries by their
+    ``client_name``. All timestamps are integer epoch seconds.
+    """
+
+    def decide(self, sender, recipient, client_name, now):
+        """
+        Decide on a request, record it and return a ``(whitelisted, response,
+        first_seen)`` tuple, where *first_seen* is :data:`None` for whitelisted
+        clients. Called via :meth:`atomic`.
+        """
+        if auto_whitelist_threshold is not None:
+            with _histograms["whitelist_check"].time():
+                hit_count = self.hit_whitelist(client_name, now,
+                                               auto_whitelist_threshold)
+            if hit_count is not None:
+                logger.debug("whitelist check: client_name=%r succeeded",
+                             client_name)
+                if hit_count == auto_whitelist_threshold and move_to_whitelist:
+                    self.remove_greylist_client(client_name)
+                return True, PASSED, None
+
+        with _histograms["greylist_check"].time():
+            first_seen = self.upsert_greylist((client_name, sender, recipient),
+                                              now)
+        logger.debug("greylist check: first_seen=%s", first_seen)
+        if now - first_seen >= greylist_timeout:
+            logger.debug("greylist check: passed, increasing whitelist hit"
+                          " counter")
+            self.add_whitelist_hit(client_name, now)
+            return False, PASSED, first_seen
+        logger.debug("greylist check: defer")
+        return False, FAILED, first_seen
+
+    def check(self, sender, recipient, client_name, now, batched=False):
+        """
+        Run :meth:`decide` via :meth:`atomic` and return its result.
+        """
+        return self.atomic(self.decide, sender, recipient, client_name, now,
+                           batched=batched)
+
+    def atomic(self, func, *args, batched=False):
+        """
+        Call ``func(*args)`` such that all its operations on the backend take
+        effect together and return its result. If *batched* is true, the
+        backend may defer making them durable to :func:`commit_batch`.
+        """
+        raise NotImplementedError
+
+    def hit_whitelist(self, client_name, now, threshold):
+        """
+        If the whitelist entry of *client_name* has at least *threshold* hits,
+        count another hit at *now* and return the previous hit count. Return
+        :data:`None` otherwise.
+        """
+        raise NotImplementedError
+
+    def add_whitelist_hit(self, client_name, now):
+        """
+        Count a hit for *client_name* at *now*, creating its whitelist entry
+        if needed.
+        """
+        raise NotImplementedError
+
+    def upsert_greylist(self, key, now):
+        """
+        Mark the greylist entry *key* as seen at *now*, creating it if needed,
+        and return its ``first_seen``.
+        """
+        raise NotImplementedError
+
+    def remove_greylist_client(self, client_name):
+        """
+        Delete all greylist entries of *client_name*.
+        """
+        raise NotImplementedError
+
+    def apply_updates(self, hits, touches):
+        """
+        Apply coalesced updates: *hits* is a list of ``(hits, last_seen,
+        client_name)`` tuples for the whitelist, *touches* a list of
+        ``(last_seen, client_name, sender, recipient)`` tuples for the
+        greylist. Entries which do not exist anymore are skipped.
+        """
+        raise NotImplementedError
+
+    def count(self, listtype):
+        """
+        Return the number of entries in *listtype* (``"greylist"`` or
+        ``"whitelist"``).
+        """
+        raise NotImplementedError
+
+    def clients_over_limit(self, limit):
+        """
+        Return ``(client_name, count)`` for all client names with more than
+        *limit* greylist entries. Backends may return a stand-in for
+        *client_name* which is only meaningful to :meth:`evict_client`.
+        """
+        raise NotImplementedError
+
+    def expire(self, listtype, cutoff, limit=None):
+        """
+        Delete all entries of *listtype* last seen at or before *cutoff*, or
+        only the *limit* least recently seen of them, and return their number.
+        """
+        raise NotImplementedError
+
+    def evict(self, listtype, count):
+        """
+        Delete the *count* least recently seen entries of *listtype* and return
+        the number of deleted entries.
+        """
+        raise NotImplementedError
+
+    def evict_client(self, client_name, count):
+        """
+        Delete the *count* most recently seen greylist entries of
+        *client_name* and return the number of deleted entries.
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        Called regularly outside of request processing, e.g. to persist state.
+        """
+
+    def close(self):
+        pass
+
+class SQLiteBackend(Backend):
+    """
+    Storage in the SQLite database at ``db_file``, see :func:`get_db`, or in
+    that of shard *shard*, see :func:`get_shard_db`.
+    """
+
+    def __init__(self, shard=None):
+        self.shard = shard
+
+    def db(self):
+        if self.shard is None:
+            return get_db()
+        return get_shard_db(self.shard)
+
+    def atomic(self, func, *args, batched=False):
+        run = run_batched if batched else run_transaction
+        return run(self.db(), lambda cursor: func(*args))
+
+    def hit_whitelist(self, client_name, now, threshold):
+        dbconn = self.db()
+        if HAVE_RETURNING:
+            match = dbconn.execute("""UPDATE whitelist
+            SET hit_count = hit_count + 1, last_seen = ?
+            WHERE client_name = ? AND hit_count >= ?
+            RETURNING hit_count""",
+                                   (now, client_name, threshold)).fetchone()
+            if match is None:
+                return None
+            return match[0] - 1
+
+        hit_count, = dbconn.execute(
+            "SELECT hit_count FROM whitelist WHERE client_name=?",
+            (client_name,)).fetchone() or (0,)
+        if hit_count < threshold:
+            return None
+        dbconn.execute("""UPDATE whitelist
+        SET hit_count = hit_count + 1, last_seen = ?
+        WHERE client_name = ?""",
+                       (now, client_name))
+        return hit_count
+
+    def add_whitelist_hit(self, client_name, now):
+        self.db().execute("""INSERT INTO whitelist (client_name, last_seen, hit_count)
+        VALUES (?, ?, 1)
+        ON CONFLICT (client_name)
+        DO UPDATE SET last_seen = excluded.last_seen, hit_count = hit_count + 1""",
+                         (client_name, now))
+
+    def upsert_greylist(self, key, now):
+        dbconn = self.db()
+        cursor = dbconn.execute("""INSERT INTO greylist (client_name, sender,
+        recipient, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (client_name, sender, recipient)
+        DO UPDATE SET last_seen = excluded.last_seen"""
+                                + (" RETURNING first_seen"
+                                   if HAVE_RETURNING else ""),
+                                key + (now, now))
+        if not HAVE_RETURNING:
+            cursor = dbconn.execute("""SELECT first_seen FROM greylist
+            WHERE client_name=? AND sender=? AND recipient=?""",
+                                    key)
+        first_seen, = cursor.fetchone()
+        return first_seen
+
+    def remove_greylist_client(self, client_name):
+        self.db().execute("DELETE FROM greylist WHERE client_name=?",
+                         (client_name,))
+
+    def apply_updates(self, hits, touches):
+        dbconn = self.db()
+        dbconn.executemany("""UPDATE whitelist
+        SET hit_count = hit_count + ?, last_seen = max(last_seen, ?)
+        WHERE client_name = ?""",
+                           hits)
+        dbconn.executemany("""UPDATE greylist
+        SET last_seen = max(last_seen, ?)
+        WHERE client_name = ? AND sender = ? AND recipient = ?""",
+                           touches)
+
+    def count(self, listtype):
+        return get_count(self.db().cursor(), listtype)
+
+    def clients_over_limit(self, limit):
+        return self.db().execute("""SELECT client_name, count
+        FROM greylist_client_counts
+        WHERE count > ?""",
+                                (limit,)).fetchall()
+
+    def expire(self, listtype, cutoff, limit=None):
+        # listtype is not direct user input, so format is safe here
+        if limit is None:
+            return self.db().execute(
+                "DELETE FROM {} WHERE last_seen <= ?".format(listtype),
+                (cutoff,)).rowcount
+        return self.db().execute("""DELETE FROM {0} WHERE id IN (
+        SELECT id FROM {0} WHERE last_seen <= ?
+        ORDER BY last_seen ASC LIMIT ?)""".format(listtype),
+                                 (cutoff, limit)).rowcount
+
+    def evict(self, listtype, count):
+        return self.db().execute("""DELETE FROM {0} WHERE id IN (
+        SELECT id FROM {0} ORDER BY last_seen ASC LIMIT ?)""".format(listtype),
+                                (count,)).rowcount
+
+    def oldest(self, listtype, count):
+        """
+        Return the ``last_seen`` of the *count* least recently seen entries of
+        *listtype*, in ascending order.
+        """
+        return [last_seen
+                for last_seen, in self.db().execute(
+                    "SELECT last_seen FROM {} ORDER BY last_seen ASC LIMIT ?".format(
+                        listtype),
+                    (count,))]
+
+    def evict_client(self, client_name, count):
+        return self.db().execute("""DELETE FROM greylist
+        WHERE id IN (SELECT id FROM greylist
+                     WHERE client_name=?
+                     ORDER BY last_seen DESC LIMIT ?)""",
+                                (client_name, count)).rowcount
+
+class CompactSQLiteBackend(SQLiteBackend):
+    """
+    Storage in the SQLite database using the compact schema selected by
+    ``sqlite_compact_keys``. :meth:`clients_over_limit` returns the hashes of
+    the client names.
+    """
+
+    def upsert_greylist(self, key, now):
+        dbconn = self.db()
+        id_ = key_hash(*key)
+        cursor = dbconn.execute("""INSERT INTO greylist (id, client_id,
+        first_seen, last_seen)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (id)
+        DO UPDATE SET last_seen = excluded.last_seen"""
+                                + (" RETURNING first_seen"
+                                   if HAVE_RETURNING else ""),
+                                (id_, key_hash(key[0]), now, now))
+        if not HAVE_RETURNING:
+            cursor = dbconn.execute(
+                "SELECT first_seen FROM greylist WHERE id=?",
+                (id_,))
+        first_seen, = cursor.fetchone()
+        # a new entry always has first_seen == now
+        if sqlite_store_keys and first_seen == now:
+            dbconn.execute("""INSERT OR IGNORE INTO greylist_keys
+            (id, client_name, sender, recipient)
+            VALUES (?, ?, ?, ?)""",
+                           (id_,) + key)
+        return first_seen
+
+    def remove_greylist_client(self, client_name):
+        self.db().execute("DELETE FROM greylist WHERE client_id=?",
+                         (key_hash(client_name),))
+
+    def apply_updates(self, hits, touches):
+        super().apply_updates(hits, [])
+        self.db().executemany("""UPDATE greylist
+        SET last_seen = max(last_seen, ?)
+        WHERE id = ?""",
+                             [(last_seen, key_hash(*key))
+                              for last_seen, *key in touches])
+
+    def clients_over_limit(self, limit):
+        return self.db().execute("""SELECT client_id, count
+        FROM greylist_client_counts
+        WHERE count > ?""",
+                                (limit,)).fetchall()
+
+    def evict_client(self, client_id, count):
+        return self.db().execute("""DELETE FROM greylist
+        WHERE id IN (SELECT id FROM greylist
+                     WHERE client_id=?
+                     ORDER BY last_seen DESC LIMIT ?)""",
+                                (client_id, count)).rowcount
+
+class ShardedSQLiteBackend(Backend):
+    """
+    Storage in ``sqlite_shards`` SQLite databases, given as a list of
+    :class:`SQLiteBackend` instances. Both lists are partitioned by the hash of
+    the client name, so each request only locks the database of its client.
+    Operations spanning several shards are only atomic per shard.
+    :meth:`clients_over_limit` returns ``(shard, client_name)`` tuples.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def _index(self, client_name):
+        return key_hash(client_name) % len(self.shards)
+
+    def _run(self, index, method, *args):
+        shard = self.shards[index]
+        return shard.atomic(getattr(shard, method), *args)
+
+    def check(self, sender, recipient, client_name, now, batched=False):
+        shard = self.shards[self._index(client_name)]
+        return shard.check(sender, recipient, client_name, now,
+                           batched=batched)
+
+    def atomic(self, func, *args, batched=False):
+        return func(*args)
+
+    def hit_whitelist(self, client_name, now, threshold):
+        return self._run(self._index(client_name), "hit_whitelist",
+                         client_name, now, threshold)
+
+    def add_whitelist_hit(self, client_name, now):
+        self._run(self._index(client_name), "add_whitelist_hit",
+                  client_name, now)
+
+    def upsert_greylist(self, key, now):
+        return self._run(self._index(key[0]), "upsert_greylist", key, now)
+
+    def remove_greylist_client(self, client_name):
+        self._run(self._index(client_name), "remove_greylist_client",
+                  client_name)
+
+    def apply_updates(self, hits, touches):
+        updates = collections.defaultdict(lambda: ([], []))
+        for hit in hits:
+            updates[self._index(hit[2])][0].append(hit)
+        for touch in touches:
+            updates[self._index(touch[1])][1].append(touch)
+        for index, (shard_hits, shard_touches) in updates.items():
+            self._run(index, "apply_updates", shard_hits, shard_touches)
+
+    def count(self, listtype):
+        return sum(shard.count(listtype) for shard in self.shards)
+
+    def clients_over_limit(self, limit):
+        return [((index, client_name), count)
+                for index, shard in enumerate(self.shards)
+                for client_name, count in shard.clients_over_limit(limit)]
+
+    def expire(self, listtype, cutoff, limit=None):
+        deleted = 0
+        for index in range(len(self.shards)):
+            if limit is None:
+                deleted += self._run(index, "expire", listtype, cutoff)
+            elif deleted < limit:
+                deleted += self._run(index, "expire", listtype, cutoff,
+                                     limit - deleted)
+        return deleted
+
+    def evict(self, listtype, count):
+        # find the globally least recently seen entries by merging those of
+        # all shards
+        oldest = heapq.merge(*(
+            [(last_seen, index) for last_seen in shard.oldest(listtype, count)]
+            for index, shard in enumerate(self.shards)))
+        counts = collections.Counter(
+            index for _, index in itertools.islice(oldest, count))
+        return sum(self._run(index, "evict", listtype, shard_count)
+                   for index, shard_count in sorted(counts.items()))
+
+    def evict_client(self, client, count):
+        index, client_name = client
+        return self._run(index, "evict_client", client_name, count)
+
+class MemoryBackend(Backend):
+    """
+    Storage in plain dictionaries, with heaps ordering the entries by
+    ``last_seen`` for expiry and eviction.
+
+    If ``db_file`` is not ``:memory:``, every change is appended to the log at
+    ``memory_log_file`` and the complete state is written to
+    ``memory_snapshot_file`` every ``memory_snapshot_interval`` seconds, after
+    which the log starts over. On startup, the snapshot is loaded and the log
+    replayed. The log is written without ``fsync``, so the last changes may be
+    lost on a system crash.
+    """
+
+    def __init__(self, snapshot_file=None, log_file=None):
+        # key -> [first_seen, last_seen]
+        self.greylist = {}
+        # client_name -> set of keys
+        self.clients = {}
+        # client_name -> [hit_count, last_seen]
+        self.whitelist = {}
+        # (last_seen, key) heaps; outdated items are skipped lazily
+        self.lru = {"greylist": [], "whitelist": []}
+        self.snapshot_file = snapshot_file
+        self.log_file = log_file
+        self._log = None
+        self._last_snapshot = clock.monotonic()
+        if snapshot_file is not None:
+            self._load()
+        if log_file is not None:
+            self._log = open(log_file, "a")
+
+    def _entries(self, listtype):
+        return self.greylist if listtype == "greylist" else self.whitelist
+
+    def _touch(self, listtype, key, last_seen):
+        lru = self.lru[listtype]
+        heapq.heappush(lru, (last_seen, key))
+        if len(lru) > 2 * len(self._entries(listtype)) + 64:
+            # drop the outdated items
+            lru[:] = [(entry[-1], key)
+                      for key, entry in self._entries(listtype).items()]
+            heapq.heapify(lru)
+
+    def _set_greylist(self, key, first_seen, last_seen):
+        self.greylist[key] = [first_seen, last_seen]
+        self.clients.setdefault(key[0], set()).add(key)
+        self._touch("greylist", key, last_seen)
+        self._write_log("g", *key, first_seen, last_seen)
+
+    def _set_whitelist(self, client_name, hit_count, last_seen):
+        self.whitelist[client_name] = [hit_count, last_seen]
+        self._touch("whitelist", client_name, last_seen)
+        self._write_log("w", client_name, hit_count, last_seen)
+
+    def _delete(self, listtype, key):
+        if listtype == "greylist":
+            del self.greylist[key]
+            keys = self.clients[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.clients[key[0]]
+            self._write_log("gd", *key)
+        else:
+            del self.whitelist[key]
+            self._write_log("wd", key)
+
+    def _write_log(self, *op):
+        if self._log is not None:
+            self._log.write(json.dumps(op) + "\n")
+
+    def _replay(self, op):
+        kind, *args = op
+        if kind == "g":
+            *key, first_seen, last_seen = args
+            self._set_greylist(tuple(key), first_seen, last_seen)
+        elif kind == "w":
+            self._set_whitelist(*args)
+        elif kind == "gd":
+            if tuple(args) in self.greylist:
+                self._delete("greylist", tuple(args))
+        elif kind == "wd":
+            if args[0] in self.whitelist:
+                self._delete("whitelist", args[0])
+
+    def _load(self):
+        try:
+            with open(self.snapshot_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"greylist": [], "whitelist": []}
+        for client_name, sender, recipient, first_seen, last_seen in \
+                state["greylist"]:
+            self._set_greylist((client_name, sender, recipient),
+                               first_seen, last_seen)
+        for client_name, hit_count, last_seen in state["whitelist"]:
+            self._set_whitelist(client_name, hit_count, last_seen)
+
+        if self.log_file is None:
+            return
+        try:
+            with open(self.log_file) as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # incomplete last line after a crash
+                        logger.warning("ignoring corrupt log entry %r", line)
+                        continue
+                    self._replay(op)
+        except FileNotFoundError:
+            pass
+        logger.info("loaded %d greylist and %d whitelist entries",
+                    len(self.greylist), len(self.whitelist))
+
+    def snapshot(self):
+        """
+        Write the complete state to the snapshot file and truncate the log.
+        """
+        self._last_snapshot = clock.monotonic()
+        if self.snapshot_file is None:
+            return
+        state = {
+            "greylist": [list(key) + entry
+                         for key, entry in self.greylist.items()],
+            "whitelist": [[client_name] + entry
+                          for client_name, entry in self.whitelist.items()],
+        }
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        if self._log is not None:
+            # replaying the log on top of the snapshot is idempotent, so a
+            # crash right here loses nothing
+            self._log.close()
+            self._log = open(self.log_file, "w")
+        logger.debug("wrote snapshot to %s", self.snapshot_file)
+
+    def atomic(self, func, *args, batched=False):
+        return func(*args)
+
+    def hit_whitelist(self, client_name, now, threshold):
+        entry = self.whitelist.get(client_name)
+        if entry is None or entry[0] < threshold:
+            return None
+        hit_count = entry[0]
+        self._set_whitelist(client_name, hit_count + 1, now)
+        return hit_count
+
+    def add_whitelist_hit(self, client_name, now):
+        hit_count = self.whitelist.get(client_name, [0])[0]
+        self._set_whitelist(client_name, hit_count + 1, now)
+
+    def upsert_greylist(self, key, now):
+        first_seen = self.greylist.get(key, [now])[0]
+        self._set_greylist(key, first_seen, now)
+        return first_seen
+
+    def remove_greylist_client(self, client_name):
+        for key in list(self.clients.get(client_name, ())):
+            self._delete("greylist", key)
+
+    def apply_updates(self, hits, touches):
+        for count, last_seen, client_name in hits:
+            entry = self.whitelist.get(client_name)
+            if entry is not None:
+                self._set_whitelist(client_name, entry[0] + count,
+                                    max(entry[1], last_seen))
+        for last_seen, *key in touches:
+            key = tuple(key)
+            entry = self.greylist.get(key)
+            if entry is not None:
+                self._set_greylist(key, entry[0], max(entry[1], last_seen))
+
+    def count(self, listtype):
+        return len(self._entries(listtype))
+
+    def clients_over_limit(self, limit):
+        return [(client_name, len(keys))
+                for client_name, keys in self.clients.items()
+                if len(keys) > limit]
+
+    def _pop_lru(self, listtype, cutoff=None):
+        entries = self._entries(listtype)
+        lru = self.lru[listtype]
+        while lru:
+            last_seen, key = lru[0]
+            if cutoff is not None and last_seen > cutoff:
+                return False
+            heapq.heappop(lru)
+            entry = entries.get(key)
+            if entry is not None and entry[-1] == last_seen:
+                self._delete(listtype, key)
+                return True
+        return False
+
+    def expire(self, listtype, cutoff, limit=None):
+        count = 0
+        while ((limit is None or count < limit)
+               and self._pop_lru(listtype, cutoff)):
+            count += 1
+        return count
+
+    def evict(self, listtype, count):
+        deleted = 0
+        while deleted < count and self._pop_lru(listtype):
+            deleted += 1
+        return deleted
+
+    def evict_client(self, client_name, count):
+        keys = sorted(self.clients.get(client_name, ()),
+                      key=lambda key: self.greylist[key][1],
+                      reverse=True)[:count]
+        for key in keys:
+            self._delete("greylist", key)
+        return len(keys)
+
+    def sync(self):
+        if self._log is not None:
+            self._log.flush()
+        if clock.monotonic() - self._last_snapshot >= memory_snapshot_interval:
+            self.snapshot()
+
+    def close(self):
+        self.snapshot()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+class RedisError(Exception):
+    """
+    An error reply from the key-value store.
+    """
+
+class RedisConnection:
+    """
+    A connection speaking the Redis serialisation protocol (RESP).
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+
+    @staticmethod
+    def _encode(command):
+        args = [arg if isinstance(arg, bytes)
+                else str(arg).encode("utf-8", errors="surrogateescape")
+                for arg in command]
+        return b"".join(
+            [b"*%d\r\n" % len(args)]
+            + [b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args])
+
+    def _read_reply(self):
+        line = self.file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("connection closed by server")
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply() for i in range(length)]
+        raise ConnectionError("protocol error: {!r}".format(line))
+
+    def pipeline(self, commands):
+        """
+        Send all *commands* at once and return their replies. If any of them
+        failed, the first error is raised after all replies have been read.
+        """
+        self.sock.sendall(b"".join(map(self._encode, commands)))
+        replies = [self._read_reply() for command in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class RedisPool:
+    """
+    Keeps up to *size* idle connections to the key-value store for reuse.
+    """
+
+    def __init__(self, host, port, db=0, timeout=None, size=4):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self.size = size
+        self.idle = []
+
+    def _connect(self):
+        logger.debug("connecting to key-value store at %s:%s",
+                     self.host, self.port)
+        conn = RedisConnection(self.host, self.port, self.timeout)
+        if self.db:
+            conn.pipeline([("SELECT", self.db)])
+        return conn
+
+    def pipeline(self, commands):
+        """
+        Run *commands* on a pooled connection and return their replies.
+        """
+        conn = self.idle.pop() if self.idle else self._connect()
+        try:
+            replies = conn.pipeline(commands)
+        except RedisError:
+            self._release(conn)
+            raise
+        except:
+            # the connection state is unknown
+            conn.close()
+            raise
+        self._release(conn)
+        return replies
+
+    def _release(self, conn):
+        if len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        for conn in self.idle:
+            conn.close()
+        self.idle.clear()
+
+class RedisBackend(Backend):
+    """
+    Storage in a Redis-compatible key-value store shared by several hosts.
+
+    With the prefix ``P``, the data is laid out as follows:
+
+    * ``Pg:KEY`` holds the ``first_seen`` of the greylist entry ``KEY``, which
+      is the greylisting key joined by NUL characters.
+    * ``Pglru`` is a sorted set of all greylist ``KEY``s by ``last_seen``,
+      ``Pgc:CLIENT_NAME`` the same for a single client name, and ``Pgclients``
+      the set of client names with greylist entries.
+    * ``Pw`` is a hash of the hit count by whitelisted client name and
+      ``Pwlru`` a sorted set of those by ``last_seen``.
+
+    Each decision takes two pipelined round trips: one for the lookup and one
+    for the update.
+    """
+
+    def __init__(self, pool, prefix="greylist:"):
+        self.pool = pool
+        self.prefix = prefix
+
+    def _member(self, key):
+        return "\0".join(key)
+
+    @staticmethod
+    def _decode(value):
+        return value.decode("utf-8", errors="surrogateescape")
+
+    def decide(self, sender, recipient, client_name, now):
+        p = self.prefix
+        key = client_name, sender, recipient
+        member = self._member(key)
+        # the greylist lookup is part of the same round trip
+        with _histograms["whitelist_check"].time():
+            hit_count, first_seen = self.pool.pipeline([
+                ("HGET", p + "w", client_name),
+                ("GET", p + "g:" + member),
+            ])
+        if (auto_whitelist_threshold is not None and hit_count is not None
+                and int(hit_count) >= auto_whitelist_threshold):
+            hit_count = int(hit_count)
             logger.debug("whitelist check: client_name=%r succeeded",
                          client_name)
-            cursor.execute("""UPDATE whitelist
-                              SET hit_count = hit_count + 1, last_seen = ?
-                              WHERE client_name = ?""",
-                           (datetime.utcnow(), client_name))
+            self.pool.pipeline([
+                ("HINCRBY", p + "w", client_name, 1),
+                ("ZADD", p + "wlru", now, client_name),
+            ])
             if hit_count == auto_whitelist_threshold and move_to_whitelist:
-                cursor.execute("DELETE FROM greylist WHERE client_name=?",
-                               (client_name,))
-                dbconn.commit()
-            return True
-    return False
+                self.remove_greylist_client(client_name)
+            return True, PASSED, None
 
-def _check_greylist(dbconn, cursor, sender, recipient, client_name):
-    key = sender, recipient, client_name
-    now = datetime.utcnow()
-    cursor.execute("""SELECT first_seen FROM greylist
-    WHERE sender=? AND recipient=? AND client_name=?""",
-                   key)
-
-    match = cursor.fetchone()
-    if match is None:
-        logger.debug("greylist check: no match, creating new entry")
-        # no entry yet
-        cursor.execute("""INSERT INTO greylist (sender, recipient, client_name,
-        first_seen, last_seen)
-        VALUES (?, ?, ?, ?, ?)""",
-                       key + (now, now))
-        cursor.close()
-        dbconn.commit()
-        return FAILED
-    else:
-        first_seen, = match
-        logger.debug("greylist check: match, first_seen=%s", first_seen)
-        delta = now - first_seen
-        cursor.execute("""UPDATE greylist
-        SET last_seen = ?
-        WHERE sender=? AND recipient=? AND client_name=?""",
-                       (now,) + key)
-        if delta.total_seconds() >= greylist_timeout:
+        first_seen = now if first_seen is None else int(first_seen)
+        logger.debug("greylist check: first_seen=%s", first_seen)
+        commands = [
+            ("SETNX", p + "g:" + member, first_seen),
+            ("ZADD", p + "glru", now, member),
+            ("ZADD", p + "gc:" + client_name, now, member),
+            ("SADD", p + "gclients", client_name),
+        ]
+        if now - first_seen >= greylist_timeout:
             logger.debug("greylist check: passed, increasing whitelist hit"
                           " counter")
-            cursor.execute("""
-INSERT OR IGNORE INTO whitelist (client_name, hit_count) VALUES (?, 0)""",
-                           (client_name, ))
-            cursor.execute("""
-UPDATE whitelist SET last_seen = ?, hit_count = hit_count + 1
-WHERE client_name=?""",
-                           (now, client_name))
-            dbconn.commit()
-            return PASSED
-        logger.debug("greylist check: defer")
-        return FAILED
+            commands += [
+                ("HINCRBY", p + "w", client_name, 1),
+                ("ZADD", p + "wlru", now, client_name),
+            ]
+            response = PASSED
+        else:
+            logger.debug("greylist check: defer")
+            response = FAILED
+        with _histograms["greylist_check"].time():
+            self.pool.pipeline(commands)
+        return False, response, first_seen
+
+    def atomic(self, func, *args, batched=False):
+        return func(*args)
+
+    def hit_whitelist(self, client_name, now, threshold):
+        p = self.prefix
+        hit_count, = self.pool.pipeline([("HGET", p + "w", client_name)])
+        if hit_count is None or int(hit_count) < threshold:
+            return None
+        self.pool.pipeline([
+            ("HINCRBY", p + "w", client_name, 1),
+            ("ZADD", p + "wlru", now, client_name),
+        ])
+        return int(hit_count)
+
+    def add_whitelist_hit(self, client_name, now):
+        p = self.prefix
+        self.pool.pipeline([
+            ("HINCRBY", p + "w", client_name, 1),
+            ("ZADD", p + "wlru", now, client_name),
+        ])
+
+    def upsert_greylist(self, key, now):
+        p = self.prefix
+        member = self._member(key)
+        _, first_seen, *_ = self.pool.pipeline([
+            ("SETNX", p + "g:" + member, now),
+            ("GET", p + "g:" + member),
+            ("ZADD", p + "glru", now, member),
+            ("ZADD", p + "gc:" + key[0], now, member),
+            ("SADD", p + "gclients", key[0]),
+        ])
+        return int(first_seen)
+
+    def _delete_greylist(self, members):
+        if not members:
+            return 0
+        p = self.prefix
+        commands = []
+        client_names = set()
+        for member in map(self._decode, members):
+            client_name = member.partition("\0")[0]
+            client_names.add(client_name)
+            commands += [
+                ("DEL", p + "g:" + member),
+                ("ZREM", p + "glru", member),
+                ("ZREM", p + "gc:" + client_name, member),
+            ]
+        self.pool.pipeline(commands)
+        client_names = sorted(client_names)
+        counts = self.pool.pipeline([("ZCARD", p + "gc:" + client_name)
+                                     for client_name in client_names])
+        empty = [client_name
+                 for client_name, count in zip(client_names, counts)
+                 if not count]
+        if empty:
+            self.pool.pipeline([("SREM", p + "gclients") + tuple(empty)])
+        return len(members)
+
+    def _delete_whitelist(self, members):
+        if not members:
+            return 0
+        p = self.prefix
+        self.pool.pipeline([
+            ("HDEL", p + "w") + tuple(members),
+            ("ZREM", p + "wlru") + tuple(members),
+        ])
+        return len(members)
+
+    def _delete(self, listtype, members):
+        if listtype == "greylist":
+            return self._delete_greylist(members)
+        return self._delete_whitelist(members)
+
+    def remove_greylist_client(self, client_name):
+        members, = self.pool.pipeline([
+            ("ZRANGE", self.prefix + "gc:" + client_name, 0, -1),
+        ])
+        self._delete_greylist(members)
+
+    def apply_updates(self, hits, touches):
+        p = self.prefix
+        if hits:
+            exists = self.pool.pipeline([("HEXISTS", p + "w", client_name)
+                                         for _, _, client_name in hits])
+            commands = []
+            for (count, last_seen, client_name), exist in zip(hits, exists):
+                if exist:
+                    commands += [
+                        ("HINCRBY", p + "w", client_name, count),
+                        ("ZADD", p + "wlru", "XX", "GT", last_seen,
+                         client_name),
+                    ]
+            if commands:
+                self.pool.pipeline(commands)
+        if touches:
+            commands = []
+            for last_seen, *key in touches:
+                member = self._member(key)
+                commands += [
+                    ("ZADD", p + "glru", "XX", "GT", last_seen, member),
+                    ("ZADD", p + "gc:" + key[0], "XX", "GT", last_seen,
+                     member),
+                ]
+            self.pool.pipeline(commands)
+
+    def count(self, listtype):
+        if listtype == "greylist":
+            count, = self.pool.pipeline([("ZCARD", self.prefix + "glru")])
+        else:
+            count, = self.pool.pipeline([("HLEN", self.prefix + "w")])
+        return count
+
+    def clients_over_limit(self, limit):
+        p = self.prefix
+        client_names, = self.pool.pipeline([("SMEMBERS", p + "gclients")])
+        client_names = list(map(self._decode, client_names))
+        if not client_names:
+            return []
+        counts = self.pool.pipeline([("ZCARD", p + "gc:" + client_name)
+                                     for client_name in client_names])
+        return [(client_name, count)
+                for client_name, count in zip(client_names, counts)
+                if count > limit]
+
+    def _lru(self, listtype):
+        return self.prefix + ("glru" if listtype == "greylist" else "wlru")
+
+    def expire(self, listtype, cutoff, limit=None):
+        command = ("ZRANGEBYSCORE", self._lru(listtype), "-inf", cutoff)
+        if limit is not None:
+            command += ("LIMIT", 0, limit)
+        members, = self.pool.pipeline([command])
+        return self._delete(listtype, members)
+
+    def evict(self, listtype, count):
+        members, = self.pool.pipeline([
+            ("ZRANGE", self._lru(listtype), 0, count - 1),
+        ])
+        return self._delete(listtype, members)
+
+    def evict_client(self, client_name, count):
+        members, = self.pool.pipeline([
+            ("ZREVRANGE", self.prefix + "gc:" + client_name, 0, count - 1),
+        ])
+        return self._delete_greylist(members)
+
+    def close(self):
+        self.pool.close()
+
+def get_backend():
+    """
+    Return the storage backend selected by ``storage``.
+    """
+    global _backend
+    if _backend is None:
+        if storage == "sqlite":
+            if sqlite_compact_keys:
+                backend_class = CompactSQLiteBackend
+            else:
+                backend_class = SQLiteBackend
+            if sqlite_shards:
+                _backend = ShardedSQLiteBackend(
+                    [backend_class(shard=index)
+                     for index in range(sqlite_shards)])
+            else:
+                _backend = backend_class()
+        elif storage == "memory":
+            if db_file == ":memory:":
+                _backend = MemoryBackend()
+            else:
+                _backend = MemoryBackend(
+                    snapshot_file=memory_snapshot_file or db_file + ".snapshot",
+                    log_file=memory_log_file or db_file + ".log")
+        elif storage == "redis":
+            _backend = RedisBackend(
+                RedisPool(redis_host, redis_port, db=redis_db,
+                          timeout=redis_timeout, size=redis_pool_size),
+                prefix=redis_prefix)
+        else:
+            raise ValueError("Invalid storage: {}".format(storage))
+    return _backend
+
+class StaticWhitelist:
+    """
+    Client addresses and names which are never greylisted, see
+    ``whitelist_prefixes``.
+
+    Networks are stored in a binary trie per address family and domains in a
+    trie of their labels, starting at the top level domain, so a lookup takes
+    at most one step per bit of the address or label of the name.
+    """
+
+    def __init__(self, entries=()):
+        # node: [child for bit 0, child for bit 1, whether a network ends here]
+        self.networks = {4: [None, None, False], 6: [None, None, False]}
+        # node: {label: node}, None marks the end of a domain
+        self.domains = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """
+        Add a network in CIDR notation, a single address or a domain, which
+        also covers all of its subdomains. Raise ValueError for an entry which
+        looks like a network or address but is not a valid one.
+        """
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError as err:
+            if "/" in entry or ":" in entry or entry.replace(".", "").isdigit():
+                raise ValueError("Invalid network in whitelist_prefixes: {}"
+                                 .format(err)) from None
+            node = self.domains
+            for label in reversed(entry.lower().strip(".").split(".")):
+                node = node.setdefault(label, {})
+            node[None] = True
+            return
+        node = self.networks[network.version]
+        address = int(network.network_address)
+        for i in range(network.max_prefixlen - 1,
+                       network.max_prefixlen - 1 - network.prefixlen, -1):
+            bit = (address >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[2] = True
+
+    def match_address(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        node = self.networks[address.version]
+        value = int(address)
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            if node[2]:
+                return True
+            node = node[(value >> i) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+    def match_name(self, name):
+        node = self.domains
+        for label in reversed(name.lower().rstrip(".").split(".")):
+            try:
+                node = node[label]
+            except KeyError:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def match(self, client_address, client_name):
+        return ((client_address is not None
+                 and self.match_address(client_address))
+                or self.match_name(client_name))
+
+def read_whitelist_prefixes(f):
+    """
+    Return the entries of a ``whitelist_prefixes_file``: one per line, with
+    ``#`` starting a comment.
+    """
+    entries = []
+    for line in f:
+        entries += line.partition("#")[0].split()
+    return entries
+
+def get_static_whitelist():
+    """
+    Return the :class:`StaticWhitelist` compiled from ``whitelist_prefixes``
+    and ``whitelist_prefixes_file``, or None if both are empty.
+    """
+    global _static_whitelist
+    if _static_whitelist is None:
+        entries = list(whitelist_prefixes)
+        if whitelist_prefixes_file is not None:
+            with open(whitelist_prefixes_file) as f:
+                entries += read_whitelist_prefixes(f)
+        _static_whitelist = StaticWhitelist(entries) if entries else False
+    return _static_whitelist or None
+
+def _check_whitelist_cache(client_name, now):
+    try:
+        expires = _whitelist_cache[client_name]
+    except KeyError:
+        return False
+    if clock.monotonic() >= expires:
+        del _whitelist_cache[client_name]
+        return False
+    _whitelist_cache.move_to_end(client_name)
+    pending = _pending_whitelist_hits.setdefault(client_name, [0, now])
+    pending[0] += 1
+    pending[1] = now
+    logger.debug("whitelist check: client_name=%r succeeded (cached)",
+                 client_name)
+    return True
+
+def _cache_whitelisted(client_name):
+    _whitelist_cache[client_name] = clock.monotonic() + whitelist_cache_ttl
+    _whitelist_cache.move_to_end(client_name)
+    while len(_whitelist_cache) > whitelist_cache_size:
+        _whitelist_cache.popitem(last=False)
+
+def _check_greylist_cache(key, now):
+    try:
+        first_seen = _greylist_cache[key]
+    except KeyError:
+        return False
+    if now - first_seen >= greylist_timeout:
+        # the entry has to be updated in the database
+        _uncache_deferred(key)
+        return False
+    _greylist_cache.move_to_end(key)
+    _pending_greylist_touches[key] = now
+    logger.debug("greylist check: defer (cached), first_seen=%s", first_seen)
+    return True
+
+def _cache_deferred(key, first_seen):
+    _greylist_cache[key] = first_seen
+    _greylist_cache.move_to_end(key)
+    _greylist_cache_clients.setdefault(key[0], set()).add(key)
+    while len(_greylist_cache) > greylist_cache_size:
+        _uncache_deferred(next(iter(_greylist_cache)))
+
+def _uncache_deferred(key):
+    del _greylist_cache[key]
+    keys = _greylist_cache_clients[key[0]]
+    keys.discard(key)
+    if not keys:
+        del _greylist_cache_clients[key[0]]
+
+def _uncache_client(client_name):
+    """
+    Drop the cached deferred keys of *client_name*, which may have been
+    whitelisted, so that its retries are decided by the backend again.
+    """
+    for key in _greylist_cache_clients.pop(client_name, ()):
+        del _greylist_cache[key]
+
+def _clear_greylist_cache():
+    _greylist_cache.clear()
+    _greylist_cache_clients.clear()
 
 def process_request(attrs):
-    dbconn = get_db()
-    cursor = dbconn.cursor()
+    """
+    Decide on a request and record it in the storage backend.
+
+    Requests from clients in the static whitelist (see
+    :func:`get_static_whitelist`) pass without touching the storage backend.
+
+    With the SQLite backend, all reads and writes for one request happen in a single ``BEGIN
+    IMMEDIATE`` transaction which is committed once. The write lock is thus
+    taken before anything is read, so concurrent processes working on the same
+    database are serialised: each decision is based on the state left behind
+    by the previously committed request and is either recorded completely or
+    not at all.
+
+    If the whitelist cache is enabled, requests from cached whitelisted clients
+    are answered without touching the database. Likewise, if the greylist cache
+    is enabled, retries of a greylisting key within ``greylist_timeout`` are
+    deferred without touching the database, until the client gets whitelisted.
+    The resulting updates are written by :func:`flush_db`.
+
+    If group commit is enabled (see :func:`batching`), the writes are left in an
+    open transaction instead, which the caller has to commit eventually using
+    :func:`commit_batch` or :func:`group_commit`.
+    """
+    sender = attrs["sender"]
+    recipient = attrs["recipient"]
+    client_name = attrs["client_name"]
+    key = client_name, sender, recipient
+
+    logger.debug("processing request: sender=%r, recipient=%r, client_name=%r",
+                  sender, recipient, client_name)
+    static_whitelist = get_static_whitelist()
+    if static_whitelist is not None and static_whitelist.match(
+            attrs.get("client_address"), client_name):
+        logger.debug("whitelist check: client_name=%r succeeded (static)",
+                     client_name)
+        return PASSED
+    now = clock.time()
+    if whitelist_cache_size and _check_whitelist_cache(client_name, now):
+        return PASSED
+    if greylist_cache_size and _check_greylist_cache(key, now):
+        return FAILED
+
+    backend = get_backend()
+    whitelisted, response, first_seen = backend.check(
+        sender, recipient, client_name, now, batched=batching())
+    if response == PASSED and greylist_cache_size:
+        # the hit may have whitelisted the client
+        _uncache_client(client_name)
+    if whitelisted and whitelist_cache_size:
+        _cache_whitelisted(client_name)
+    elif response == FAILED and greylist_cache_size:
+        _cache_deferred(key, first_seen)
+    return response
 
+def respond(request):
+    """
+    Run a request as returned by :func:`read_request` or
+    :class:`RequestParser` through the greylisting logic and return the
+    response text to send to Postfix.
+    """
     try:
-        sender = attrs["sender"]
-        recipient = attrs["recipient"]
-        client_name = attrs["client_name"]
+        clean_request(request)
+    except KeyError as err:
+        logger.error("Malformed request: Missing critical attribute: %s", err)
+        logger.warning("Returning PASS action")
+        _request_outcomes["malformed"] += 1
+        return response_pass
+    try:
+        response = process_request(request)
+    except sqlite3.OperationalError as err:
+        if not is_busy_error(err):
+            raise
+        logger.error("Giving up on request: %s", err)
+        logger.warning("Returning PASS action")
+        _request_outcomes["error"] += 1
+        return response_pass
+    except (OSError, RedisError) as err:
+        logger.error("Storage backend unavailable: %s", err)
+        logger.warning("Returning PASS action")
+        _request_outcomes["error"] += 1
+        return response_pass
+    if response == PASSED:
+        _request_outcomes["passed"] += 1
+        return response_pass
+    elif response == FAILED:
+        _request_outcomes["failed"] += 1
+        return response_fail
+    raise AssertionError("Programming error")
+
+GC_COUNTERS = (
+    ("passes",
+     "Garbage collection runs which had an expiry or size limit to enforce"),
+    ("chunks", "Garbage collection transactions"),
+    ("deleted", "Entries deleted by garbage collection"),
+    ("incomplete", "Garbage collection runs stopped by the time budget"),
+)
+
+def metrics_snapshot():
+    """
+    Return the metrics of this process as a JSON-serializable dict, see
+    :func:`render_metrics`.
+    """
+    backend = get_backend()
+    return {
+        "requests": dict(_request_outcomes),
+        "gc": {name: _gc_progress[name] for name, _ in GC_COUNTERS},
+        "entries": {listtype: backend.count(listtype)
+                    for listtype in ("greylist", "whitelist")},
+        "histograms": {key: [histogram.counts, histogram.sum]
+                       for key, histogram in _histograms.items()},
+    }
 
-        logger.debug("processing request: sender=%r, recipient=%r, client_name=%r",
-                      sender, recipient, client_name)
-        if _check_whitelist(dbconn, cursor, client_name):
-            return PASSED
+def merge_metrics(snapshots):
+    """
+    Add up the counters and histograms of several :func:`metrics_snapshot`
+    results. The entry counts are taken from the last snapshot having them.
+    """
+    merged = {
+        "requests": collections.Counter(),
+        "gc": collections.Counter(),
+        "entries": {},
+        "histograms": {},
+    }
+    for snapshot in snapshots:
+        merged["requests"].update(snapshot["requests"])
+        merged["gc"].update(snapshot["gc"])
+        merged["entries"] = snapshot["entries"] or merged["entries"]
+        for key, (counts, total) in snapshot["histograms"].items():
+            try:
+                merged_counts, merged_total = merged["histograms"][key]
+            except KeyError:
+                merged["histograms"][key] = [list(counts), total]
+                continue
+            merged["histograms"][key] = [
+                [a + b for a, b in zip(merged_counts, counts)],
+                merged_total + total]
+    return merged
 
-        return _check_greylist(dbconn, cursor, sender, recipient, client_name)
+def render_metrics(snapshot=None):
+    """
+    Return the metrics of this process (or *snapshot*, as returned by
+    :func:`metrics_snapshot`) in the Prometheus text format.
+    """
+    if snapshot is None:
+        snapshot = metrics_snapshot()
+    lines = [
+        "# HELP greylist_requests_total Policy requests by outcome",
+        "# TYPE greylist_requests_total counter",
+    ]
+    for outcome in ("passed", "failed", "malformed", "error"):
+        lines.append('greylist_requests_total{{outcome="{}"}} {}'.format(
+            outcome, snapshot["requests"].get(outcome, 0)))
+    for name, help in GC_COUNTERS:
+        lines += [
+            "# HELP greylist_gc_{}_total {}".format(name, help),
+            "# TYPE greylist_gc_{}_total counter".format(name),
+            "greylist_gc_{}_total {}".format(name,
+                                             snapshot["gc"].get(name, 0)),
+        ]
+    lines += [
+        "# HELP greylist_entries Entries in the lists",
+        "# TYPE greylist_entries gauge",
+    ]
+    for listtype, count in sorted(snapshot["entries"].items()):
+        lines.append('greylist_entries{{list="{}"}} {}'.format(
+            listtype, count))
+    for key, histogram in _histograms.items():
+        try:
+            counts, total = snapshot["histograms"][key]
+        except KeyError:
+            continue
+        observed = Histogram(histogram.name, histogram.help,
+                             histogram.buckets)
+        observed.counts, observed.sum = counts, total
+        lines += observed.format()
+    return "\n".join(lines) + "\n"
+
+def metrics_response(request_line, snapshot=None):
+    """
+    Return the HTTP response to a request for the metrics, given its first
+    line as bytes.
+    """
+    method, path, *_ = request_line.decode("latin-1").split() + ["", ""]
+    if method == "GET" and path.partition("?")[0] == "/metrics":
+        status = "200 OK"
+        body = render_metrics(snapshot).encode()
+    else:
+        status = "404 Not Found"
+        body = b"not found\n"
+    return ("HTTP/1.0 {}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            "Content-Length: {}\r\n"
+            "\r\n".format(status, len(body)).encode() + body)
+
+async def handle_connection(reader, writer):
+    """
+    Serve policy requests from a single Postfix connection until it is closed
+    by the peer. Any number of requests may be sent over one connection.
+    """
+    parser = RequestParser()
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                # connection closed, drop any incomplete request
+                return
+            for request in parser.feed(data):
+                if isinstance(request, ValueError):
+                    logger.error("Malformed request: %s", request)
+                    logger.warning("Returning PASS action")
+                    _request_outcomes["malformed"] += 1
+                    writer.write(response_pass.encode())
+                    await writer.drain()
+                    continue
+                response = await run_db(respond, request)
+                if commit_before_response:
+                    response = await group_commit(response)
+                writer.write(response.encode())
+                # make sure everything is flushed, before doing potentially
+                # time consuming GC work
+                await writer.drain()
+                if not commit_before_response:
+                    await group_commit(response)
+                await run_db(maybe_flush_db)
+                if not gc_background:
+                    await run_db(maybe_gc_db)
+    except ConnectionError as err:
+        logger.info("connection lost: %s", err)
+    except (OSError, RedisError) as err:
+        logger.error("closing connection: %s", err)
     finally:
-        cursor.close()
+        writer.close()
 
-def setup_db(dbconn):
+async def handle_metrics(reader, writer):
+    """
+    Answer a single HTTP request for the metrics, see :func:`render_metrics`.
+    """
+    try:
+        request_line = await reader.readline()
+        # skip the headers
+        while (await reader.readline()).strip():
+            pass
+        writer.write(await run_db(metrics_response, request_line))
+        await writer.drain()
+    except ConnectionError as err:
+        logger.info("metrics connection lost: %s", err)
+    finally:
+        writer.close()
+
+def remove_stale_socket(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            logger.info("removing stale socket at %s", path)
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+async def start_server(address, handler=handle_connection, sock=None):
+    """
+    Start listening for Postfix policy connections on *address*, as returned
+    by :func:`parse_listen_address`, and return the :class:`asyncio.Server`.
+    Connections are served by *handler*. If *sock* is given, it is used as the
+    already bound listening socket for *address*.
+    """
+    kind, addr = address
+    if kind == "unix":
+        if sock is None:
+            remove_stale_socket(addr)
+            server = await asyncio.start_unix_server(handler, path=addr)
+        else:
+            server = await asyncio.start_unix_server(handler, sock=sock)
+    else:
+        if sock is None:
+            host, port = addr
+            server = await asyncio.start_server(handler, host, port)
+        else:
+            server = await asyncio.start_server(handler, sock=sock)
+    logger.info("listening on %s:%s", kind, addr)
+    return server
+
+def bind_socket(address):
+    """
+    Return a non-blocking socket listening on *address*, as returned by
+    :func:`parse_listen_address`.
+    """
+    kind, addr = address
+    if kind == "unix":
+        remove_stale_socket(addr)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(addr)
+        sock.listen(socket.SOMAXCONN)
+    else:
+        host, port = addr
+        if host is None and socket.has_dualstack_ipv6():
+            sock = socket.create_server(("", port), family=socket.AF_INET6,
+                                        dualstack_ipv6=True)
+        else:
+            family = socket.AF_INET6 if ":" in (host or "") else socket.AF_INET
+            sock = socket.create_server((host or "", port), family=family)
+    sock.setblocking(False)
+    return sock
+
+def send_report(fd):
+    """
+    Send the metrics of this worker to the supervisor, see
+    :class:`Supervisor`.
+    """
+    # written at once, as a report is smaller than PIPE_BUF
+    try:
+        os.write(fd, json.dumps(metrics_snapshot()).encode() + b"\n")
+    except BlockingIOError:
+        # the supervisor is behind, it will get the next report
+        pass
+
+async def report_task(fd):
+    while True:
+        await asyncio.sleep(WORKER_REPORT_INTERVAL)
+        await run_db(send_report, fd)
+
+def serve(address, sock=None, worker=None):
+    """
+    Run the policy daemon on *address* until interrupted (SIGINT) or
+    terminated (SIGTERM).
+
+    If ``workers`` is larger than 1, a :class:`Supervisor` runs that many
+    processes instead, each of which calls this with the shared listening
+    socket *sock* and a ``(index, report_fd)`` tuple as *worker*.
+    """
+    if worker is None and workers > 1:
+        Supervisor(address, workers).run()
+        return
+
+    async def main():
+        global clock
+        loop = asyncio.get_running_loop()
+        clock = CachedClock(loop)
+        # open the storage once, before any client connects
+        if storage == "sqlite":
+            await run_db(get_dbs)
+        else:
+            await run_db(get_backend)
+        server = await start_server(address, sock=sock)
+        background = []
+        metrics_server = None
+        if worker is None:
+            if gc_background:
+                background.append(asyncio.ensure_future(gc_task()))
+            if metrics_listen is not None:
+                metrics_server = await start_server(
+                    parse_listen_address(metrics_listen), handle_metrics)
+        else:
+            index, report_fd = worker
+            # the workers share the database, one garbage collector is enough
+            if gc_background and index == 0:
+                background.append(asyncio.ensure_future(gc_task()))
+            background.append(asyncio.ensure_future(report_task(report_fd)))
+        # stop like on SIGINT, so that the storage is closed cleanly
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in background:
+                task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+            if worker is not None:
+                await run_db(send_report, report_fd)
+
+    global clock
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        # SIGTERM
+        pass
+    finally:
+        stop_db_executor()
+        # the cached clock cannot be used once the event loop is closed
+        clock = Clock()
+
+class Supervisor:
+    """
+    Runs *count* worker processes which serve policy requests from a shared
+    socket listening on *address*, restarts them when they die and adds up
+    their metrics.
+
+    Each worker reports its metrics (see :func:`metrics_snapshot`) through a
+    pipe every ``WORKER_REPORT_INTERVAL`` seconds and when it stops; the
+    supervisor serves their sum on ``metrics_listen``. The metrics of dead
+    workers are kept, so the counters do not go back on a restart.
+    """
+
+    def __init__(self, address, count):
+        if storage == "memory":
+            raise ValueError("The memory storage cannot be shared by workers")
+        self.address = address
+        self.count = count
+        self.sock = None
+        self.metrics_sock = None
+        self.selector = selectors.DefaultSelector()
+        # pid -> (index, read end of the report pipe, start time)
+        self.workers = {}
+        # read end of a report pipe -> incomplete report
+        self.buffers = {}
+        # index -> last report of the running worker
+        self.reports = {}
+        # sum of the last reports of the workers which have exited
+        self.retired = merge_metrics([])
+        self.stopping = False
+
+    def snapshot(self):
+        return merge_metrics([self.retired] + list(self.reports.values()))
+
+    def start_worker(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # keep only the policy socket and the report pipe
+                os.close(read_fd)
+                self.selector.close()
+                if self.metrics_sock is not None:
+                    self.metrics_sock.close()
+                for _, fd, _ in self.workers.values():
+                    os.close(fd)
+                # the supervisor stops the workers on SIGINT (e.g. from a
+                # terminal, which sends it to all processes)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.set_blocking(write_fd, False)
+                serve(self.address, self.sock, (index, write_fd))
+                status = 0
+            except BaseException:
+                logger.exception("worker %d failed", index)
+            finally:
+                close_db()
+                # never return into the code of the supervisor
+                os._exit(status)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self.workers[pid] = index, read_fd, time.monotonic()
+        self.selector.register(read_fd, selectors.EVENT_READ, index)
+        logger.info("started worker %d (pid %d)", index, pid)
+
+    def read_reports(self, fd, index):
+        data = self.buffers.pop(fd, b"")
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        *reports, self.buffers[fd] = data.split(b"\n")
+        if reports:
+            self.reports[index] = json.loads(reports[-1])
+
+    def reap(self, block=False):
+        """
+        Collect the workers which have exited and restart them, unless the
+        supervisor is stopping.
+        """
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index, fd, started = self.workers.pop(pid)
+            self.read_reports(fd, index)
+            self.selector.unregister(fd)
+            os.close(fd)
+            del self.buffers[fd]
+            self.retired = merge_metrics(
+                [self.retired, self.reports.pop(index, merge_metrics([]))])
+            if self.stopping:
+                continue
+            logger.error("worker %d (pid %d) exited with status %d",
+                         index, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                # do not fork in a tight loop if workers fail right away
+                time.sleep(WORKER_RESTART_DELAY)
+            self.start_worker(index)
+
+    def serve_metrics(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+        with conn:
+            conn.settimeout(1)
+            try:
+                f = conn.makefile("rb")
+                request_line = f.readline()
+                # skip the headers
+                while f.readline().strip():
+                    pass
+                conn.sendall(metrics_response(request_line, self.snapshot()))
+            except OSError as err:
+                logger.info("metrics connection lost: %s", err)
+
+    def run(self):
+        """
+        Run the workers until the supervisor gets SIGINT or SIGTERM.
+        """
+        if storage == "sqlite":
+            # set up the schema once, the workers open their own connections
+            get_dbs()
+        close_db()
+        self.sock = bind_socket(self.address)
+        logger.info("listening on %s:%s", *self.address)
+        if metrics_listen is not None:
+            self.metrics_sock = bind_socket(
+                parse_listen_address(metrics_listen))
+            self.selector.register(self.metrics_sock, selectors.EVENT_READ)
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for index in range(self.count):
+                self.start_worker(index)
+            while True:
+                for key, _ in self.selector.select(timeout=0.5):
+                    if key.fileobj is self.metrics_sock:
+                        self.serve_metrics(self.metrics_sock)
+                    else:
+                        self.read_reports(key.fd, key.data)
+                self.reap()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self.stopping = True
+            for pid in self.workers:
+                os.kill(pid, signal.SIGTERM)
+            self.reap(block=True)
+            self.selector.close()
+            self.sock.close()
+            if self.metrics_sock is not None:
+                self.metrics_sock.close()
+            totals = self.snapshot()["requests"]
+            logger.info("workers answered %d requests",
+                        sum(totals.values()))
+
+def get_schema_version():
+    """
+    Return the ``user_version`` of a database with the schema selected by
+    ``sqlite_compact_keys``.
+    """
+    return SCHEMA_VERSION + (COMPACT_KEYS_FLAG if sqlite_compact_keys else 0)
+
+def migrate_unversioned(dbconn):
+    """
+    Bring a database without a schema version, i.e. an empty one or one from
+    before the schema was versioned, to the current schema by comparing its
+    objects with it.
+    """
     try:
         verify_db(dbconn)
         logger.info("database schema verified successfully")
     except ValueError as err:
         logger.warning("database schema has errors: %s", err)
-        create_db(dbconn)
+        if not upgrade_db(dbconn):
+            raise ValueError("Database schema cannot be upgraded in place")
+
+# (version, function) pairs, ordered by version: each function migrates a
+# database from the previous version to its version in place, without losing
+# entries. They have to be idempotent, as the version is only recorded after
+# they have completed. Version 1 is the first versioned schema, databases
+# without a version are handled by migrate_unversioned().
+MIGRATIONS = []
+
+def setup_db(dbconn):
+    """
+    Make sure that the database has the current schema, using the version
+    recorded in it, and migrate it if necessary.
+    """
+    version, = dbconn.execute("PRAGMA user_version").fetchone()
+    expected = get_schema_version()
+    if version == expected:
+        logger.debug("database schema version %d", version)
+        return
+    number = version & ~COMPACT_KEYS_FLAG
+    if number > SCHEMA_VERSION:
+        raise ValueError("Database schema version {} is newer than {}".format(
+            number, SCHEMA_VERSION))
+    logger.info("migrating database schema from version %d to %d",
+                number, SCHEMA_VERSION)
+    if not number:
+        migrate_unversioned(dbconn)
+    else:
+        for target, migrate in MIGRATIONS:
+            if target > number:
+                logger.info("migrating database schema to version %d", target)
+                migrate(dbconn)
+    if number and (version ^ expected) & COMPACT_KEYS_FLAG:
+        # the keys are converted by upgrade_db()
+        if not upgrade_db(dbconn):
+            raise ValueError("Database schema cannot be upgraded in place")
+    dbconn.execute("PRAGMA user_version={:d}".format(expected))
+    dbconn.commit()
+
+def same_sql(sql, other):
+    """
+    Return whether the statements *sql* and *other* only differ in whitespace.
+    """
+    return (sql is not None and other is not None
+            and sql.split() == other.split())
+
+def _read_schema(dbconn):
+    # the tables of SQLite itself, e.g. sqlite_stat1, are not part of the
+    # schema
+    cursor = dbconn.execute(r"""SELECT type, name, sql FROM sqlite_master
+    WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite\_%' ESCAPE '\'""")
+    try:
+        return {(type_, name): sql for type_, name, sql in cursor}
+    finally:
+        cursor.close()
 
 def verify_db(dbconn):
-    cursor = dbconn.execute("SELECT * FROM SQLITE_MASTER")
+    schema = get_schema()
+    cursor = dbconn.execute(r"""SELECT * FROM sqlite_master
+    WHERE name NOT LIKE 'sqlite\_%' ESCAPE '\'""")
     try:
         found = set()
         for type_, name, _, _, sql in cursor:
             if sql is None:
                 continue
             try:
-                if sql != SCHEMA[(type_, name)]:
+                if not same_sql(sql, schema[(type_, name)]):
                     logger.warning("verifying: sql schema differs. found %r", sql)
-                    logger.info("verifying: expected %r", SCHEMA[(type_, name)])
+                    logger.info("verifying: expected %r", schema[(type_, name)])
                     raise ValueError("Schema differs")
             except KeyError as err:
                 raise ValueError("Unexpected {}: {}".format(type_, err))
             found.add(name)
-        missing = set(table
-                      for (type_, table) in SCHEMA.keys()
-                      if type_ == "table") - found
+        missing = set(name for (type_, name) in schema.keys()) - found
         if missing:
-            raise ValueError("Missing tables: {}".format(", ".join(missing)))
+            raise ValueError("Missing objects: {}".format(
+                ", ".join(sorted(missing))))
     finally:
         cursor.close()
 
@@ -423,6 +3510,20 @@ if __name__ == "__main__":
         configuration details please see the comments at the start of
         greylist.py"""
     )
+    parser.add_argument(
+        "-l", "--listen",
+        default=None,
+        type=parse_listen_address,
+        metavar="ADDRESS",
+        help="Run as a daemon, accepting connections on ADDRESS (either"
+        " unix:/path/to/socket or tcp:host:port) instead of reading a single"
+        " request stream from stdin")
+    parser.add_argument(
+        "--gc-only",
+        default=False,
+        action="store_true",
+        help="Only run garbage collection on the database and exit (e.g. from"
+        " cron)")
     parser.add_argument(
         "-c", "--config",
         default=None,
@@ -451,39 +3552,51 @@ if __name__ == "__main__":
     logger = logging.getLogger("greylist")
 
     if args.config is not None:
-        load_config(args.config)
+        load_config(args.config, daemon=args.listen is not None)
+
+    if args.gc_only:
+        gc_db()
+        close_db()
+        sys.exit(0)
 
     try:
+        if args.listen is not None:
+            serve(args.listen)
+            sys.exit(0)
+
+        parser = RequestParser()
+        stdin = sys.stdin.buffer
+        stdout = sys.stdout.buffer
+        # read1() returns whatever is available, like a socket
         while True:
-            try:
-                request = read_request(sys.stdin)
-                if request is None:
-                    break
-                if not request:
-                    # ignore empty requests
-                    continue
-                try:
-                    clean_request(request)
-                except KeyError as err:
-                    raise ValueError("Missing critical attribute: {}".format(err))
-            except ValueError as err:
-                logger.error("Malformed request: %s", err)
-                logger.warning("Returning PASS action")
-                print(response_pass)
-                continue
-            response = process_request(request)
-            if response == PASSED:
-                print(response_pass)
-            elif response == FAILED:
-                print(response_fail)
-            else:
-                raise AssertionError("Programming error")
-            # make sure everything is flushed, before doing potentially time
-            # consuming GC work
-            sys.stdout.flush()
-            gc_db()
+            data = stdin.read1(READ_SIZE)
+            if not data:
+                break
+            for request in parser.feed(data):
+                if isinstance(request, ValueError):
+                    logger.error("Malformed request: %s", request)
+                    logger.warning("Returning PASS action")
+                    _request_outcomes["malformed"] += 1
+                    response = response_pass
+                else:
+                    response = respond(request)
+                    # only a single request is processed at a time, so there
+                    # is nothing to wait for in a batch
+                    if commit_before_response:
+                        commit_batch()
+                # like print(), which was used before
+                stdout.write((response + "\n").encode())
+                # make sure everything is flushed, before doing potentially
+                # time consuming GC work
+                stdout.flush()
+                commit_batch()
+                maybe_flush_db()
+                maybe_gc_db()
     except KeyboardInterrupt:
         pass
+    finally:
+        # writes any coalesced updates
+        close_db()
 
 else:
     # defer configuration of logger until the end
@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-from datetime import datetime, timedelta
+#%# capabilities=multigraph
 import os
 import stat
 
@@ -27,10 +27,10 @@ def do_config_greylist():
     print("total.draw LINE2")
     print("total.info Total entries in the greylist")
 
-def do_data_greylist(cursor):
-    active = get_active_greylist(cursor)
-    total = get_total("greylist", cursor)
-    dead = get_dead_greylist(cursor)
+def do_data_greylist(stats):
+    active = stats["active_greylist"]
+    total = stats["total_greylist"]
+    dead = stats["dead_greylist"]
     print("dead.value {}".format(dead))
     print("active.value {}".format(active))
     print("inactive.value {}".format(total-(active+dead)))
@@ -53,10 +53,10 @@ def do_config_whitelist():
     print("total.draw LINE2")
     print("total.info Total entries in the greylist")
 
-def do_data_whitelist(cursor):
-    active = get_active_whitelist(cursor)
-    pending = get_pending_whitelist(cursor)
-    total = get_total("whitelist", cursor)
+def do_data_whitelist(stats):
+    active = stats["active_whitelist"]
+    pending = stats["pending_whitelist"]
+    total = stats["total_whitelist"]
     print("active.value {}".format(active))
     print("inactive.value {}".format(total-(active+pending)))
     print("pending.value {}".format(pending))
@@ -76,11 +76,9 @@ def do_config_overview():
     print("whitelist.draw LINE2")
     print("whitelist.info Amount of entries in the whitelist")
 
-def do_data_overview(cursor):
-    print("greylist.value {}".format(
-        get_total("greylist", cursor)))
-    print("whitelist.value {}".format(
-        get_total("whitelist", cursor)))
+def do_data_overview(stats):
+    print("greylist.value {}".format(stats["total_greylist"]))
+    print("whitelist.value {}".format(stats["total_whitelist"]))
 
 def do_config_size():
     print("graph_title greylisting database size")
@@ -93,8 +91,8 @@ def do_config_size():
     print("size.draw LINE1")
     print("size.info Size of the SQLite file")
 
-def do_data_size(cursor):
-    print("size.value {}".format(get_db_size()))
+def do_data_size(stats):
+    print("size.value {}".format(stats["db_size"]))
 
 def do_config_client_names():
     print("graph_title Distinct client names")
@@ -106,9 +104,9 @@ def do_config_client_names():
     print("clientnames.draw LINE1")
     print("clientnames.info Distinct client names in the greylisting component")
 
-def do_data_client_names(cursor):
+def do_data_client_names(stats):
     print("clientnames.value {}".format(
-        get_distinct_client_names(cursor)))
+        stats["distinct_greylist_client_names"]))
 
 def do_config_overhead():
     print("graph_title Greylist database overhead")
@@ -121,64 +119,71 @@ def do_config_overhead():
     print("efficiency.draw LINE1")
     print("efficiency.info Ratio of database size and entry count.")
 
-def do_data_overhead(cursor):
-    count = get_total("greylist", cursor) + get_total("whitelist", cursor)
-    efficiency = get_db_size() / count
+def do_data_overhead(stats):
+    count = stats["total_greylist"] + stats["total_whitelist"]
+    if not count:
+        # unknown, rather than failing the other graphs of a multigraph run
+        print("efficiency.value U")
+        return
+    efficiency = stats["db_size"] / count
     print("efficiency.value {:.4f}".format(efficiency))
 
-def get_total(listtype, cursor):
-    # listtype is not direct user input, so format is safe here
-    total, = cursor.execute(
-        """SELECT COUNT(*) FROM {}""".format(listtype)).fetchone()
-    return total
-
-def get_active_greylist(cursor):
-    now = datetime.utcnow()
-    active, = cursor.execute(
-        """SELECT COUNT(*) FROM greylist
-        WHERE (julianday(?) - julianday(last_seen)) * 86400.0 <= ?""",
-        (now, greylist.stats_active_threshold)).fetchone()
-    return active
-
-def get_active_whitelist(cursor):
-    now = datetime.utcnow()
-    active, = cursor.execute(
-        """SELECT COUNT(*) FROM whitelist
-        WHERE (julianday(?) - julianday(last_seen)) * 86400.0 <= ?
-        AND hit_count >= ?""",
-        (now,
-         greylist.stats_active_threshold,
-         greylist.auto_whitelist_threshold)).fetchone()
-    return active
-
-def get_dead_greylist(cursor):
-    now = datetime.utcnow()
-    dead, = cursor.execute(
-        """SELECT COUNT(*) FROM greylist
-        WHERE (julianday(?) - julianday(last_seen)) * 86400.0 >= ?
-        AND last_seen = first_seen""",
-        (now,
-         greylist.stats_dead_threshold)).fetchone()
-    return dead
-
-def get_pending_whitelist(cursor):
-    pending, = cursor.execute(
-        """SELECT COUNT(*) FROM whitelist
-        WHERE hit_count < ?""",
-        (greylist.auto_whitelist_threshold,)).fetchone()
-    return pending
-
-def get_distinct_client_names(cursor):
-    count, = cursor.execute(
-        """SELECT COUNT(*) FROM (
-        SELECT COUNT(*) FROM greylist GROUP BY client_name
-        )""").fetchone()
-    return count
+def sum_rows(cursors, sql, args=()):
+    """
+    Run the aggregate query *sql* on all databases (see
+    ``greylist.sqlite_shards``) and return the column-wise sums.
+    """
+    totals = None
+    for cursor in cursors:
+        # SUM() is NULL on an empty table
+        row = [value or 0 for value in cursor.execute(sql, args).fetchone()]
+        totals = row if totals is None else [
+            a + b for a, b in zip(totals, row)]
+    return totals
+
+def collect_stats(cursors):
+    """
+    Return all figures shown by the graphs, as a dict. Each table is scanned
+    only once.
+    """
+    now = greylist.clock.time()
+    # without a threshold, the cutoff is NULL and nothing is counted
+    active_cutoff = dead_cutoff = None
+    if greylist.stats_active_threshold is not None:
+        active_cutoff = now - greylist.stats_active_threshold
+    if greylist.stats_dead_threshold is not None:
+        dead_cutoff = now - greylist.stats_dead_threshold
+    stats = {}
+    (stats["total_greylist"],
+     stats["active_greylist"],
+     stats["dead_greylist"]) = sum_rows(
+         cursors,
+         """SELECT COUNT(*),
+         SUM(last_seen >= ?),
+         SUM(last_seen <= ? AND last_seen = first_seen)
+         FROM greylist""",
+         (active_cutoff, dead_cutoff))
+    (stats["total_whitelist"],
+     stats["active_whitelist"],
+     stats["pending_whitelist"]) = sum_rows(
+         cursors,
+         """SELECT COUNT(*),
+         SUM(last_seen >= ? AND hit_count >= ?),
+         SUM(hit_count < ?)
+         FROM whitelist""",
+         (active_cutoff,
+          greylist.auto_whitelist_threshold,
+          greylist.auto_whitelist_threshold))
+    # each client name is stored in a single shard only
+    stats["distinct_greylist_client_names"], = sum_rows(
+        cursors,
+        """SELECT COUNT(*) FROM greylist_client_counts""")
+    stats["db_size"] = get_db_size()
+    return stats
 
 def get_db_size():
     greylist.close_db()
-    st = os.stat(greylist.db_file)
-    return st.st_size
+    return sum(os.stat(path).st_size for path in greylist.db_files())
 
 graph_types = {
     "greylist": (do_config_greylist, do_data_greylist),
@@ -254,30 +259,34 @@ if __name__ == "__main__":
                 logger.error("invalid filename: %s", filename)
                 sys.exit(1)
 
-        try:
-            config_handler, data_handler = graph_types[graph_type]
-        except KeyError as err:
-            logger.error("unknown graph type: %s", err)
-            sys.exit(1)
+        if graph_type == "multigraph":
+            if os.environ.get("MUNIN_CAP_MULTIGRAPH") != "1":
+                logger.error("munin-node does not support multigraph")
+                sys.exit(1)
+            handlers = {"greylisting_" + name: handlers
+                        for name, handlers in graph_types.items()}
+        else:
+            try:
+                handlers = {None: graph_types[graph_type]}
+            except KeyError as err:
+                logger.error("unknown graph type: %s", err)
+                sys.exit(1)
 
         if args.munin_command == "config":
-            config_handler()
+            for name, (config_handler, _) in handlers.items():
+                if name is not None:
+                    print("multigraph {}".format(name))
+                config_handler()
             sys.exit(0)
 
-        dbconn = greylist.get_db()
-        cursor = dbconn.cursor()
-        data_handler(cursor)
+        stats = collect_stats(
+            [dbconn.cursor() for dbconn in greylist.get_dbs()])
+        for name, (_, data_handler) in handlers.items():
+            if name is not None:
+                print("multigraph {}".format(name))
+            data_handler(stats)
         sys.exit(0)
 
-    dbconn = greylist.get_db()
-    cursor = dbconn.cursor()
-
-    print("total_greylist {}".format(get_total("greylist", cursor)))
-    print("active_greylist {}".format(get_active_greylist(cursor)))
-    print("dead_greylist {}".format(get_dead_greylist(cursor)))
-    print("total_whitelist {}".format(get_total("whitelist", cursor)))
-    print("active_whitelist {}".format(get_active_whitelist(cursor)))
-    print("pending_whitelist {}".format(get_pending_whitelist(cursor)))
-    print("distinct_greylist_client_names {}".format(
-        get_distinct_client_names(cursor)))
-    print("db_size {}".format(get_db_size()))
+    stats = collect_stats([dbconn.cursor() for dbconn in greylist.get_dbs()])
+    for key, value in stats.items():
+        print("{} {}".format(key, value))
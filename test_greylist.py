@@ -1,3 +1,11 @@
+import asyncio
+import contextlib
+import io
+import os
+import socketserver
+import sqlite3
+import tempfile
+import threading
 import time
 import unittest
 
@@ -6,6 +14,7 @@ greylist.db_file = ":memory:"
 
 class TestGreylist(unittest.TestCase):
     def setUp(self):
+        self.clock = greylist.clock = greylist.VirtualClock()
         greylist.get_db()
 
     def test_greylisting(self):
@@ -21,7 +30,7 @@ class TestGreylist(unittest.TestCase):
             greylist.FAILED,
             greylist.process_request(request))
 
-        time.sleep(1)
+        self.clock.advance(1)
 
         self.assertEqual(
             greylist.PASSED,
@@ -47,7 +56,7 @@ class TestGreylist(unittest.TestCase):
             greylist.FAILED,
             greylist.process_request(request))
 
-        time.sleep(1)
+        self.clock.advance(1)
 
         self.assertEqual(
             greylist.PASSED,
@@ -82,7 +91,7 @@ class TestGreylist(unittest.TestCase):
             greylist.FAILED,
             greylist.process_request(request))
 
-        time.sleep(1)
+        self.clock.advance(1)
 
         self.assertEqual(
             greylist.PASSED,
@@ -98,5 +107,2011 @@ class TestGreylist(unittest.TestCase):
                 "SELECT COUNT(*) FROM greylist")))
 
 
+    def test_single_commit_per_request(self):
+        request = {
+            "client_name": "example.com",
+            "sender": "foo@dom1.example.com",
+            "recipient": "bar@dom2.example.com"
+        }
+
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 1
+
+        statements = []
+        greylist.get_db().set_trace_callback(statements.append)
+        for i in range(3):
+            greylist.process_request(request)
+        self.assertEqual(
+            3,
+            sum(sql == "COMMIT" for sql in statements))
+
+    def test_without_returning(self):
+        request = {
+            "client_name": "example.com",
+            "sender": "foo@dom1.example.com",
+            "recipient": "bar@dom2.example.com"
+        }
+
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 1
+        greylist.move_to_whitelist = True
+        greylist.HAVE_RETURNING = False
+        try:
+            for i in range(3):
+                self.assertEqual(
+                    greylist.PASSED,
+                    greylist.process_request(request))
+        finally:
+            greylist.HAVE_RETURNING = True
+
+        self.assertSequenceEqual(
+            [(0, 3)],
+            list(greylist.get_db().execute(
+                """SELECT (SELECT COUNT(*) FROM greylist),
+                (SELECT hit_count FROM whitelist)""")))
+
+    def test_expiry_over_a_week(self):
+        greylist.greylist_timeout = 300
+        greylist.greylist_expire = 86400
+        greylist.auto_whitelist_threshold = None
+        try:
+            # a new key every hour, each retried once after ten minutes
+            for hour in range(7 * 24):
+                request = {
+                    "client_name": "example.com",
+                    "sender": "foo{}@dom1.example.com".format(hour),
+                    "recipient": "bar@dom2.example.com"
+                }
+                self.assertEqual(greylist.FAILED,
+                                 greylist.process_request(request))
+                self.clock.advance(600)
+                self.assertEqual(greylist.PASSED,
+                                 greylist.process_request(request))
+                self.clock.advance(3000)
+                greylist.gc_db()
+        finally:
+            greylist.greylist_expire = None
+        self.assertEqual(
+            24, greylist.get_count(greylist.get_db().cursor(), "greylist"))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.clock = greylist.Clock()
+
+class TestWhitelistCache(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        self.dbconn = greylist.get_db()
+        greylist.whitelist_cache_size = 2
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 1
+
+    def test_cached_hits_skip_database(self):
+        # pass the greylist, then get whitelisted
+        for i in range(2):
+            greylist.process_request(self.request)
+
+        statements = []
+        self.dbconn.set_trace_callback(statements.append)
+        for i in range(5):
+            self.assertEqual(
+                greylist.PASSED,
+                greylist.process_request(self.request))
+        self.assertSequenceEqual([], statements)
+        self.dbconn.set_trace_callback(None)
+
+        greylist.flush_db()
+        self.assertSequenceEqual(
+            [(7,)],
+            list(self.dbconn.execute("SELECT hit_count FROM whitelist")))
+
+    def test_cache_is_bounded(self):
+        for client_name in ("a.example", "b.example", "c.example"):
+            request = dict(self.request, client_name=client_name)
+            for i in range(2):
+                greylist.process_request(request)
+        self.assertSequenceEqual(
+            ["b.example", "c.example"],
+            list(greylist._whitelist_cache))
+
+    def test_gc_invalidates_cache(self):
+        for i in range(2):
+            greylist.process_request(self.request)
+        greylist.max_whitelist_entries = 0
+        try:
+            greylist.gc_db()
+        finally:
+            greylist.max_whitelist_entries = 1000
+        greylist.greylist_timeout = 100
+        self.assertEqual(
+            greylist.FAILED,
+            greylist.process_request(dict(self.request, recipient="x@y")))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.whitelist_cache_size = None
+        greylist._whitelist_cache.clear()
+        greylist.auto_whitelist_threshold = 10
+
+class TestGreylistCache(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        self.dbconn = greylist.get_db()
+        greylist.greylist_cache_size = 2
+        greylist.greylist_timeout = 100
+
+    def test_retries_skip_database(self):
+        self.assertEqual(
+            greylist.FAILED,
+            greylist.process_request(self.request))
+
+        statements = []
+        self.dbconn.set_trace_callback(statements.append)
+        for i in range(5):
+            self.assertEqual(
+                greylist.FAILED,
+                greylist.process_request(self.request))
+        self.assertSequenceEqual([], statements)
+
+        greylist.flush_db()
+        self.assertTrue(any(sql.startswith("UPDATE greylist")
+                            for sql in statements))
+        self.dbconn.set_trace_callback(None)
+
+        # once the timeout has passed, the database decides again
+        greylist.greylist_timeout = 0
+        self.assertEqual(
+            greylist.PASSED,
+            greylist.process_request(self.request))
+        self.assertNotIn(
+            ("example.com", "foo@dom1.example.com", "bar@dom2.example.com"),
+            greylist._greylist_cache)
+
+    def test_cache_is_bounded(self):
+        for recipient in ("a@example.com", "b@example.com", "c@example.com"):
+            greylist.process_request(dict(self.request, recipient=recipient))
+        self.assertSequenceEqual(
+            ["b@example.com", "c@example.com"],
+            [recipient for _, _, recipient in greylist._greylist_cache])
+        self.assertEqual(
+            {"example.com": set(greylist._greylist_cache)},
+            greylist._greylist_cache_clients)
+
+    def test_whitelisting_drops_cached_keys(self):
+        greylist.auto_whitelist_threshold = 1
+        retry = dict(self.request, recipient="b@example.com")
+        self.assertEqual(
+            greylist.FAILED,
+            greylist.process_request(retry))
+        # another key of the client passes greylisting and whitelists it
+        backend = greylist.get_backend()
+        backend.atomic(
+            backend.upsert_greylist,
+            ("example.com", "foo@dom1.example.com", "a@example.com"),
+            int(time.time()) - 200)
+        self.assertEqual(
+            greylist.PASSED,
+            greylist.process_request(
+                dict(self.request, recipient="a@example.com")))
+        self.assertEqual(
+            greylist.PASSED,
+            greylist.process_request(retry))
+        self.assertEqual({}, greylist._greylist_cache_clients)
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.greylist_cache_size = None
+        greylist.auto_whitelist_threshold = 10
+        greylist._clear_greylist_cache()
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self.dbconn = greylist.get_db()
+        self.statements = []
+        self.dbconn.set_trace_callback(self.statements.append)
+        greylist.greylist_timeout = 100
+
+    def _request(self, i):
+        return ("client_name=example.com\n"
+                "client_address=192.0.2.1\n"
+                "sender=foo@dom1.example.com\n"
+                "recipient=bar{}@dom2.example.com\n"
+                "\n".format(i)).encode()
+
+    def _run_clients(self, count):
+        async def client(host, port, i):
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(self._request(i))
+            response = await reader.readuntil(b"\n\n")
+            writer.close()
+            return response
+
+        async def run():
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)))
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                return await asyncio.gather(*(client(host, port, i)
+                                              for i in range(count)))
+
+        return asyncio.run(run())
+
+    def _commits(self):
+        return sum(sql == "COMMIT" for sql in self.statements)
+
+    def test_batch_size(self):
+        greylist.commit_batch_size = 4
+        greylist.commit_batch_interval = 10000
+        responses = self._run_clients(4)
+        self.assertSequenceEqual(
+            [greylist.response_fail.encode()] * 4,
+            responses)
+        self.assertEqual(1, self._commits())
+        self.assertEqual(4, greylist.get_count(self.dbconn.cursor(),
+                                               "greylist"))
+
+    def test_batch_interval(self):
+        greylist.commit_batch_size = 100
+        greylist.commit_batch_interval = 20
+        responses = self._run_clients(3)
+        self.assertSequenceEqual(
+            [greylist.response_fail.encode()] * 3,
+            responses)
+        self.assertEqual(1, self._commits())
+        self.assertFalse(self.dbconn.in_transaction)
+
+    def test_respond_first(self):
+        greylist.commit_before_response = False
+        for i in range(3):
+            greylist.process_request({
+                "client_name": "example.com",
+                "sender": "foo@dom1.example.com",
+                "recipient": "bar{}@dom2.example.com".format(i),
+            })
+        self.assertTrue(self.dbconn.in_transaction)
+        self.assertEqual(0, self._commits())
+        greylist.commit_batch()
+        self.assertEqual(1, self._commits())
+
+    def test_commit_off_event_loop(self):
+        greylist.commit_batch_size = 100
+        greylist.commit_batch_interval = 20
+        commit_batch = greylist.commit_batch
+
+        def slow_commit_batch():
+            # like retrying the commit of a locked database
+            time.sleep(0.3)
+            commit_batch()
+
+        async def run():
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)))
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(self._request(0))
+                response = asyncio.ensure_future(reader.readuntil(b"\n\n"))
+                ticks = 0
+                while not response.done():
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+                writer.close()
+                return response.result(), ticks
+
+        greylist.commit_batch = slow_commit_batch
+        try:
+            response, ticks = asyncio.run(run())
+        finally:
+            greylist.commit_batch = commit_batch
+        self.assertEqual(greylist.response_fail.encode(), response)
+        self.assertEqual(1, self._commits())
+        self.assertGreater(ticks, 5)
+
+    def tearDown(self):
+        self.dbconn.set_trace_callback(None)
+        greylist.close_db()
+        greylist.commit_batch_size = 1
+        greylist.commit_batch_interval = 10
+        greylist.commit_before_response = True
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        greylist.get_db()
+
+    def test_parse_listen_address(self):
+        self.assertEqual(
+            ("unix", "/run/greylist.sock"),
+            greylist.parse_listen_address("unix:/run/greylist.sock"))
+        self.assertEqual(
+            ("tcp", ("127.0.0.1", 10023)),
+            greylist.parse_listen_address("tcp:127.0.0.1:10023"))
+        self.assertEqual(
+            ("tcp", ("::1", 10023)),
+            greylist.parse_listen_address("tcp:[::1]:10023"))
+        with self.assertRaises(ValueError):
+            greylist.parse_listen_address("tcp:localhost")
+
+    def test_multiple_requests_per_connection(self):
+        greylist.greylist_timeout = 100
+        greylist.auto_whitelist_threshold = 10
+
+        request = (b"request=smtpd_access_policy\n"
+                   b"client_name=example.com\n"
+                   b"client_address=192.0.2.1\n"
+                   b"sender=foo@dom1.example.com\n"
+                   b"recipient=bar@dom2.example.com\n"
+                   b"\n")
+
+        async def run():
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)))
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(request + b"garbage\n\n" + request)
+                responses = [await reader.readuntil(b"\n\n")
+                             for i in range(3)]
+                writer.close()
+                return responses
+
+        self.assertSequenceEqual(
+            [greylist.response_fail.encode(),
+             greylist.response_pass.encode(),
+             greylist.response_fail.encode()],
+            asyncio.run(run()))
+
+    def tearDown(self):
+        greylist.close_db()
+
+class TestGCScheduling(unittest.TestCase):
+    def setUp(self):
+        self._saved = (greylist.gc_interval_requests, greylist.gc_interval)
+        self.runs = 0
+        self._gc_db = greylist.gc_db
+        greylist.gc_db = self._count_gc
+        greylist._gc_requests = 0
+        greylist._gc_last_run = None
+
+    def _count_gc(self):
+        self.runs += 1
+
+    def test_every_n_requests(self):
+        greylist.gc_interval_requests = 3
+        greylist.gc_interval = None
+        for i in range(7):
+            greylist.maybe_gc_db()
+        self.assertEqual(2, self.runs)
+
+    def test_every_t_seconds(self):
+        greylist.gc_interval_requests = None
+        greylist.gc_interval = 3600
+        for i in range(5):
+            greylist.maybe_gc_db()
+        self.assertEqual(1, self.runs)
+
+    def test_disabled(self):
+        greylist.gc_interval_requests = None
+        greylist.gc_interval = None
+        for i in range(5):
+            greylist.maybe_gc_db()
+        self.assertEqual(0, self.runs)
+
+    def tearDown(self):
+        greylist.gc_db = self._gc_db
+        greylist.gc_interval_requests, greylist.gc_interval = self._saved
+
+class TestCounters(unittest.TestCase):
+    def setUp(self):
+        self.dbconn = greylist.get_db()
+
+    def _assert_counts_consistent(self):
+        cursor = self.dbconn.cursor()
+        for listtype in ("greylist", "whitelist"):
+            actual, = cursor.execute(
+                "SELECT COUNT(*) FROM {}".format(listtype)).fetchone()
+            self.assertEqual(actual, greylist.get_count(cursor, listtype))
+        self.assertSequenceEqual(
+            list(cursor.execute("""SELECT client_name, COUNT(*) FROM greylist
+            GROUP BY client_name ORDER BY client_name""")),
+            list(cursor.execute("""SELECT client_name, count
+            FROM greylist_client_counts ORDER BY client_name""")))
+
+    def test_counters_follow_gc(self):
+        greylist.max_greylist_entries = 5
+        greylist.max_greylist_entries_per_client_name = 2
+        greylist.max_whitelist_entries = 1
+
+        for i in range(4):
+            for client_name in ("a.example", "b.example"):
+                greylist.process_request({
+                    "client_name": client_name,
+                    "sender": "foo{}@dom1.example.com".format(i),
+                    "recipient": "bar@dom2.example.com"
+                })
+        self.dbconn.execute("""INSERT INTO whitelist
+        (client_name, last_seen, hit_count) VALUES
+        ('a.example', 946684800, 1),
+        ('b.example', 946684800, 1)""")
+        self._assert_counts_consistent()
+
+        greylist.gc_db()
+        self._assert_counts_consistent()
+        cursor = self.dbconn.cursor()
+        self.assertEqual(4, greylist.get_count(cursor, "greylist"))
+        self.assertEqual(1, greylist.get_count(cursor, "whitelist"))
+
+    def test_upgrade_keeps_data(self):
+        greylist.close_db()
+        dbconn = sqlite3.connect(":memory:",
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+        for key in (("table", "whitelist"), ("table", "greylist")):
+            dbconn.execute(greylist.SCHEMA[key])
+        # index created on the wrong table by earlier versions
+        dbconn.execute(
+            "CREATE INDEX whitelist_last_seen ON greylist (last_seen)")
+        dbconn.execute("""INSERT INTO greylist
+        (client_name, sender, recipient, first_seen, last_seen) VALUES
+        ('a.example', 'foo@example.com', 'bar@example.com',
+         946684800, 946684800)""")
+        dbconn.commit()
+
+        greylist.setup_db(dbconn)
+        greylist.verify_db(dbconn)
+        self.assertEqual(1, greylist.get_count(dbconn.cursor(), "greylist"))
+        dbconn.close()
+
+    def test_migrate_text_timestamps(self):
+        greylist.close_db()
+        dbconn = sqlite3.connect(":memory:",
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+        for sql in greylist.LEGACY_SCHEMA.values():
+            dbconn.execute(sql)
+        dbconn.execute("""CREATE INDEX greylist_last_seen ON greylist
+(last_seen)""")
+        dbconn.execute("""INSERT INTO greylist
+        (client_name, sender, recipient, first_seen, last_seen) VALUES
+        ('a.example', 'foo@example.com', 'bar@example.com',
+         '2000-01-01 00:00:00', '2000-01-01 00:01:00.123456')""")
+        dbconn.execute("""INSERT INTO whitelist
+        (client_name, last_seen, hit_count) VALUES
+        ('a.example', '2000-01-01 00:02:00', 3)""")
+        dbconn.commit()
+
+        greylist.setup_db(dbconn)
+        greylist.verify_db(dbconn)
+        self.assertSequenceEqual(
+            [("a.example", 946684800, 946684860)],
+            list(dbconn.execute("""SELECT client_name, first_seen, last_seen
+            FROM greylist""")))
+        self.assertSequenceEqual(
+            [("a.example", 946684920, 3)],
+            list(dbconn.execute("""SELECT client_name, last_seen, hit_count
+            FROM whitelist""")))
+        self.assertEqual(1, greylist.get_count(dbconn.cursor(), "greylist"))
+        self.assertEqual(1, greylist.get_count(dbconn.cursor(), "whitelist"))
+        dbconn.close()
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.max_greylist_entries = 100000
+        greylist.max_greylist_entries_per_client_name = 1000
+        greylist.max_whitelist_entries = 1000
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        self.dbconn = greylist.get_db()
+        self.statements = []
+
+    def _trace(self, sql):
+        # statements run by triggers are reported as comments
+        if sql.lstrip().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+            self.statements.append(sql)
+
+    def test_hot_queries_use_indices(self):
+        greylist.greylist_timeout = 0
+        greylist.greylist_expire = 3600
+        greylist.whitelist_expire = 3600
+        greylist.max_greylist_entries = 1
+        greylist.max_greylist_entries_per_client_name = 1
+        greylist.max_whitelist_entries = 1
+
+        self.dbconn.set_trace_callback(self._trace)
+        # first fill the greylist, then let the clients get whitelisted
+        for auto_whitelist_threshold in (None, 1):
+            greylist.auto_whitelist_threshold = auto_whitelist_threshold
+            for client_name in ("a.example", "b.example"):
+                for recipient in ("foo@example.com", "bar@example.com"):
+                    request = {
+                        "client_name": client_name,
+                        "sender": "sender@example.com",
+                        "recipient": recipient,
+                    }
+                    greylist.process_request(request)
+                    greylist.process_request(request)
+            greylist.gc_db()
+        self.dbconn.set_trace_callback(None)
+
+        self.assertTrue(self.statements)
+        for sql in self.statements:
+            plan = [detail
+                    for *_, detail in self.dbconn.execute(
+                        "EXPLAIN QUERY PLAN " + sql)]
+            for detail in plan:
+                self.assertFalse(
+                    detail.startswith("SCAN") and "USING" not in detail,
+                    "full table scan in {!r}: {}".format(sql, plan))
+                self.assertNotIn(
+                    "TEMP B-TREE", detail,
+                    "full sort in {!r}: {}".format(sql, plan))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.auto_whitelist_threshold = 10
+        greylist.greylist_expire = None
+        greylist.whitelist_expire = None
+        greylist.max_greylist_entries = 100000
+        greylist.max_greylist_entries_per_client_name = 1000
+        greylist.max_whitelist_entries = 1000
+
+class TestLocking(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "client_address": "192.0.2.1",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self._saved = (greylist.db_file, greylist.sqlite_journal_mode,
+                       greylist.sqlite_busy_timeout, greylist.write_retries,
+                       greylist.write_retry_backoff)
+        greylist.db_file = os.path.join(self.tmpdir.name, "greylist.db")
+        greylist.sqlite_journal_mode = "wal"
+        greylist.sqlite_busy_timeout = 0
+        greylist.write_retry_backoff = 0.02
+        greylist.greylist_timeout = 100
+        greylist.get_db()
+
+    def _lock_db(self, duration):
+        locked = threading.Event()
+
+        def hold_lock():
+            dbconn = sqlite3.connect(greylist.db_file)
+            dbconn.execute("BEGIN IMMEDIATE")
+            locked.set()
+            time.sleep(duration)
+            dbconn.commit()
+            dbconn.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        return thread
+
+    def test_wal_enabled(self):
+        mode, = greylist.get_db().execute("PRAGMA journal_mode").fetchone()
+        self.assertEqual("wal", mode)
+
+    def test_retry_until_unlocked(self):
+        greylist.write_retries = 10
+        thread = self._lock_db(0.1)
+        try:
+            self.assertEqual(
+                greylist.response_fail,
+                greylist.respond(dict(self.request)))
+        finally:
+            thread.join()
+
+    def test_pass_if_locked(self):
+        greylist.write_retries = 1
+        thread = self._lock_db(0.5)
+        try:
+            self.assertEqual(
+                greylist.response_pass,
+                greylist.respond(dict(self.request)))
+        finally:
+            thread.join()
+
+    def test_daemon_keeps_running_while_locked(self):
+        greylist.write_retries = 10
+        request = "".join("{}={}\n".format(*item)
+                          for item in self.request.items()) + "\n"
+
+        async def run():
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)))
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(request.encode())
+                response = asyncio.ensure_future(reader.readuntil(b"\n\n"))
+                ticks = 0
+                while not response.done():
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+                writer.close()
+                return response.result(), ticks
+
+        thread = self._lock_db(0.3)
+        try:
+            response, ticks = asyncio.run(run())
+        finally:
+            thread.join()
+        self.assertEqual(greylist.response_fail.encode(), response)
+        # the event loop was not blocked by the retries
+        self.assertGreater(ticks, 5)
+
+    def tearDown(self):
+        greylist.close_db()
+        (greylist.db_file, greylist.sqlite_journal_mode,
+         greylist.sqlite_busy_timeout, greylist.write_retries,
+         greylist.write_retry_backoff) = self._saved
+        self.tmpdir.cleanup()
+
+class TestMemoryBackend(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self._saved = greylist.db_file
+        greylist.storage = "memory"
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 1
+        greylist.move_to_whitelist = True
+
+    def test_whitelisting(self):
+        backend = greylist.get_backend()
+        self.assertIsInstance(backend, greylist.MemoryBackend)
+        for i in range(3):
+            self.assertEqual(
+                greylist.PASSED,
+                greylist.process_request(self.request))
+        self.assertEqual({}, backend.greylist)
+        self.assertEqual([3], backend.whitelist["example.com"][:1])
+
+    def test_gc(self):
+        greylist.auto_whitelist_threshold = None
+        greylist.greylist_timeout = 100
+        greylist.max_greylist_entries = 3
+        greylist.max_greylist_entries_per_client_name = 2
+        try:
+            for client_name in ("a.example", "b.example"):
+                for i in range(3):
+                    greylist.process_request(dict(
+                        self.request,
+                        client_name=client_name,
+                        recipient="bar{}@example.com".format(i)))
+            greylist.gc_db()
+        finally:
+            greylist.max_greylist_entries = 100000
+            greylist.max_greylist_entries_per_client_name = 1000
+        backend = greylist.get_backend()
+        self.assertEqual(3, backend.count("greylist"))
+        self.assertEqual(
+            [2, 1],
+            sorted((len(keys) for keys in backend.clients.values()),
+                   reverse=True))
+
+    def test_snapshot_and_log(self):
+        greylist.db_file = os.path.join(self.tmpdir.name, "greylist")
+        greylist.auto_whitelist_threshold = 10
+        greylist.process_request(self.request)
+        greylist.close_db()
+        self.assertTrue(os.path.exists(greylist.db_file + ".snapshot"))
+
+        # changes after the snapshot are only in the log
+        greylist.process_request(dict(self.request, client_name="a.example"))
+        greylist.get_backend().sync()
+        restored = greylist.MemoryBackend(
+            snapshot_file=greylist.db_file + ".snapshot",
+            log_file=greylist.db_file + ".log")
+        self.assertEqual(
+            {"example.com": [1, restored.whitelist["example.com"][1]],
+             "a.example": [1, restored.whitelist["a.example"][1]]},
+            restored.whitelist)
+        self.assertEqual(2, restored.count("greylist"))
+        restored.close()
+
+    def test_daemon(self):
+        import bench
+        import signal
+        db_file = os.path.join(self.tmpdir.name, "greylist.db")
+        config_file = os.path.join(self.tmpdir.name, "config.ini")
+        with open(config_file, "w") as f:
+            f.write("[DEFAULT]\n"
+                    "storage = memory\n"
+                    "db_file = {}\n".format(db_file))
+        address = os.path.join(self.tmpdir.name, "greylist.sock")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            with self.subTest(signal=signum):
+                daemon = bench.start_daemon(config_file, address)
+                try:
+                    _, responses = bench.run_socket(
+                        [dict(self.request, client_address="192.0.2.1")],
+                        ("unix", address), connections=1)
+                finally:
+                    daemon.send_signal(signum)
+                    daemon.wait()
+                self.assertEqual(0, daemon.returncode)
+                self.assertEqual([greylist.response_fail], responses)
+                # the snapshot is written on shutdown, and no SQLite
+                # database is created next to it
+                self.assertTrue(os.path.exists(db_file + ".snapshot"))
+                os.unlink(db_file + ".snapshot")
+                self.assertFalse(os.path.exists(db_file))
+
+    def test_daemon_only(self):
+        config = "[DEFAULT]\nstorage = memory\n"
+        with self.assertRaises(ValueError):
+            greylist.load_config(io.StringIO(config), daemon=False)
+        greylist.load_config(io.StringIO(config), daemon=True)
+        self.assertEqual("memory", greylist.storage)
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.storage = "sqlite"
+        greylist.db_file = self._saved
+        greylist.auto_whitelist_threshold = 10
+        self.tmpdir.cleanup()
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the subset of the Redis protocol used by RedisBackend, keeping the
+    data in ``self.server.data``.
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for i in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return (b"*%d\r\n" % len(value)
+                    + b"".join(map(self.reply, value)))
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            name, *args = command
+            with self.server.lock:
+                try:
+                    result = getattr(self, "cmd_" + name.decode().lower())(
+                        self.server.data, *args)
+                except Exception as err:
+                    self.wfile.write(b"-ERR %s\r\n" % str(err).encode())
+                    continue
+            self.wfile.write(self.reply(result))
+
+    def cmd_ping(self, data):
+        return "PONG"
+
+    def cmd_select(self, data, db):
+        return "OK"
+
+    def cmd_get(self, data, key):
+        return data.get(key)
+
+    def cmd_setnx(self, data, key, value):
+        if key in data:
+            return 0
+        data[key] = value
+        return 1
+
+    def cmd_del(self, data, *keys):
+        return sum(data.pop(key, None) is not None for key in keys)
+
+    def cmd_hget(self, data, key, field):
+        return data.get(key, {}).get(field)
+
+    def cmd_hincrby(self, data, key, field, increment):
+        hash = data.setdefault(key, {})
+        hash[field] = b"%d" % (int(hash.get(field, 0)) + int(increment))
+        return int(hash[field])
+
+    def cmd_hdel(self, data, key, *fields):
+        hash = data.get(key, {})
+        return sum(hash.pop(field, None) is not None for field in fields)
+
+    def cmd_hlen(self, data, key):
+        return len(data.get(key, {}))
+
+    def cmd_hexists(self, data, key, field):
+        return int(field in data.get(key, {}))
+
+    def cmd_zadd(self, data, key, *args):
+        flags = set()
+        while args[0] in (b"XX", b"GT"):
+            flags.add(args[0])
+            args = args[1:]
+        zset = data.setdefault(key, {})
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            if member not in zset:
+                if b"XX" in flags:
+                    continue
+                added += 1
+            elif b"GT" in flags and float(score) <= zset[member]:
+                continue
+            zset[member] = float(score)
+        return added
+
+    def cmd_zrem(self, data, key, *members):
+        zset = data.get(key, {})
+        return sum(zset.pop(member, None) is not None for member in members)
+
+    def cmd_zcard(self, data, key):
+        return len(data.get(key, {}))
+
+    def _sorted(self, data, key):
+        return sorted(data.get(key, {}).items(), key=lambda item: item[::-1])
+
+    def _range(self, items, start, stop):
+        stop = int(stop)
+        return [member for member, score
+                in items[int(start):None if stop == -1 else stop + 1]]
+
+    def cmd_zrange(self, data, key, start, stop):
+        return self._range(self._sorted(data, key), start, stop)
+
+    def cmd_zrevrange(self, data, key, start, stop):
+        return self._range(self._sorted(data, key)[::-1], start, stop)
+
+    def cmd_zrangebyscore(self, data, key, min, max, *limit):
+        members = [member for member, score in self._sorted(data, key)
+                   if float(min) <= score <= float(max)]
+        if limit:
+            _, offset, count = limit
+            members = members[int(offset):int(offset) + int(count)]
+        return members
+
+    def cmd_sadd(self, data, key, *members):
+        set_ = data.setdefault(key, set())
+        added = len(set(members) - set_)
+        set_.update(members)
+        return added
+
+    def cmd_srem(self, data, key, *members):
+        set_ = data.get(key, set())
+        removed = len(set_ & set(members))
+        set_.difference_update(members)
+        return removed
+
+    def cmd_smembers(self, data, key):
+        return sorted(data.get(key, set()))
+
+class TestRedisBackend(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0), FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.data = {}
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        greylist.storage = "redis"
+        greylist.redis_port = self.port
+        greylist.greylist_timeout = 60
+        greylist.auto_whitelist_threshold = 1
+        greylist.move_to_whitelist = True
+
+    def backend(self):
+        return greylist.RedisBackend(
+            greylist.RedisPool("127.0.0.1", self.port, size=2))
+
+    def test_shared_state(self):
+        # two MX hosts sharing the store
+        mx1, mx2 = self.backend(), self.backend()
+        now = int(time.time())
+        args = (self.request["sender"], self.request["recipient"],
+                self.request["client_name"])
+        self.assertEqual(greylist.FAILED, mx1.decide(*args, now)[1])
+        self.assertEqual(greylist.FAILED, mx2.decide(*args, now + 30)[1])
+        self.assertEqual((False, greylist.PASSED, now),
+                         mx2.decide(*args, now + 60))
+        self.assertEqual(1, mx1.count("whitelist"))
+        # the second pass whitelists the client and clears its greylist
+        self.assertEqual((True, greylist.PASSED, None),
+                         mx1.decide(*args, now + 61))
+        self.assertEqual(0, mx2.count("greylist"))
+        mx1.close()
+        mx2.close()
+
+    def test_process_request(self):
+        backend = greylist.get_backend()
+        self.assertIsInstance(backend, greylist.RedisBackend)
+        self.assertEqual(greylist.FAILED,
+                         greylist.process_request(self.request))
+        self.assertEqual(greylist.FAILED,
+                         greylist.process_request(self.request))
+        self.assertEqual(1, backend.count("greylist"))
+        self.assertEqual(0, backend.count("whitelist"))
+
+    def test_gc(self):
+        backend = self.backend()
+        now = int(time.time())
+        for client_name in ("a.example", "b.example"):
+            for i in range(3):
+                backend.upsert_greylist(
+                    (client_name, "foo@example.com",
+                     "bar{}@example.com".format(i)),
+                    now + i)
+        self.assertEqual([("a.example", 3), ("b.example", 3)],
+                         sorted(backend.clients_over_limit(2)))
+        self.assertEqual(1, backend.evict_client("a.example", 1))
+        self.assertEqual(1, backend.expire("greylist", now, 1))
+        self.assertEqual(1, backend.expire("greylist", now))
+        self.assertEqual(3, backend.count("greylist"))
+        self.assertEqual(2, backend.evict("greylist", 2))
+        self.assertEqual([("b.example", 1)], backend.clients_over_limit(0))
+        self.assertEqual(1, backend.evict("greylist", 5))
+        self.assertNotIn(b"greylist:gclients", {
+            key for key, value in self.server.data.items() if value})
+        backend.close()
+
+    def test_fail_open(self):
+        self.server.shutdown()
+        self.server.server_close()
+        greylist.redis_port = self.port
+        self.assertEqual(greylist.response_pass,
+                         greylist.respond(dict(self.request,
+                                               client_address="192.0.2.1")))
+
+    def test_housekeeping_survives_outage(self):
+        greylist.whitelist_cache_size = 10
+        greylist.write_behind_interval = 0
+        greylist.gc_interval_requests = 1
+        try:
+            greylist.process_request(self.request)
+            greylist.process_request(self.request)
+            self.server.shutdown()
+            self.server.server_close()
+            greylist.get_backend().pool.close()
+            greylist._pending_whitelist_hits["example.com"] = [1, 0]
+            greylist.maybe_flush_db()
+            greylist.maybe_gc_db()
+            self.assertEqual(0, greylist._gc_requests)
+        finally:
+            greylist.whitelist_cache_size = None
+            greylist.write_behind_interval = 5
+            greylist._pending_whitelist_hits.clear()
+        greylist.close_db()
+
+    def tearDown(self):
+        greylist.close_db()
+        self.server.shutdown()
+        self.server.server_close()
+        greylist.storage = "sqlite"
+        greylist.redis_port = 6379
+        greylist.auto_whitelist_threshold = 10
+
+class TestCompactKeys(unittest.TestCase):
+    request = {
+        "client_name": "example.com",
+        "sender": "foo@dom1.example.com",
+        "recipient": "bar@dom2.example.com"
+    }
+
+    def setUp(self):
+        greylist.close_db()
+        greylist.sqlite_compact_keys = True
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 2
+
+    def _fill(self, count):
+        for i in range(count):
+            greylist.process_request(dict(
+                self.request,
+                client_name="mx{}.example.com".format(i % 7),
+                sender="sender{}@example.com".format(i)))
+
+    def test_whitelisting(self):
+        backend = greylist.get_backend()
+        self.assertIsInstance(backend, greylist.CompactSQLiteBackend)
+        dbconn = greylist.get_db()
+        for i in range(2):
+            greylist.process_request(self.request)
+        self.assertEqual(
+            [("example.com", "foo@dom1.example.com", "bar@dom2.example.com")],
+            dbconn.execute("""SELECT client_name, sender, recipient
+            FROM greylist JOIN greylist_keys USING (id)""").fetchall())
+        # the whitelisted client's greylist entries are removed
+        greylist.process_request(self.request)
+        self.assertEqual(0, backend.count("greylist"))
+        self.assertEqual(
+            0, dbconn.execute("SELECT COUNT(*) FROM greylist_keys").fetchone()[0])
+
+    def test_client_limit(self):
+        greylist.auto_whitelist_threshold = None
+        greylist.max_greylist_entries = None
+        greylist.max_greylist_entries_per_client_name = 2
+        try:
+            self._fill(21)
+            greylist.gc_db()
+        finally:
+            greylist.max_greylist_entries = 100000
+            greylist.max_greylist_entries_per_client_name = 1000
+        dbconn = greylist.get_db()
+        self.assertEqual(
+            [(2,)] * 7,
+            dbconn.execute("""SELECT COUNT(*) FROM greylist
+            GROUP BY client_id""").fetchall())
+        self.assertEqual(
+            [(2,)] * 7,
+            dbconn.execute("""SELECT count FROM greylist_client_counts
+            """).fetchall())
+
+    def test_migration(self):
+        greylist.sqlite_compact_keys = False
+        self._fill(10)
+        dbconn = greylist.get_db()
+        entries = sorted(dbconn.execute("""SELECT client_name, sender,
+        recipient, first_seen, last_seen FROM greylist"""))
+
+        for compact in (True, False):
+            greylist.sqlite_compact_keys = compact
+            greylist.setup_db(dbconn)
+            greylist.verify_db(dbconn)
+            self.assertEqual(10, greylist.get_count(dbconn.cursor(),
+                                                    "greylist"))
+        self.assertEqual(
+            entries,
+            sorted(dbconn.execute("""SELECT client_name, sender, recipient,
+            first_seen, last_seen FROM greylist""")))
+
+    def test_smaller(self):
+        greylist.auto_whitelist_threshold = None
+        sizes = {}
+        for compact in (False, True):
+            greylist.sqlite_compact_keys = compact
+            self._fill(2000)
+            dbconn = greylist.get_db()
+            # the tables and indices used for lookups
+            sizes[compact] = dbconn.execute("""SELECT SUM(pgsize) FROM dbstat
+            WHERE name IN ('greylist', 'sqlite_autoindex_greylist_1',
+                           'greylist_last_seen',
+                           'greylist_client_name_last_seen',
+                           'greylist_client_id_last_seen')""").fetchone()[0]
+            greylist.close_db()
+        self.assertLess(sizes[True] * 2, sizes[False])
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.sqlite_compact_keys = False
+        greylist.auto_whitelist_threshold = 10
+
+class TestCompactQueryPlans(TestQueryPlans):
+    def setUp(self):
+        greylist.close_db()
+        greylist.sqlite_compact_keys = True
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        greylist.sqlite_compact_keys = False
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        greylist.close_db()
+        greylist.sqlite_shards = 4
+        greylist.greylist_timeout = 100
+        greylist.auto_whitelist_threshold = None
+
+    def _request(self, client_name, i=0):
+        return {
+            "client_name": client_name,
+            "sender": "foo{}@dom1.example.com".format(i),
+            "recipient": "bar@dom2.example.com"
+        }
+
+    def _client_names(self, dbconn):
+        return [client_name
+                for client_name, in dbconn.execute(
+                    "SELECT DISTINCT client_name FROM greylist")]
+
+    def test_partitioned_by_client_name(self):
+        backend = greylist.get_backend()
+        self.assertIsInstance(backend, greylist.ShardedSQLiteBackend)
+        client_names = ["mx{}.example.com".format(i) for i in range(20)]
+        for client_name in client_names:
+            for i in range(2):
+                self.assertEqual(
+                    greylist.FAILED,
+                    greylist.process_request(self._request(client_name, i)))
+        self.assertEqual(40, backend.count("greylist"))
+
+        found = [self._client_names(dbconn) for dbconn in greylist.get_dbs()]
+        self.assertTrue(all(found))
+        self.assertCountEqual(client_names, sum(found, []))
+
+    def test_whitelisting(self):
+        greylist.greylist_timeout = 0
+        greylist.auto_whitelist_threshold = 1
+        for i in range(3):
+            self.assertEqual(
+                greylist.PASSED,
+                greylist.process_request(self._request("example.com")))
+        backend = greylist.get_backend()
+        self.assertEqual(0, backend.count("greylist"))
+        self.assertEqual(1, backend.count("whitelist"))
+
+    def test_gc_limits(self):
+        greylist.max_greylist_entries = 10
+        greylist.max_greylist_entries_per_client_name = 3
+        try:
+            client_names = ["mx{}.example.com".format(i) for i in range(4)]
+            now = int(time.time())
+            backend = greylist.get_backend()
+            for i in range(4):
+                for j, client_name in enumerate(client_names):
+                    backend.upsert_greylist(
+                        (client_name, "foo{}@example.com".format(i),
+                         "bar@example.com"),
+                        now + 4 * i + j)
+            greylist.gc_db()
+        finally:
+            greylist.max_greylist_entries = 100000
+            greylist.max_greylist_entries_per_client_name = 1000
+
+        # first the newest entry of each client is purged, then the two
+        # globally oldest entries
+        self.assertEqual(10, backend.count("greylist"))
+        remaining = sorted(
+            last_seen - now
+            for dbconn in greylist.get_dbs()
+            for last_seen, in dbconn.execute(
+                "SELECT last_seen FROM greylist"))
+        self.assertEqual([2, 3, 4, 5, 6, 7, 8, 9, 10, 11], remaining)
+
+    def test_group_commit(self):
+        greylist.commit_batch_size = 100
+        try:
+            for i in range(10):
+                greylist.process_request(
+                    self._request("mx{}.example.com".format(i)))
+            self.assertTrue(any(dbconn.in_transaction
+                                for dbconn in greylist.get_dbs()))
+            greylist.commit_batch()
+        finally:
+            greylist.commit_batch_size = 1
+        self.assertFalse(any(dbconn.in_transaction
+                             for dbconn in greylist.get_dbs()))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.sqlite_shards = None
+        greylist.auto_whitelist_threshold = 10
+
+class TestIncrementalGC(unittest.TestCase):
+    storage = "sqlite"
+
+    def setUp(self):
+        greylist.close_db()
+        greylist.storage = self.storage
+        greylist.auto_whitelist_threshold = None
+        greylist.gc_chunk_size = 10
+        greylist._gc_progress.clear()
+        self.backend = greylist.get_backend()
+        self.now = int(time.time())
+
+    def _fill(self, count, last_seen, recipient="bar@example.com"):
+        for i in range(count):
+            self.backend.atomic(
+                self.backend.upsert_greylist,
+                ("mx{}.example.com".format(i % 3), "foo{}@example.com".format(i),
+                 recipient),
+                last_seen + i)
+
+    def test_expire_in_chunks(self):
+        greylist.greylist_expire = 3600
+        self._fill(25, self.now - 7200)
+        self._fill(5, self.now, "baz@example.com")
+        steps = greylist.gc_steps()
+        next(steps)
+        # the first chunk is committed before the rest is done
+        self.assertEqual(20, self.backend.count("greylist"))
+        self.assertEqual(1, sum(1 for _ in steps))
+        self.assertEqual(5, self.backend.count("greylist"))
+        self.assertEqual(
+            {"passes": 1, "chunks": 3, "deleted": 25, "incomplete": 0},
+            {key: greylist._gc_progress[key]
+             for key in ("passes", "chunks", "deleted", "incomplete")})
+
+    def test_evict_in_chunks(self):
+        greylist.max_greylist_entries = 5
+        self._fill(30, self.now)
+        greylist.gc_db()
+        self.assertEqual(5, self.backend.count("greylist"))
+        self.assertEqual(25, greylist._gc_progress["deleted"])
+        self.assertEqual(
+            [], self.backend.clients_over_limit(2))
+
+    def test_time_budget(self):
+        greylist.gc_time_budget = 0
+        greylist.max_greylist_entries = 5
+        self._fill(30, self.now)
+        greylist.gc_db()
+        self.assertEqual(20, self.backend.count("greylist"))
+        self.assertEqual(1, greylist._gc_progress["incomplete"])
+        greylist.gc_db()
+        self.assertEqual(10, self.backend.count("greylist"))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.storage = "sqlite"
+        greylist.auto_whitelist_threshold = 10
+        greylist.gc_chunk_size = None
+        greylist.gc_time_budget = None
+        greylist.greylist_expire = None
+        greylist.max_greylist_entries = 100000
+
+class TestIncrementalGCMemory(TestIncrementalGC):
+    storage = "memory"
+
+class TestLowWater(unittest.TestCase):
+    def setUp(self):
+        greylist.close_db()
+        greylist.auto_whitelist_threshold = None
+        greylist.gc_low_water = 0.5
+        greylist._gc_progress.clear()
+        self.backend = greylist.get_backend()
+        self.now = int(time.time())
+
+    def _add(self, client_name, i):
+        self.backend.atomic(
+            self.backend.upsert_greylist,
+            (client_name, "foo{}@example.com".format(i), "bar@example.com"),
+            self.now + i)
+
+    def test_global_limit(self):
+        greylist.max_greylist_entries = 10
+        for i in range(40):
+            self._add("mx{}.example.com".format(i % 4), i)
+            greylist.gc_db()
+            self.assertLessEqual(self.backend.count("greylist"), 10)
+        # purged down to 5 entries once every 6 new entries, instead of once
+        # for every entry beyond the first 10
+        self.assertEqual(5, greylist._gc_progress["passes"])
+        self.assertEqual(30, greylist._gc_progress["deleted"])
+        self.assertEqual(10, self.backend.count("greylist"))
+
+    def test_client_limit(self):
+        greylist.max_greylist_entries = None
+        greylist.max_greylist_entries_per_client_name = 4
+        for i in range(5):
+            self._add("a.example", i)
+        for i in range(4):
+            self._add("b.example", i)
+        greylist.gc_db()
+        self.assertEqual([("a.example", 2), ("b.example", 4)],
+                         sorted(greylist.get_db().execute(
+                             "SELECT * FROM greylist_client_counts")))
+
+    def test_whitelist_limit(self):
+        greylist.max_whitelist_entries = 4
+        for i in range(5):
+            self.backend.atomic(self.backend.add_whitelist_hit,
+                                "mx{}.example.com".format(i), self.now + i)
+        greylist.gc_db()
+        self.assertEqual(2, self.backend.count("whitelist"))
+
+    def test_config(self):
+        greylist.load_config(io.StringIO("[DEFAULT]\ngc_low_water = 0.9\n"))
+        self.assertEqual(0.9, greylist.gc_low_water)
+        greylist.load_config(io.StringIO("[DEFAULT]\ngc_low_water = none\n"))
+        self.assertIsNone(greylist.gc_low_water)
+        for value in ["1", "1.5", "-0.1"]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    greylist.load_config(io.StringIO(
+                        "[DEFAULT]\ngc_low_water = {}\n".format(value)))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.auto_whitelist_threshold = 10
+        greylist.gc_low_water = None
+        greylist.max_greylist_entries = 100000
+        greylist.max_greylist_entries_per_client_name = 1000
+        greylist.max_whitelist_entries = 1000
+
+class TestBench(unittest.TestCase):
+    def test_inprocess(self):
+        import bench
+        import random
+        greylist.close_db()
+        greylist.greylist_timeout = 60
+        requests, whitelisted, greylisted = bench.generate_requests(
+            200, dict(bench.DEFAULT_MIX, burst=0), random.Random(1),
+            clients=10)
+        bench.seed_db(whitelisted, greylisted, int(time.time()))
+        latencies, responses = bench.run_inprocess(requests)
+        self.assertEqual(200, len(latencies))
+        # new keys and early retries are deferred, everything else passes
+        expected = sum(1 for request in requests
+                       if request["client_name"].startswith("mx"))
+        expected += sum(1 for key, age in greylisted if age == 0)
+        self.assertEqual(expected, responses.count(greylist.response_fail))
+        self.assertEqual(200 - expected,
+                         responses.count(greylist.response_pass))
+
+class TestCachedClock(unittest.TestCase):
+    def test_once_per_iteration(self):
+        async def run():
+            clock = greylist.CachedClock(asyncio.get_running_loop())
+            first = clock.monotonic()
+            same = clock.monotonic()
+            await asyncio.sleep(0.01)
+            return first, same, clock.monotonic()
+
+        first, same, later = asyncio.run(run())
+        self.assertEqual(first, same)
+        self.assertGreater(later, first)
+
+    def test_database_thread(self):
+        greylist.greylist_timeout = 100
+        request = (b"client_name=example.com\n"
+                   b"client_address=192.0.2.1\n"
+                   b"sender=foo@dom1.example.com\n"
+                   b"recipient=bar@dom2.example.com\n"
+                   b"\n")
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            # makes call_soon() fail when called from another thread
+            loop.set_debug(True)
+            greylist.clock = clock = greylist.CachedClock(loop)
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)))
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(request)
+                response = await reader.readuntil(b"\n\n")
+                writer.close()
+            first = await greylist.run_db(clock.time)
+            await asyncio.sleep(1.1)
+            return response, first, await greylist.run_db(clock.time)
+
+        greylist.get_db()
+        try:
+            response, first, later = asyncio.run(run())
+        finally:
+            greylist.clock = greylist.Clock()
+            greylist.close_db()
+        self.assertEqual(greylist.response_fail.encode(), response)
+        # the cached time expires, even if read on the database thread
+        self.assertGreater(later, first)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = greylist.clock = greylist.VirtualClock()
+        greylist.get_db()
+        greylist._request_outcomes.clear()
+
+    def test_histogram(self):
+        histogram = greylist.Histogram("test_seconds", "Test", (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertSequenceEqual([
+            "# HELP test_seconds Test",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 3.65",
+            "test_seconds_count 4",
+        ], histogram.format())
+
+    def test_outcomes(self):
+        greylist.greylist_timeout = 100
+        greylist.auto_whitelist_threshold = 10
+        request = {
+            "client_name": "example.com",
+            "client_address": "192.0.2.1",
+            "sender": "foo@dom1.example.com",
+            "recipient": "bar@dom2.example.com"
+        }
+        greylist.respond(dict(request))
+        self.clock.advance(100)
+        greylist.respond(dict(request))
+        greylist.respond({"sender": "foo@dom1.example.com"})
+        self.assertEqual(
+            {"failed": 1, "passed": 1, "malformed": 1},
+            greylist._request_outcomes)
+
+        metrics = greylist.render_metrics()
+        self.assertIn('greylist_requests_total{outcome="failed"} 1\n',
+                      metrics)
+        self.assertIn('greylist_entries{list="greylist"} 1\n', metrics)
+        self.assertIn("# TYPE greylist_commit_seconds histogram\n", metrics)
+
+    def test_scrape(self):
+        async def get(path):
+            server = await greylist.start_server(("tcp", ("127.0.0.1", 0)),
+                                                 greylist.handle_metrics)
+            async with server:
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write("GET {} HTTP/1.0\r\n\r\n".format(path).encode())
+                response = await reader.read()
+                writer.close()
+                return response
+
+        response = asyncio.run(get("/metrics"))
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"greylist_gc_deleted_total ", response)
+        response = asyncio.run(get("/"))
+        self.assertTrue(response.startswith(b"HTTP/1.0 404 Not Found\r\n"))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.clock = greylist.Clock()
+
+class TestStaticWhitelist(unittest.TestCase):
+    def setUp(self):
+        greylist.get_db()
+
+    def test_match(self):
+        whitelist = greylist.StaticWhitelist(
+            ["192.0.2.0/24", "198.51.100.7", "2001:db8::/32",
+             "example.com", ".mail.example.net."])
+        self.assertTrue(whitelist.match_address("192.0.2.200"))
+        self.assertFalse(whitelist.match_address("192.0.3.1"))
+        self.assertTrue(whitelist.match_address("198.51.100.7"))
+        self.assertFalse(whitelist.match_address("198.51.100.8"))
+        self.assertTrue(whitelist.match_address("2001:db8:1::25"))
+        self.assertFalse(whitelist.match_address("2001:db9::25"))
+        self.assertFalse(whitelist.match_address("unknown"))
+        self.assertTrue(whitelist.match_name("example.com"))
+        self.assertTrue(whitelist.match_name("MX1.Example.COM."))
+        self.assertFalse(whitelist.match_name("badexample.com"))
+        self.assertFalse(whitelist.match_name("com"))
+        self.assertTrue(whitelist.match_name("out.mail.example.net"))
+        self.assertFalse(whitelist.match_name("example.net"))
+
+    def test_invalid_networks(self):
+        for entry in ["10.0.0.0/33", "192.168.1/24", "192.168.1",
+                      "2001:db8::/129", "2001:db8:::1", "example.com/24"]:
+            with self.subTest(entry=entry):
+                with self.assertRaises(ValueError):
+                    greylist.StaticWhitelist([entry])
+
+    def test_invalid_network_in_config(self):
+        saved = greylist.whitelist_prefixes
+        try:
+            with self.assertRaises(ValueError):
+                greylist.load_config(io.StringIO(
+                    "[DEFAULT]\n"
+                    "whitelist_prefixes = example.com, 10.0.0.0/33\n"))
+        finally:
+            greylist.whitelist_prefixes = saved
+            greylist._static_whitelist = None
+
+    def test_read_file(self):
+        self.assertSequenceEqual(
+            ["192.0.2.0/24", "example.com", "example.net"],
+            greylist.read_whitelist_prefixes([
+                "# relays\n",
+                "192.0.2.0/24  # our own\n",
+                "\n",
+                "example.com example.net\n",
+            ]))
+
+    def test_no_database_access(self):
+        greylist.greylist_timeout = 100
+        greylist.whitelist_prefixes = ["192.0.2.0/24", "example.com"]
+        greylist._static_whitelist = None
+        for request in [
+                {"client_name": "unknown", "client_address": "192.0.2.1"},
+                {"client_name": "mx.example.com",
+                 "client_address": "198.51.100.1"}]:
+            request.update(sender="foo@dom1.example.com",
+                           recipient="bar@dom2.example.com")
+            self.assertEqual(greylist.response_pass, greylist.respond(request))
+        self.assertEqual(0, greylist.get_backend().count("greylist"))
+        self.assertEqual(0, greylist.get_backend().count("whitelist"))
+        self.assertEqual(greylist.response_fail, greylist.respond({
+            "client_name": "mx.example.org",
+            "client_address": "198.51.100.1",
+            "sender": "foo@dom1.example.com",
+            "recipient": "bar@dom2.example.com",
+        }))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.whitelist_prefixes = []
+        greylist._static_whitelist = None
+
+class TestNormalization(unittest.TestCase):
+    def setUp(self):
+        self.clock = greylist.clock = greylist.VirtualClock()
+        greylist.get_db()
+
+    def test_group_address(self):
+        greylist.client_ipv4_prefix = 24
+        greylist.client_ipv6_prefix = 64
+        self.assertEqual("192.0.2.0/24", greylist.group_address("192.0.2.77"))
+        self.assertEqual("2001:db8:1:2::/64",
+                         greylist.group_address("2001:db8:1:2:3::1"))
+        self.assertEqual("mx.example.com",
+                         greylist.group_address("mx.example.com"))
+        greylist.client_ipv6_prefix = None
+        self.assertEqual("2001:db8::1", greylist.group_address("2001:db8::1"))
+
+    def test_normalize_sender(self):
+        for sender, normalized in [
+                ("SRS0=HHH=TT=orig.example=alice@fwd.example",
+                 "alice@orig.example"),
+                ("SRS1=HHH=fwd.example==HHH=TT=orig.example=alice@fwd2.example",
+                 "alice@orig.example"),
+                ("prvs=0123abcdef=bob@Example.COM", "bob@example.com"),
+                ("btv1==123abc==bob@example.com", "bob@example.com"),
+                ("bounces-12345-carol=x.org@list.example",
+                 "bounces-#-carol=x.org@list.example"),
+                ("dave+tag@example.com", "dave@example.com"),
+                ("", "")]:
+            self.assertEqual(normalized, greylist.normalize_sender(sender))
+
+    def test_retry_from_pool(self):
+        greylist.greylist_timeout = 100
+        greylist.use_client_address = True
+        greylist.client_ipv4_prefix = 24
+        greylist.normalize_senders = True
+        request = {
+            "client_name": "mx1.example.com",
+            "client_address": "192.0.2.1",
+            "sender": "bounces-1001@example.com",
+            "recipient": "bar@dom2.example.com",
+        }
+        self.assertEqual(greylist.response_fail,
+                         greylist.respond(dict(request)))
+        self.clock.advance(100)
+        self.assertEqual(greylist.response_pass, greylist.respond(dict(
+            request, client_name="mx2.example.com", client_address="192.0.2.2",
+            sender="bounces-1002@example.com")))
+        self.assertEqual(1, greylist.get_backend().count("greylist"))
+
+    def tearDown(self):
+        greylist.close_db()
+        greylist.clock = greylist.Clock()
+        greylist.use_client_address = False
+        greylist.client_ipv4_prefix = None
+        greylist.client_ipv6_prefix = None
+        greylist.normalize_senders = False
+
+class TestRequestParser(unittest.TestCase):
+    request = (b"request=smtpd_access_policy\n"
+               b"protocol_state=RCPT\n"
+               b"client_name=example.com\n"
+               b"client_address=192.0.2.1\n"
+               b"sender=SRS0=HHH=TT=orig.example=alice@fwd.example\n"
+               b"recipient=bar@dom2.example.com\n"
+               b"helo_name=mx.example.com\n"
+               b"\n")
+
+    def test_incremental(self):
+        parser = greylist.RequestParser()
+        stream = b"\n" + self.request + b"garbage\nsender=\n\n" + self.request
+        requests = []
+        for i in range(0, len(stream), 7):
+            requests += parser.feed(stream[i:i + 7])
+        self.assertEqual(3, len(requests))
+        self.assertEqual(b"", parser.buffer)
+        request, malformed, _ = requests
+        self.assertIsInstance(malformed, ValueError)
+        self.assertEqual("example.com", request["client_name"])
+        self.assertEqual("192.0.2.1", request["client_address"])
+        self.assertEqual("SRS0=HHH=TT=orig.example=alice@fwd.example",
+                         request["sender"])
+        self.assertEqual("bar@dom2.example.com", request.get("recipient"))
+
+    def test_crlf_and_missing_attributes(self):
+        request, = greylist.RequestParser().feed(
+            b"client_address=192.0.2.1\r\nsender=\r\n\r\n")
+        self.assertEqual("", request["sender"])
+        self.assertNotIn("recipient", request)
+        self.assertIsNone(request.get("client_name"))
+        with self.assertRaises(KeyError):
+            request["recipient"]
+        with self.assertRaises(KeyError):
+            greylist.clean_request(request)
+
+    def test_crlf_split_across_reads(self):
+        parser = greylist.RequestParser()
+        self.assertSequenceEqual([], parser.feed(
+            b"client_address=192.0.2.1\r\nsender=foo@example.com\r"))
+        self.assertSequenceEqual(
+            [], parser.feed(b"\nrecipient=bar@example.com\r"))
+        request, = parser.feed(b"\n\r\n")
+        self.assertEqual("foo@example.com", request["sender"])
+        self.assertEqual("bar@example.com", request["recipient"])
+        self.assertEqual(b"", parser.buffer)
+
+    def test_blank_line_with_whitespace(self):
+        parser = greylist.RequestParser()
+        stream = (b"client_address=192.0.2.1\nsender=foo@example.com \n"
+                  b"recipient=bar@example.com\n \t\n"
+                  b"client_address=192.0.2.2\nsender=\nrecipient=baz\n\t")
+        first, = parser.feed(stream)
+        self.assertEqual("foo@example.com", first["sender"])
+        second, = parser.feed(b"\n")
+        self.assertEqual("192.0.2.2", second["client_address"])
+        expected = greylist.read_request(
+            stream.decode().splitlines(True))
+        for name in ("client_address", "sender", "recipient"):
+            self.assertEqual(expected[name], first[name])
+
+    def test_same_as_read_request(self):
+        request, = greylist.RequestParser().feed(self.request)
+        expected = greylist.read_request(
+            self.request.decode().splitlines(True))
+        for name in greylist.Request.__slots__:
+            self.assertEqual(expected[name], request[name])
+
+class TestWorkers(unittest.TestCase):
+    def test_merge_metrics(self):
+        greylist.get_db()
+        try:
+            snapshot = greylist.metrics_snapshot()
+        finally:
+            greylist.close_db()
+        first = dict(snapshot, requests={"passed": 2},
+                     entries={"greylist": 5, "whitelist": 0})
+        second = dict(snapshot, requests={"passed": 1, "failed": 3},
+                      entries={"greylist": 7, "whitelist": 1})
+        merged = greylist.merge_metrics([first, second])
+        self.assertEqual(3, merged["requests"]["passed"])
+        self.assertEqual(3, merged["requests"]["failed"])
+        self.assertEqual({"greylist": 7, "whitelist": 1}, merged["entries"])
+        counts, total = merged["histograms"]["commit"]
+        self.assertEqual(2 * sum(snapshot["histograms"]["commit"][0]),
+                         sum(counts))
+        self.assertIn('greylist_requests_total{outcome="failed"} 3\n',
+                      greylist.render_metrics(merged))
+
+    def test_prefork(self):
+        import bench
+        import random
+        import signal
+        import socket
+        requests, _, _ = bench.generate_requests(
+            100, {"new": 1}, random.Random(1))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_file = os.path.join(tmpdir, "config.ini")
+            metrics_address = os.path.join(tmpdir, "metrics.sock")
+            with open(config_file, "w") as f:
+                f.write("[DEFAULT]\n"
+                        "db_file = {}\n"
+                        "sqlite_journal_mode = WAL\n"
+                        "workers = 2\n"
+                        "metrics_listen = unix:{}\n".format(
+                            os.path.join(tmpdir, "greylist.db"),
+                            metrics_address))
+            address = os.path.join(tmpdir, "greylist.sock")
+            daemon = bench.start_daemon(config_file, address)
+
+            def scrape():
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(metrics_address)
+                    sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+                    return sock.makefile("rb").read().decode()
+
+            def children():
+                with open("/proc/{0}/task/{0}/children".format(
+                        daemon.pid)) as f:
+                    return [int(pid) for pid in f.read().split()]
+
+            def sockets(pid):
+                fd_dir = "/proc/{}/fd".format(pid)
+                targets = set()
+                for fd in os.listdir(fd_dir):
+                    try:
+                        targets.add(os.readlink(os.path.join(fd_dir, fd)))
+                    except FileNotFoundError:
+                        pass
+                return {target for target in targets
+                        if target.startswith("socket:")}
+
+            try:
+                _, responses = bench.run_socket(
+                    requests[:50], ("unix", address), connections=4)
+                self.assertEqual(50, responses.count(greylist.response_fail))
+                workers = children()
+                self.assertEqual(2, len(workers))
+                # the workers only share the policy socket, not the one
+                # for the metrics
+                for pid in workers:
+                    self.assertEqual(
+                        1, len(sockets(pid) & sockets(daemon.pid)))
+                # the reports of the workers arrive every second
+                time.sleep(greylist.WORKER_REPORT_INTERVAL + 0.5)
+                self.assertIn('greylist_requests_total{outcome="failed"} 50\n',
+                              scrape())
+
+                os.kill(workers[0], signal.SIGKILL)
+                deadline = time.monotonic() + 10
+                while workers[0] in children() or len(children()) < 2:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.1)
+                _, responses = bench.run_socket(
+                    requests[50:], ("unix", address), connections=4)
+                self.assertEqual(50, responses.count(greylist.response_fail))
+            finally:
+                daemon.send_signal(signal.SIGINT)
+                daemon.wait()
+
+class TestSchemaVersion(unittest.TestCase):
+    def setUp(self):
+        greylist.close_db()
+        self.dbconn = sqlite3.connect(":memory:")
+
+    def user_version(self):
+        return self.dbconn.execute("PRAGMA user_version").fetchone()[0]
+
+    def test_recorded(self):
+        greylist.setup_db(self.dbconn)
+        self.assertEqual(greylist.SCHEMA_VERSION, self.user_version())
+        # versioned databases are not compared with the schema again
+        verify_db = greylist.verify_db
+        greylist.verify_db = None
+        try:
+            greylist.setup_db(self.dbconn)
+        finally:
+            greylist.verify_db = verify_db
+
+    def test_whitespace_keeps_entries(self):
+        for sql in greylist.SCHEMA.values():
+            self.dbconn.execute(" ".join(sql.split()))
+        self.dbconn.execute("""INSERT INTO greylist
+        (client_name, sender, recipient, first_seen, last_seen) VALUES
+        ('a.example', 'foo@example.com', 'bar@example.com', 1, 1)""")
+        self.dbconn.commit()
+        greylist.setup_db(self.dbconn)
+        count, = self.dbconn.execute("SELECT COUNT(*) FROM greylist").fetchone()
+        self.assertEqual(1, count)
+        self.assertEqual(greylist.SCHEMA_VERSION, self.user_version())
+
+    def test_migrations(self):
+        greylist.setup_db(self.dbconn)
+        applied = []
+        migrations = greylist.MIGRATIONS
+        version = greylist.SCHEMA_VERSION
+        greylist.MIGRATIONS = [
+            (version + 1, lambda dbconn: applied.append(version + 1)),
+            (version + 2, lambda dbconn: applied.append(version + 2)),
+        ]
+        greylist.SCHEMA_VERSION = version + 2
+        try:
+            greylist.setup_db(self.dbconn)
+            self.assertEqual([version + 1, version + 2], applied)
+            self.assertEqual(version + 2, self.user_version())
+            greylist.setup_db(self.dbconn)
+            self.assertEqual([version + 1, version + 2], applied)
+
+            self.dbconn.execute("PRAGMA user_version={:d}".format(version + 1))
+            greylist.setup_db(self.dbconn)
+            self.assertEqual([version + 1, version + 2, version + 2], applied)
+        finally:
+            greylist.MIGRATIONS = migrations
+            greylist.SCHEMA_VERSION = version
+
+    def test_statistics_table(self):
+        greylist.setup_db(self.dbconn)
+        self.dbconn.execute("""INSERT INTO greylist
+        (client_name, sender, recipient, first_seen, last_seen) VALUES
+        ('a.example', 'foo@example.com', 'bar@example.com', 1, 1)""")
+        self.dbconn.commit()
+        # creates sqlite_stat1
+        self.dbconn.execute("ANALYZE")
+        greylist.sqlite_compact_keys = True
+        try:
+            greylist.setup_db(self.dbconn)
+            self.assertEqual(greylist.get_schema_version(),
+                             self.user_version())
+            greylist.verify_db(self.dbconn)
+            self.assertSequenceEqual(
+                [(1,)], list(self.dbconn.execute(
+                    "SELECT count FROM greylist_client_counts")))
+        finally:
+            greylist.sqlite_compact_keys = False
+
+    def test_keeps_unknown_tables(self):
+        for sql in greylist.SCHEMA.values():
+            self.dbconn.execute(sql)
+        self.dbconn.execute("CREATE TABLE notes (text TEXT)")
+        self.dbconn.execute("CREATE INDEX notes_text ON notes (text)")
+        self.dbconn.execute("INSERT INTO notes VALUES ('keep me')")
+        greylist.setup_db(self.dbconn)
+        self.assertEqual(greylist.SCHEMA_VERSION, self.user_version())
+        self.assertSequenceEqual(
+            [("keep me",)], list(self.dbconn.execute("SELECT * FROM notes")))
+        self.assertIsNotNone(self.dbconn.execute("""SELECT 1 FROM sqlite_master
+        WHERE name = 'notes_text'""").fetchone())
+
+    def test_never_drops_data(self):
+        self.dbconn.execute("""CREATE TABLE greylist
+        (id INTEGER PRIMARY KEY, client_name TEXT, comment TEXT)""")
+        self.dbconn.execute("""INSERT INTO greylist (client_name, comment)
+        VALUES ('a.example', 'kept')""")
+        self.dbconn.commit()
+        with self.assertRaises(ValueError):
+            greylist.setup_db(self.dbconn)
+        self.assertEqual(0, self.user_version())
+        self.assertSequenceEqual(
+            [("a.example", "kept")],
+            list(self.dbconn.execute(
+                "SELECT client_name, comment FROM greylist")))
+
+    def test_newer_version(self):
+        self.dbconn.execute("PRAGMA user_version={:d}".format(
+            greylist.SCHEMA_VERSION + 1))
+        with self.assertRaises(ValueError):
+            greylist.setup_db(self.dbconn)
+
+    def tearDown(self):
+        self.dbconn.close()
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        import stats
+        # stats.py imports greylist only when run as a script
+        stats.greylist = greylist
+        self.stats = stats
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self._saved = greylist.db_file
+        greylist.db_file = os.path.join(self.tmpdir.name, "greylist.db")
+        self.now = int(time.time())
+
+    def _fill(self, dbconn, offset=0):
+        now = self.now
+        dbconn.executemany(
+            "INSERT INTO greylist (client_name, sender, recipient,"
+            " first_seen, last_seen) VALUES (?, ?, ?, ?, ?)",
+            [("a{}.example".format(offset), "foo@example.com",
+              "bar@example.com", now - 100, now - 10),
+             ("b{}.example".format(offset), "foo@example.com",
+              "bar@example.com", now - 200000, now - 200000),
+             ("b{}.example".format(offset), "baz@example.com",
+              "bar@example.com", now - 200000, now - 7200)])
+        dbconn.executemany(
+            "INSERT INTO whitelist (client_name, last_seen, hit_count)"
+            " VALUES (?, ?, ?)",
+            [("c{}.example".format(offset), now - 10, 20),
+             ("d{}.example".format(offset), now - 10, 2),
+             ("e{}.example".format(offset), now - 7200, 20)])
+        dbconn.commit()
+
+    def _collect(self):
+        return self.stats.collect_stats(
+            [dbconn.cursor() for dbconn in greylist.get_dbs()])
+
+    def test_collect_stats(self):
+        self._fill(greylist.get_db())
+        stats = self._collect()
+        self.assertEqual(
+            {"total_greylist": 3, "active_greylist": 1, "dead_greylist": 1,
+             "total_whitelist": 3, "active_whitelist": 1,
+             "pending_whitelist": 1, "distinct_greylist_client_names": 2},
+            {key: value for key, value in stats.items() if key != "db_size"})
+        self.assertEqual(os.stat(greylist.db_file).st_size, stats["db_size"])
+
+    def test_thresholds_disabled(self):
+        self._fill(greylist.get_db())
+        saved = greylist.stats_active_threshold, greylist.stats_dead_threshold
+        greylist.stats_active_threshold = greylist.stats_dead_threshold = None
+        try:
+            stats = self._collect()
+        finally:
+            (greylist.stats_active_threshold,
+             greylist.stats_dead_threshold) = saved
+        self.assertEqual(3, stats["total_greylist"])
+        self.assertEqual(0, stats["active_greylist"])
+        self.assertEqual(0, stats["dead_greylist"])
+        self.assertEqual(0, stats["active_whitelist"])
+        self.assertEqual(1, stats["pending_whitelist"])
+
+    def test_sharded(self):
+        greylist.sqlite_shards = 2
+        try:
+            for index in range(2):
+                self._fill(greylist.get_shard_db(index), index)
+            stats = self._collect()
+        finally:
+            greylist.close_db()
+            greylist.sqlite_shards = None
+        self.assertEqual(6, stats["total_greylist"])
+        self.assertEqual(2, stats["dead_greylist"])
+        self.assertEqual(2, stats["pending_whitelist"])
+        self.assertEqual(4, stats["distinct_greylist_client_names"])
+        self.assertEqual(
+            sum(os.stat(greylist.shard_file(index)).st_size
+                for index in range(2)),
+            stats["db_size"])
+
+    def test_empty_overhead(self):
+        stats = self._collect()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.stats.do_data_overhead(stats)
+        self.assertEqual("efficiency.value U\n", output.getvalue())
+
+    def _munin(self, graph, *args, cap_multigraph=True):
+        import subprocess
+        import sys
+        config_file = os.path.join(self.tmpdir.name, "config.ini")
+        with open(config_file, "w") as f:
+            f.write("[DEFAULT]\ndb_file = {}\n".format(greylist.db_file))
+        env = dict(os.environ, MUNIN="1", MUNIN_GRAPH=graph,
+                   CONFIG=config_file)
+        if cap_multigraph:
+            env["MUNIN_CAP_MULTIGRAPH"] = "1"
+        return subprocess.run(
+            [sys.executable, self.stats.__file__, *args],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+
+    def test_multigraph(self):
+        self._fill(greylist.get_db())
+        greylist.close_db()
+        result = self._munin("multigraph")
+        self.assertEqual(0, result.returncode, result.stderr)
+        lines = result.stdout.splitlines()
+        self.assertEqual(
+            ["multigraph greylisting_" + name
+             for name in self.stats.graph_types],
+            [line for line in lines if line.startswith("multigraph ")])
+        self.assertIn("total.value 3", lines)
+        self.assertIn("clientnames.value 2", lines)
+
+        result = self._munin("multigraph", "config")
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn("multigraph greylisting_size", result.stdout)
+        self.assertIn("graph_title greylist contents", result.stdout)
+
+    def test_multigraph_unsupported(self):
+        result = self._munin("multigraph", cap_multigraph=False)
+        self.assertEqual(1, result.returncode)
+        self.assertEqual("", result.stdout)
+
+    def test_single_graph(self):
+        self._fill(greylist.get_db())
+        greylist.close_db()
+        result = self._munin("overview")
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertEqual("greylist.value 3\nwhitelist.value 3\n",
+                         result.stdout)
+
     def tearDown(self):
         greylist.close_db()
+        greylist.db_file = self._saved
+        self.tmpdir.cleanup()
@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 import binascii
+import heapq
 import itertools
 import random
+import time
 
 _anon_dict = {}
 _anon_rng = random.SystemRandom()
@@ -17,16 +19,35 @@ def anon_address(addr):
         _anon_dict[addr] = randkey+at+remotepart
         return _anon_dict[addr]
 
+def query_all(sql, sqlargs, key):
+    """
+    Run *sql* on all databases (see ``greylist.sqlite_shards``) and merge the
+    results, which have to be sorted by *key* already.
+    """
+    cursors = [dbconn.execute(sql, sqlargs) for dbconn in greylist.get_dbs()]
+    return heapq.merge(*cursors, key=key)
+
+def format_timestamp(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
+
 def show_greylist(args):
-    dbconn = greylist.get_db()
     sqlargs = ()
-    sql = ("SELECT id, client_name, sender, recipient, first_seen, last_seen "
-           "FROM greylist "
-           "ORDER BY recipient ASC, sender ASC, last_seen DESC")
+    if not greylist.sqlite_compact_keys:
+        sql = ("SELECT id, client_name, sender, recipient, first_seen, last_seen "
+               "FROM greylist ")
+    elif greylist.sqlite_store_keys:
+        sql = ("SELECT id, client_name, sender, recipient, first_seen, last_seen "
+               "FROM greylist JOIN greylist_keys USING (id) ")
+    else:
+        raise SystemExit("show-greylist needs sqlite_store_keys with"
+                         " sqlite_compact_keys")
+    sql += "ORDER BY recipient ASC, sender ASC, last_seen DESC"
     if args.limit is not None:
         sql += " LIMIT ?"
         sqlargs += (args.limit,)
-    cursor = dbconn.execute(sql, sqlargs)
+    cursor = itertools.islice(
+        query_all(sql, sqlargs, lambda x: (x[3], x[2], -x[5])),
+        args.limit)
     rows = itertools.groupby(cursor, lambda x: x[3])
     print("    {:5s} {:30s} ({})".format(
         "id", "sender", "client name"))
@@ -35,11 +56,10 @@ def show_greylist(args):
         for id, client_name, sender, _, first_seen, last_seen in items:
             print("    #{:<4d} {:30s} (from {})\n        first: {}\n        last:  {}".format(
                 id, args.anonymizer(sender), client_name,
-                first_seen.replace(microsecond=0),
-                last_seen.replace(microsecond=0)))
+                format_timestamp(first_seen),
+                format_timestamp(last_seen)))
 
 def show_whitelist(args):
-    dbconn = greylist.get_db()
     sqlargs = ()
     sql = ("SELECT id, client_name, last_seen, hit_count "
            "FROM whitelist "
@@ -47,14 +67,16 @@ def show_whitelist(args):
     if args.limit is not None:
         sql += " LIMIT ?"
         sqlargs += (args.limit,)
-    cursor = dbconn.execute(sql, sqlargs)
+    cursor = itertools.islice(
+        query_all(sql, sqlargs, lambda x: (x[1], -x[2])),
+        args.limit)
     print("{:5s} {:40s} {:20s} {:4s}".format(
         "id", "client name", "last seen", "hitc"))
     for id, client_name, last_seen, hit_count in cursor:
         print("#{:<4d} {:40s} {!s:20s} {:4d}".format(
             id,
             client_name,
-            last_seen.replace(microsecond=0),
+            format_timestamp(last_seen),
             hit_count))
 
 if __name__ == "__main__":